@@ -4,15 +4,10 @@
 # 3 inputs arguments are expected, 1 - input tck, 2 - reference anatomy image, and 3 - output tck.
 # AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
 
-import nibabel as nib
 import os, sys, getopt
-import scipy
-import dipy
-from dipy.io.stateful_tractogram import Space, StatefulTractogram
-from dipy.io.streamline import load_tractogram, save_tractogram
-from dipy.io.utils import create_nifti_header, get_reference_info
-from dipy.denoise.enhancement_kernel import EnhancementKernel
-from dipy.tracking.fbcmeasures import FBCMeasures
+import KUL_FWT_fbc as kfbc
+import KUL_FWT_manifest as kman
+import KUL_FWT_perf as kperf
 
 # print 'Number of arguments:', len(sys.argv), 'arguments.'
 # print 'Argument List:', str(sys.argv)
@@ -25,14 +20,29 @@ def main(argv):
     inputfile = ''
     reffile = ''
     outputfile = ''
+    # scoring engine, dipy (default), exact, grid or approx
+    # exact gives the same rFBC as dipy and is only faster spread over -n processes,
+    # grid and approx are faster but their rFBC differs a little from dipy's, so they are opt-in,
+    # approx scores QuickBundles cluster representatives, -q sets the cluster threshold in mm
+    # KUL_FWT_FBC_ENGINE sets the engine for the runs of make_TCKs.sh, -e still wins
+    engine = os.environ.get('KUL_FWT_FBC_ENGINE', '') or 'dipy'
+    qb_thr = kfbc.QB_THR
+    nproc = 1
+    # rFBC threshold is empirically defined
+    # sliding down from 0.2, -t takes a list of thresholds to sweep
+    # and -m the minimum number of streamlines the chosen one should keep
+    thresholds = [0.02]
+    min_count = 0
+    force = False
+    usage = 'KUL_FWT_FBC_4TCKs.py -i <inputfile> -r <reffile> -o <outputfile> [-e <dipy|exact|grid|approx>] [-q <qb_thr>] [-n <nproc>] [-t <thr1,thr2,..>] [-m <min_count>] [-f]'
     try:
-        opts, args = getopt.getopt(argv,"hi:r:o:",["ifile=","rfile=","ofile="])
+        opts, args = getopt.getopt(argv,"hi:r:o:e:q:n:t:m:f",["ifile=","rfile=","ofile=","engine=","qb_thr=","nproc=","thr=","min_count=","force"])
     except getopt.GetoptError:
-        print ('KUL_FWT_FBC_4TCKs.py -i <inputfile> -r <reffile> -o <outputfile>')
+        print (usage)
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print ('KUL_FWT_FBC_4TCKs.py -i <inputfile> -r <reffile> -o <outputfile>')
+            print (usage)
             sys.exit()
         elif opt in ("-i", "--ifile"):
             inputfile = arg
@@ -40,10 +50,44 @@ def main(argv):
             reffile = arg
         elif opt in ("-o", "--ofile"):
             outputfile = arg
+        elif opt in ("-e", "--engine"):
+            engine = arg
+        elif opt in ("-q", "--qb_thr"):
+            qb_thr = float(arg)
+        elif opt in ("-n", "--nproc"):
+            nproc = int(arg)
+        elif opt in ("-t", "--thr"):
+            thresholds = [float(el) for el in arg.split(',')]
+        elif opt in ("-m", "--min_count"):
+            min_count = int(arg)
+        elif opt in ("-f", "--force"):
+            force = True
     print ('Input file is "', inputfile)
     print ('Reference anatomy file is "', reffile)
     print ('Output file is "', outputfile)
-    # load the reference anatomy
+    print ('FBC engine is "', engine)
+
+    # FBC relevant values
+    D33 = 1.0
+    D44 = 0.02
+    t = 1
+
+    # nothing to do if input, reference and settings are the same as for the existing output
+    sidecar = kfbc.rfbc_sidecar(outputfile)
+    sweep_csv = os.path.splitext(outputfile)[0] + '_rfbc_sweep.csv'
+    m_in = [inputfile, reffile]
+    m_par = {'engine': engine, 'D33': D33, 'D44': D44, 't': t, 'thresholds': thresholds, 'min_count': min_count}
+    if engine == 'approx':
+        m_par['qb_thr'] = qb_thr
+    m_out = [outputfile, sweep_csv, sidecar]
+    if not force and kman.up_to_date('fbc', m_in, m_par, m_out):
+        return
+
+    # nibabel only once the arguments are known
+    import nibabel as nib
+    import KUL_FWT_tckio as ktio
+
+    # load the reference anatomy, only its grid is used
     print ( reffile )
     img = nib.load(reffile)
 
@@ -52,30 +96,45 @@ def main(argv):
     # img.to_filename(${prep_d}/sub-${subj}${ses_str}_T1brain_inFA_sform_fixed.nii.gz)
     # nib.load('${prep_d}/sub-${subj}${ses_str}_T1brain_inFA_sform_fixed.nii.gz')
 
-    # FBC relevant values
-    D33 = 1.0
-    D44 = 0.02
-    t = 1
-    k = EnhancementKernel(D33, D44, t)
-
-    # load the reference tractogram
-    tck_in = load_tractogram(inputfile, img)
+    # the kernel LUT is cached on disk, only the first bundle computes it
+    with kperf.stage('kernel', outputfile):
+        k = kfbc.get_kernel(D33, D44, t)
 
-    # apply FBV to input TCK
-    rfbc = FBCMeasures(tck_in.streamlines, k)
+    # load the reference tractogram as one flat buffer
+    with kperf.stage('load', outputfile) as rec:
+        pts, offs, lens, header = ktio.read_tck(inputfile)
+        rec.update(kperf.counts(lens))
+    if not ktio.in_grid(pts, img.affine, img.shape):
+        raise ValueError('Bounding box is not valid.')
+    streamlines = ktio.as_arraysequence(pts, offs, lens)
 
-    # rFBC threshold is empirically defined
-    # sliding down from 0.2
-    rfbc_thr = 0.02
+    # apply FBV to input TCK, unless the rFBC sidecar of a previous run still matches
+    # see KUL_FWT_fbc.py for how the grid and exact engines compare to dipy, and the approximate one to them
+    params = kfbc.rfbc_params(inputfile, engine, D33, D44, t, qb_thr)
+    rfbc = None if force else kfbc.load_rfbc(sidecar, params)
+    if rfbc is None:
+        with kperf.stage('fbc', outputfile, engine=engine, nproc=nproc, **kperf.counts(lens)):
+            rfbc = kfbc.streamline_rfbc(streamlines, k, engine, nproc, qb_thr=qb_thr)
+        kfbc.save_rfbc(sidecar, rfbc, params)
+    else:
+        print ('Reusing rFBC from "', sidecar)
 
-    # apply threshold to streamlines
-    rfbc_sl, rfbc_rgb, rfbc_rfbc = rfbc.get_points_rfbc_thresholded(rfbc_thr, emphasis=0.01)
+    # count the survivors of every threshold and pick one
+    thrs, counts, rfbc_thr = kfbc.sweep_rfbc(rfbc, thresholds, min_count)
+    with open(sweep_csv, 'w') as sf:
+        sf.write('threshold,count,chosen\n')
+        for thr, count in zip(thrs, counts):
+            print ('rFBC threshold %g keeps %d streamlines' % (thr, count))
+            sf.write('%g,%d,%d\n' % (thr, count, thr == rfbc_thr))
+    print ('Chosen rFBC threshold is "', rfbc_thr)
 
-    # filter the streamlines
-    rfbc_thr_TCK = StatefulTractogram(rfbc_sl, img, Space.RASMM)
+    # apply threshold to streamlines, like kfbc.select_streamlines the last point of each is dropped
+    keep = rfbc > rfbc_thr
 
-    # save them
-    save_tractogram(rfbc_thr_TCK, outputfile, bbox_valid_check=False)
+    # save them straight from the input buffer
+    with kperf.stage('write', outputfile, **kperf.counts(lens[keep] - 1)):
+        ktio.write_tck(outputfile, pts, offs[keep], lens[keep] - 1, header)
+    kman.record('fbc', m_in, m_par, m_out)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
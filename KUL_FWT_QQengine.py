@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+# In-process QQ of a bundle, replaces the chain of mrtrix/scilpy calls in the QQ part of make_TCKs.sh
+# There, every bundle went through tckresample, scil_compute_centroid.py, three tckmap passes,
+# KUL_FWT_reorientTCKs.py, tckstats -histogram, one tcksample per metric and KUL_FWT_TCKsQQ.py,
+# each reading the same .tck again. Here the bundle is read once as a flat point buffer and
+#  - resampled to 101 points along arc length (linear, like dipy's set_number_of_points)
+#  - its centroid is found by aligning all resampled streamlines to a running mean, which is
+#    what QuickBundles with a very large threshold does in scil_compute_centroid.py
+#  - tdi (length in voxel, as tckmap -precise), max length and max curvature maps are built on the
+#    template grid from sub-voxel samples of every segment
+#  - reoriented by VOIs as in KUL_FWT_reorientTCKs.py
+#  - lengths go to the tckstats histogram and report, metrics are sampled at the nearest voxel as
+#    with tcksample -nointerp, and the profiles of KUL_FWT_TCKsQQ.py are made from memory.
+# File names and formats are the ones make_TCKs.sh used, the maps may differ from tckmap in voxels
+# a streamline only grazes. The resampled bundle (rs1c) is only saved with KUL_FWT_DEBUG=1.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt
+import numpy as np
+import KUL_FWT_imcache as kimc
+import KUL_FWT_manifest as kman
+import KUL_FWT_perf as kperf
+import KUL_FWT_store as kstore
+import KUL_FWT_tckio as ktio
+
+
+# flat float64 points, offsets and lengths of a bundle
+def flatten(streamlines):
+    return ktio.flatten(streamlines, dtype=np.float64)
+
+
+# segment lengths, with the segments that join two streamlines set to 0
+def _segments(pts, offs):
+    seg = np.linalg.norm(np.diff(pts, axis=0), axis=1)
+    seg[offs[1:] - 1] = 0
+    return seg
+
+
+# arc length of every streamline
+def streamline_lengths(pts, offs, lens):
+    cum = np.concatenate([[0], np.cumsum(_segments(pts, offs))])
+    return cum[offs + lens - 1] - cum[offs]
+
+
+# all streamlines to n_points equidistant along their arc length, shape (n_streamlines, n_points, 3)
+def resample(pts, offs, lens, n_points=101):
+    seg = _segments(pts, offs)
+    cum = np.concatenate([[0], np.cumsum(seg)])
+    start = cum[offs]
+    total = cum[offs + lens - 1] - start
+    t = start[:, None] + total[:, None] * np.linspace(0, 1, n_points)[None, :]
+
+    # segment each target falls in, kept inside its own streamline
+    idx = np.searchsorted(cum, t.ravel(), side='right').reshape(t.shape) - 1
+    idx = np.clip(idx, offs[:, None], np.maximum(offs + lens - 2, offs)[:, None])
+    nxt = np.minimum(idx + 1, len(pts) - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(seg[np.minimum(idx, len(seg) - 1)] > 0, (t - cum[idx]) / seg[np.minimum(idx, len(seg) - 1)], 0)
+    frac = np.clip(frac, 0, 1)[..., None]
+    return pts[idx] + frac * (pts[nxt] - pts[idx])
+
+
+# centroid of resampled streamlines (n_streamlines, n_points, 3)
+# each streamline is flipped when its reverse is closer to the current centroid
+def centroid(rs, n_iter=10):
+    c = rs[0]
+    for i in range(n_iter):
+        d = np.mean(np.linalg.norm(rs - c, axis=2), 1)
+        d_flip = np.mean(np.linalg.norm(rs[:, ::-1] - c, axis=2), 1)
+        new = np.where((d_flip < d)[:, None, None], rs[:, ::-1], rs).mean(0)
+        if np.allclose(new, c):
+            break
+        c = new
+    return new
+
+
+# curvature (1/mm) at every point, end points take the value of their neighbour
+def point_curvature(pts, offs, lens):
+    a = np.diff(pts, axis=0)
+    na = np.linalg.norm(a, axis=1)
+    curv = np.zeros(len(pts))
+    if len(pts) < 3:
+        return curv
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosang = np.einsum('ij,ij->i', a[:-1], a[1:]) / (na[:-1] * na[1:])
+        k = np.arccos(np.clip(cosang, -1, 1)) / (0.5 * (na[:-1] + na[1:]))
+    curv[1:-1] = np.nan_to_num(k)
+    # first and last points have no angle, and the joins between streamlines are meaningless
+    first = offs
+    last = offs + lens - 1
+    curv[first] = curv[np.minimum(first + 1, last)]
+    curv[last] = curv[np.maximum(last - 1, first)]
+    return curv
+
+
+# tdi, max length and max curvature maps on a template grid
+# every segment is cut in pieces of at most step voxels, each piece counts in the voxel it lies in
+def tract_maps(pts, offs, lens, shape, affine, step=0.1, max_samples=4000000):
+    shape = tuple(shape[:3])
+    tdi = np.zeros(int(np.prod(shape)))
+    lmap = np.zeros(int(np.prod(shape)))
+    cmap = np.zeros(int(np.prod(shape)))
+    if len(pts) < 2:
+        return tdi.reshape(shape), lmap.reshape(shape), cmap.reshape(shape)
+
+    inv = np.linalg.inv(affine)
+    vox = pts @ inv[:3, :3].T + inv[:3, 3]
+    seg_mm = _segments(pts, offs)
+    owner = np.repeat(np.arange(len(lens)), lens)[:-1]
+    sl_len = streamline_lengths(pts, offs, lens)
+    curv = point_curvature(pts, offs, lens)
+
+    # only real segments
+    segs = np.nonzero(seg_mm > 0)[0]
+    n_sub = np.maximum(1, np.ceil(np.linalg.norm(vox[segs + 1] - vox[segs], axis=1) / step)).astype(np.intp)
+
+    # in chunks, to keep the sub samples bounded
+    bounds = np.searchsorted(np.cumsum(n_sub), np.arange(max_samples, n_sub.sum() + max_samples, max_samples))
+    lo = 0
+    for hi in np.unique(np.append(bounds, len(segs))):
+        if hi <= lo:
+            continue
+        s = segs[lo:hi]
+        k = n_sub[lo:hi]
+        rep = np.repeat(np.arange(len(s)), k)
+        j = np.arange(len(rep)) - np.repeat(np.cumsum(k) - k, k)
+        f = ((j + 0.5) / k[rep])[:, None]
+        p = vox[s[rep]] + f * (vox[s[rep] + 1] - vox[s[rep]])
+        ijk = np.floor(p + 0.5).astype(np.intp)
+        inside = np.all((ijk >= 0) & (ijk < np.array(shape)), axis=1)
+        lin = np.ravel_multi_index(tuple(ijk[inside].T), shape)
+        rep = rep[inside]
+        tdi += np.bincount(lin, weights=(seg_mm[s] / k)[rep], minlength=tdi.size)
+        np.maximum.at(lmap, lin, sl_len[owner[s]][rep])
+        np.maximum.at(cmap, lin, (0.5 * (curv[s] + curv[s + 1]))[rep])
+        lo = hi
+    return tdi.reshape(shape), lmap.reshape(shape), cmap.reshape(shape)
+
+
+# values at the nearest voxel of every point, NaN outside the image
+def sample_nearest(vol, affine, pts):
+    vol = np.asarray(vol)
+    if vol.ndim > 3:
+        vol = vol[..., 0]
+    inv = np.linalg.inv(affine)
+    ijk = np.floor(pts @ inv[:3, :3].T + inv[:3, 3] + 0.5).astype(np.intp)
+    inside = np.all((ijk >= 0) & (ijk < np.array(vol.shape)), axis=1)
+    vals = np.full(len(pts), np.nan)
+    vals[inside] = vol[ijk[inside, 0], ijk[inside, 1], ijk[inside, 2]]
+    return vals
+
+
+def save_tck(fname, streamlines):
+    ktio.save_streamlines(fname, streamlines)
+
+
+# (n_streamlines, n_points, 3) array straight to .tck
+def save_resampled(fname, rs):
+    n, p = rs.shape[:2]
+    ktio.write_tck(fname, rs.reshape(-1, 3).astype(np.float32), np.arange(n) * p, np.full(n, p))
+
+
+def save_map(fname, data, template):
+    import nibabel as nib
+    hdr = template.header.copy()
+    hdr.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(data.astype(np.float32), template.affine, hdr), fname)
+
+
+# streamline counts per 1 mm length bin
+def length_counts(lengths):
+    return np.bincount(np.round(lengths).astype(np.intp)) if len(lengths) else np.zeros(1, dtype=np.intp)
+
+
+# length histogram like tckstats -histogram, 1 mm bins
+def write_histogram(fname, lengths):
+    counts = length_counts(lengths)
+    with open(fname, 'w') as f:
+        f.write('# KUL_FWT_QQengine.py\n')
+        f.write('Length,Count\n')
+        for i, c in enumerate(counts):
+            f.write('%d,%d\n' % (i, c))
+
+
+# the summary tckstats prints, appended like tee -a did
+def write_report(fname, lengths):
+    cols = ('mean', 'median', 'std. dev.', 'min', 'max', 'count')
+    if len(lengths):
+        vals = (np.mean(lengths), np.median(lengths), np.std(lengths, ddof=1) if len(lengths) > 1 else 0, np.min(lengths), np.max(lengths))
+    else:
+        vals = (np.nan,) * 5
+    with open(fname, 'a') as f:
+        f.write(''.join('%12s' % c for c in cols) + '\n')
+        f.write(''.join('%12g' % v for v in vals) + '%12d\n' % len(lengths))
+
+
+# one line of space separated values per streamline, as tcksample writes them
+def write_samples(fname, vals, offs, lens):
+    with open(fname, 'w') as f:
+        f.write('# KUL_FWT_QQengine.py\n')
+        for o, n in zip(offs, lens):
+            f.write(' '.join('%g' % v for v in vals[o:o + n]) + '\n')
+
+
+def qq_bundle(inputfile, template, mdir, voi1, voi2, stream=False, n_points=101, overrides=None, profiles=True):
+    import nibabel as nib
+    import KUL_FWT_reorientTCKs as kreor
+    import KUL_FWT_TCKsQQ as kqq
+
+    if not (os.path.isfile(inputfile) and os.path.isfile(template) and os.path.isdir(mdir)):
+        return False
+
+    # names as in make_TCKs.sh, the input is ${TCK_out}/<bundle>_fin_<T>_<algo>_inMNI.tck
+    TCK_out, in_nam = os.path.split(inputfile)
+    fin = in_nam[:-len('_inMNI.tck')] if in_nam.endswith('_inMNI.tck') else os.path.splitext(in_nam)[0]
+    qq_d = os.path.join(TCK_out, 'QQ')
+    os.makedirs(os.path.join(qq_d, 'tmp'), exist_ok=True)
+    tck_rs1 = os.path.join(qq_d, 'tmp', fin + '_rs1c_inMNI.tck')
+    tck_cent = os.path.join(qq_d, 'tmp', fin + '_inMNI_centroid1.tck')
+    tck_reor = os.path.join(qq_d, fin + '_inMNI_rTCK.tck')
+    tckc_reor = os.path.join(qq_d, fin + '_inMNI_centroid_rTCK.tck')
+    maps = [os.path.join(qq_d, fin + '_' + m + '_inMNI.nii.gz') for m in ('tdi', 'length', 'curve')]
+    hist = os.path.join(qq_d, fin + '_rs1c_lengths_histogram.csv')
+    report = os.path.join(qq_d, fin + '_rs1c_lengths_report.csv')
+
+    # metrics sampled along the bundle, same list as the tcksample loop had
+    metrics = [('FA', 'FA_MNI'), ('ADC', 'ADC_MNI'), ('AD', 'AD_MNI'), ('RD', 'RD_MNI')]
+    mets_fs = {m: os.path.join(mdir, f + '.nii.gz') for m, f in metrics}
+    mets_fs.update({'TDI': maps[0], 'Length': maps[1], 'Curve': maps[2]})
+    names = ['FA', 'ADC', 'AD', 'RD', 'TDI', 'Length', 'Curve']
+    # by suffix, SD_Stream has an underscore of its own
+    if fin.endswith(('_iFOD2', '_iFOD1', '_SD_Stream')):
+        mets_fs.update({'FD': os.path.join(mdir, 'fd_MNI.nii.gz'), 'Disp': os.path.join(mdir, 'disp_MNI.nii.gz'), 'Peaks': os.path.join(mdir, 'peaks_MNI.nii.gz')})
+        names += ['FD', 'Disp', 'Peaks']
+    mets_fs.update(overrides or {})
+    samples = [os.path.join(qq_d, fin + '_' + m + '.csv') for m in names]
+
+    # with KUL_FWT_STORE set, histogram and samples go to the subject's store instead of csv files
+    store = kstore.store_file(qq_d)
+    bundle, method, algo = kstore.parse_name(fin)
+
+    # template and metric maps are the same for every bundle of the subject, they are recorded by size
+    # and mtime instead of being hashed for each bundle
+    m_maps = [template] + [mets_fs[m] for m in names[:4] + names[7:] if os.path.isfile(mets_fs[m])]
+    m_in = [inputfile] + [v for v in (voi1, voi2) if os.path.isfile(v)] + m_maps
+    m_par = {'stream': stream, 'n_points': n_points, 'metrics': [[m, mets_fs[m]] for m in names], 'store': store is not None}
+    m_out = [tck_cent] + maps
+    if ktio.keep_intermediates():
+        m_out.append(tck_rs1)
+    reorient = os.path.isfile(voi1) and os.path.isfile(voi2)
+    if reorient:
+        m_out += [tck_reor, tckc_reor] + ([] if store else [hist] + samples)
+
+    if not kman.up_to_date('qqengine', m_in, m_par, m_out) \
+            or (reorient and store is not None and not kstore.has(store, 'histograms', bundle, algo, method, 'length')):
+        # read once, everything below works on the flat buffer
+        with kperf.stage('load', inputfile) as rec:
+            pts, offs, lens, header = ktio.read_tck(inputfile)
+            pts = pts.astype(np.float64)
+            temp = nib.load(template)
+            rec.update(kperf.counts(lens))
+        if not len(lens):
+            # FBC can leave nothing of a bundle, there is nothing to resample, map or profile
+            print ('No streamlines in "', inputfile, '", skipping its QQ')
+            return True
+
+        with kperf.stage('maps', inputfile, **kperf.counts(lens)):
+            rs = resample(pts, offs, lens, n_points)
+            cent = centroid(rs)
+            if ktio.keep_intermediates():
+                save_resampled(tck_rs1, rs)
+            save_tck(tck_cent, [cent.astype(np.float32)])
+
+            tdi, lmap, cmap = tract_maps(pts, offs, lens, temp.shape, temp.affine)
+            for fname, data in zip(maps, (tdi, lmap, cmap)):
+                save_map(fname, data, temp)
+        del pts
+
+        if reorient:
+            with kperf.stage('reorient', inputfile, stream=stream, streamlines=len(rs), points=rs.shape[0] * rs.shape[1]):
+                # same flip rules as KUL_FWT_reorientTCKs.py
+                if stream:
+                    dmap1 = kreor.roi_distance(voi1)
+                    dmap2 = kreor.roi_distance(voi2)
+                    flip = kreor.flip_mask(rs, dmap1, dmap2)
+                    flip_c = kreor.flip_mask([cent], dmap1, dmap2)
+                else:
+                    import dipy.tracking.streamline as dts
+                    tckv1, v_aff = kimc.load_nifti(voi1)
+                    tckv2 = kimc.load_nifti_data(voi2)
+                    reor = dts.orient_by_rois(list(rs), v_aff, np.minimum(tckv1, 1), np.minimum(tckv2, 1), in_place=False, as_generator=False)
+                    flip = np.array([not np.array_equal(a[0], b[0]) for a, b in zip(reor, rs)], dtype=bool)
+                    reor_c = dts.orient_by_rois([cent], v_aff, np.minimum(tckv1, 1), np.minimum(tckv2, 1), in_place=False, as_generator=False)
+                    flip_c = np.array([not np.array_equal(reor_c[0][0], cent[0])])
+                rs = np.where(flip[:, None, None], rs[:, ::-1], rs)
+                cent = cent[::-1] if flip_c[0] else cent
+                save_resampled(tck_reor, rs)
+                save_tck(tckc_reor, [cent.astype(np.float32)])
+
+            # stats and per metric samples of the reoriented, resampled bundle
+            r_pts, r_offs, r_lens = flatten(list(rs.astype(np.float32)))
+            with kperf.stage('samples', inputfile, **kperf.counts(r_lens)):
+                lengths = streamline_lengths(r_pts, r_offs, r_lens)
+                if store:
+                    kstore.add_histogram(store, fin, length_counts(lengths))
+                else:
+                    write_histogram(hist, lengths)
+                write_report(report, lengths)
+                computed = dict(zip(maps, (tdi, lmap, cmap)))
+                for m, fname in zip(names, samples):
+                    im = mets_fs[m]
+                    if im in computed:
+                        vals = sample_nearest(computed[im], temp.affine, r_pts)
+                    elif os.path.isfile(im):
+                        vol, aff = kimc.load_nifti(im)
+                        vals = sample_nearest(vol, aff, r_pts)
+                    else:
+                        print ('No image for ' + m + ', skipping')
+                        continue
+                    if store:
+                        kstore.add_samples(store, fin, m, vals, n_points)
+                    else:
+                        write_samples(fname, vals, r_offs, r_lens)
+
+        kman.record('qqengine', m_in, m_par, m_out, stat_only=m_maps)
+
+        # profiles and fingerprint of KUL_FWT_TCKsQQ.py, straight from the reoriented bundle
+        if reorient and profiles:
+            return kqq.tck_qq(tck_reor, mdir, streamlines=list(rs.astype(np.float32)))
+    elif reorient and profiles:
+        return kqq.tck_qq(tck_reor, mdir)
+    return True
+
+
+def main(argv):
+    inputfile = ''
+    template = ''
+    mdir = ''
+    voi1 = ''
+    voi2 = ''
+    stream = False
+    n_points = 101
+    overrides = {}
+    profiles = True
+    usage = 'KUL_FWT_QQengine.py -i <tck_inMNI> -t <template> -m <mdir> -s <voi1> -e <voi2> [-S] [-p <n_points>] [-x <metric=image,..>] [-P]'
+    try:
+        opts, args = getopt.getopt(argv,"hi:t:m:s:e:Sp:x:P",["ifile=","template=","mdir=","voi1=","voi2=","stream","n_points=","metric_ims=","no_profiles"])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-i", "--ifile"):
+            inputfile = arg
+        elif opt in ("-t", "--template"):
+            template = arg
+        elif opt in ("-m", "--mdir"):
+            mdir = arg
+        elif opt in ("-s", "--voi1"):
+            voi1 = arg
+        elif opt in ("-e", "--voi2"):
+            voi2 = arg
+        elif opt in ("-S", "--stream"):
+            stream = True
+        elif opt in ("-p", "--n_points"):
+            n_points = int(arg)
+        elif opt in ("-x", "--metric_ims"):
+            # e.g. FA=/path/FOD_MNI.nii.gz, to sample another image under a metric's name
+            overrides.update(el.split('=', 1) for el in arg.split(','))
+        elif opt in ("-P", "--no_profiles"):
+            profiles = False
+    print ('Input TCK file is "', inputfile)
+    print ('Template is "', template)
+    print ('Metrics folder is "', mdir)
+    print ('Start VOI file is  "', voi1)
+    print ('End VOI file is  "', voi2)
+
+    if not qq_bundle(inputfile, template, mdir, voi1, voi2, stream, n_points, overrides, profiles):
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
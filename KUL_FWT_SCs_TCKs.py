@@ -12,48 +12,15 @@
 # No need to include any warps or transforms as we stick to subject space
 # still need a script for generating screenshots
 
-import nibabel as nib
-import numpy as np
 import os, sys, getopt, glob
-import scipy
-import dipy
-import dipy.stats.analysis as dsa
-import dipy.data as dpd
-import pkgutil
-import matplotlib
-matplotlib.use('Qt5Agg')
-import matplotlib.pyplot as plt
-import dipy.tracking.streamline as dts
-from nilearn import plotting
+import KUL_FWT_render as krend
 
 
 # inputfile = '/media/rad/Data/DF_final/sub-S5_KUL_WBTCK_Seg_output/sub-S5_TCKs_output/CST_LT_output/CST_LT_fin_WB_iFOD2_inMNI.tck'
 # mdir = '/media/rad/Data/DF_final/sub-S5_KUL_WBTCK_Seg_output/sub-S5_prep'
 # vdir = '/media/rad/Data/DF_final/sub-S5_KUL_WBTCK_Seg_output/sub-S5_VOIs/CST_LT_VOIs_inMNI'
 
-def main(argv):
-    inputfile = ''
-    vdir = ''
-    mdir = ''
-    try:
-        opts, args = getopt.getopt(argv,"hi:v:m:",["ifile=","vdir=","mdir="])
-    except getopt.GetoptError:
-        print ('KUL_FWT_SCs_TCKs.py -i <inputfile> -v <vdir> -m <mdir>')
-        sys.exit(2)
-    for opt, arg in opts:
-        if opt == '-h':
-            print ('KUL_FWT_SCs_TCKs.py -i <inputfile> -v <vdir> -m <mdir>')
-            sys.exit()
-        elif opt in ("-i", "--ifile"):
-            inputfile = arg
-        elif opt in ("-v", "--vdir"):
-            vdir = arg
-        elif opt in ("-m", "--mdir"):
-            mdir = arg
-    print ('Input TCK file is "', inputfile)
-    print ('VOIs dir is "', vdir)
-    print ('Metrics folder is "', mdir)
-
+def bundle_screenshots(inputfile, vdir, mdir):
     # sanity checks
     if os.path.isfile(inputfile):
       if os.path.isdir(vdir):
@@ -88,12 +55,8 @@ def main(argv):
 
             tck_map_src = os.path.join(in_path, '*_fin_map_' + tckmeth + '_*_inMNI.nii.gz')
             tck_map = glob.glob(tck_map_src)
-            tckm_im = nib.load(tck_map[0])
             scrn_shot2 = os.path.join(new_dir, in_name + '_screenshot1_niGB.pdf')
-            gbd = plotting.plot_glass_brain(tckm_im, title= in_name, display_mode='lyrz', cmap= 'cool')
-            gbd.savefig(scrn_shot2, dpi = 300)
-
-
+            scrn_shot3 = os.path.join(new_dir, in_name + '_screenshot2_niGB.pdf')
 
             # need to find my VOIs
             incs_lst = os.path.join(vdir, '*incs*_map_inMNI.nii.gz')
@@ -101,22 +64,38 @@ def main(argv):
             # excs_lst = os.path.join(vdir, '*excs*_bin_inMNI.nii.gz')
             # excs = glob.glob(excs_lst)
 
-            # start with the bundle
-            vois_glasses = plotting.plot_glass_brain(tckm_im, title= in_name, display_mode='lyrz', cmap= 'cool')
+            # rendered now or queued, see KUL_FWT_render.py
+            # same map and VOIs as last time, same screenshots
+            return krend.submit({'kind': 'glass_vois', 'inputs': tck_map[:1] + incs, 'outs': [scrn_shot2, scrn_shot3],
+                                 'title': in_name})
+    return False
 
-            # loop over incs
 
-            voi_ims = nib.load(incs[0])
-            vois_glasses.add_contours(voi_ims, colors='gold', linewidths= 0.75 )
+def main(argv):
+    inputfile = ''
+    vdir = ''
+    mdir = ''
+    try:
+        opts, args = getopt.getopt(argv,"hi:v:m:",["ifile=","vdir=","mdir="])
+    except getopt.GetoptError:
+        print ('KUL_FWT_SCs_TCKs.py -i <inputfile> -v <vdir> -m <mdir>')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('KUL_FWT_SCs_TCKs.py -i <inputfile> -v <vdir> -m <mdir>')
+            sys.exit()
+        elif opt in ("-i", "--ifile"):
+            inputfile = arg
+        elif opt in ("-v", "--vdir"):
+            vdir = arg
+        elif opt in ("-m", "--mdir"):
+            mdir = arg
+    print ('Input TCK file is "', inputfile)
+    print ('VOIs dir is "', vdir)
+    print ('Metrics folder is "', mdir)
 
-            # # handle the vois ims
-            for el in incs[1:]:
-                voi_ims = nib.load(el)
-                vois_glasses.add_contours(voi_ims, colors='gold', linewidths= 0.75 )
-                # vois_glasses.add_contours(voi_ims, colors='gold', threshold=0.01)
+    bundle_screenshots(inputfile, vdir, mdir)
 
-            scrn_shot3 = os.path.join(new_dir, in_name + '_screenshot2_niGB.pdf')
-            vois_glasses.savefig(scrn_shot3, dpi = 300)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
@@ -7,50 +7,26 @@
 # following this example -> https://dipy.org/documentation/1.3.0./_downloads/e344c36d129dda8d2f2bcac50ee292fd/afq_tract_profiles.py/
 
 
-import nibabel as nib
 import numpy as np
 import os, sys, getopt, glob, re
-import scipy
-import dipy
-import dipy.stats.analysis as dsa
-import dipy.data as dpd
-import pkgutil
-import matplotlib
-import csv
-matplotlib.use('Qt5Agg')
-import matplotlib.pyplot as plt
-import dipy.tracking.streamline as dts
-from nilearn import plotting
-from dipy.tracking import utils
-from dipy.viz import actor, window, colormap as cmap
-from dipy.io.image import load_nifti, load_nifti_data, save_nifti
-from dipy.io.stateful_tractogram import Space, StatefulTractogram
-from dipy.io.streamline import load_tractogram, save_tractogram
-from dipy.io.utils import create_nifti_header, get_reference_info
-from dipy.segment.clustering import QuickBundles
-from dipy.segment.metric import AveragePointwiseEuclideanMetric, ResampleFeature
+from KUL_FWT_profiles import afq_profiles
+import KUL_FWT_fingerprint as kfp
+import KUL_FWT_imcache as kimc
+import KUL_FWT_manifest as kman
+import KUL_FWT_store as kstore
+import KUL_FWT_render as krend
+import KUL_FWT_perf as kperf
+import KUL_FWT_tckio as ktio
 
 # inputfile = '/media/rad/Data/DF_final/sub-DF_KUL_WBTCK_Seg_output/sub-DF_TCKs_output/CST_LT_output/QQ/tmp/CST_LT_fin_WB_iFOD2_inMNI_rTCK.tck'
 # mdir = '/media/rad/Data/DF_final/sub-DF_KUL_WBTCK_Seg_output/sub-DF_prep'
 
-def main(argv):
-    inputfile = ''
-    mdir = ''
-    try:
-        opts, args = getopt.getopt(argv,"hi:c:v:m:",["ifile=","mdir=","scalars="])
-    except getopt.GetoptError:
-        print ('KUL_FWT_TCKsQQ.py -i <inputfile> -m <mdir>')
-        sys.exit(2)
-    for opt, arg in opts:
-        if opt == '-h':
-            print ('KUL_FWT_TCKsQQ.py -i <inputfile> -m <mdir>')
-            sys.exit()
-        elif opt in ("-i", "--ifile"):
-            inputfile = arg
-        elif opt in ("-m", "--mdir"):
-            mdir = arg
-    print ('Input TCK file is "', inputfile)
-    print ('Metrics folder is "', mdir)
+# streamlines can be passed in when the caller already has the bundle of inputfile in memory
+def tck_qq(inputfile, mdir, csv=True, streamlines=None):
+    # heavy imports stay out of module level, -h and the batch driver don't pay for them
+    # figures are drawn by KUL_FWT_render.py
+    import nibabel as nib
+    from dipy.io.streamline import load_tractogram
 
     # sanity checks
     if os.path.isfile(inputfile):
@@ -66,15 +42,6 @@ def main(argv):
             # third define metrics common to both approaches
             # FA, ADC, AD, RD, Curvature
             fa_im = os.path.join(mdir, 'FA_MNI.nii.gz')
-            refff = nib.load(fa_im)
-            fa, _ = load_nifti(fa_im)
-
-            # load the input tractogram
-            # and find the centroid to load it as well
-            tck_in = load_tractogram(inputfile, refff).streamlines
-
-            # find your weights
-            w_tcks = dsa.gaussian_weights(tck_in)
 
             # more metrics
             # metrics1 = ['FA', 'ADC', 'AD', 'RD', 'Curv']
@@ -85,72 +52,123 @@ def main(argv):
                 names1 += ('Apparent Fiber Density', 'Fiber Dispersion', 'FOD Peaks')
                 metrics1 += ('fd', 'disp', 'peaks')
 
-            for m in range(len(metrics1)):
-                im = os.path.join(mdir, str(metrics1[m]) + '_MNI.nii.gz')
-                im_l, _ = load_nifti(im)
-                prof_fig = os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_' + str(metrics1[m]) + '_scalar_profile.pdf')
-                prof_tck = dsa.afq_profile(im_l, tck_in, refff.affine, weights=w_tcks)
-                prof_out = os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_' + str(metrics1[m]) + '_scalar_profile.csv')
-                np.savetxt(prof_out, prof_tck, delimiter=',')
-                fig, (ax1) = plt.subplots(1,1)
-                ax1.plot(prof_tck)
-                ax1.set_ylabel(names1[m])
-                ax1.set_xlabel('Node along bundle')
-                ax1.ticklabel_format(axis="y", style="sci", scilimits=(0,0))
-                plt.title(in_nr[0])
-                plt.tight_layout()
-                fig.savefig(prof_fig, bbox_inches='')
-                plt.close()
-                del fig
-
-
             # deal with tract specific maps
             names2 = ('Streamlines TDI', 'Streamlines Lengths', 'Streamlines Curvature')
             metrics2 = ('tdi', 'length', 'curve')
 
-            for n in range(len(metrics2)):
-                im2 = os.path.join(in_path, in_nr[0] + '_' + str(metrics2[n]) + '_inMNI.nii.gz')
-                im_l2, _ = load_nifti(im2)
-                prof_fig2 = os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_' + str(metrics2[n]) + '_scalar_profile.pdf')
-                prof_tck2 = dsa.afq_profile(im_l2, tck_in, refff.affine, weights=w_tcks)
-                prof_out2 = os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_' + str(metrics2[n]) + '_scalar_profile.csv')
-                np.savetxt(prof_out2, prof_tck2, delimiter=',')
-                fig2, (ax2) = plt.subplots(1,1)
-                ax2.plot(prof_tck2)
-                ax2.set_ylabel(names2[n])
-                ax2.set_xlabel('Node along bundle')
-                ax2.ticklabel_format(axis="y", style="sci", scilimits=(0,0))
-                plt.title(in_nr[0])
-                plt.tight_layout()
-                fig2.savefig(prof_fig2, bbox_inches='')
-                plt.close()
-                del fig2
+            names = names1 + names2
+            metrics = metrics1 + metrics2
+            ims = [os.path.join(mdir, str(m) + '_MNI.nii.gz') for m in metrics1]
+            ims += [os.path.join(in_path, in_nr[0] + '_' + str(m) + '_inMNI.nii.gz') for m in metrics2]
+
+            # with KUL_FWT_STORE set, profiles and fingerprint go to the subject's store instead of csv files
+            store = kstore.store_file(in_path)
+            key = kstore.parse_name(in_nr[0])
+
+            # the pdfs are checked by the renderer, but their values come from here, so a missing pdf
+            # redoes the profiles, also when figures are queued: a job whose render failed or never ran
+            # is queued again. A stage that only writes to the store keeps its record next to the input tck
+            prof_base = [os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_' + str(m) + '_scalar_profile') for m in metrics]
+            prof_outs = [] if store else [p + '.csv' for p in prof_base]
 
             # read your map
             # use scale1 MSBP uint8
             brain_m1 = os.path.join(mdir, '*_LC+spine_inMNI.nii.gz')
             brain_m2 = glob.glob(brain_m1)
-            brain_map = load_nifti_data(brain_m2[0])
-            _, bm_affine = load_nifti(brain_m2[0])
 
             # make name for output pdf
             conn_fp = os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_conn_fingerprint.pdf')
+            connfp_npz = os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_conn_fingerprint.npz')
             connfp_csv = os.path.join(in_path, in_nr[0] + '_' + in_nr[1] + '_conn_grouping.csv')
-
-            # make the conn_fp figure if not yet made
-            if not os.path.exists(conn_fp):
-                # read your tck
-                refff = nib.load(brain_m2[0])
-                # tck_in = load_tractogram(inputfile, refff).streamlines
+            fp_outs = [connfp_npz] + ([connfp_csv] if csv and not store else [])
+
+            # profiles and fingerprint are redone only when their inputs changed, see KUL_FWT_manifest.py
+            # or when they are missing from the store
+            prof_par = {'metrics': metrics, 'store': store is not None}
+            fp_par = {'csv': csv, 'store': store is not None}
+            do_profs = not kman.up_to_date('profiles', [inputfile] + ims, prof_par, prof_outs) \
+                or (store is not None and not kstore.has(store, 'profiles', key[0], key[2], key[1], metrics[-1])) \
+                or not all(os.path.isfile(p + '.pdf') for p in prof_base)
+            do_fp = not kman.up_to_date('fingerprint', [inputfile] + brain_m2[:1], fp_par, fp_outs) \
+                or (store is not None and not kstore.has(store, 'fingerprints', key[0], key[2], key[1], 'conn'))
+
+            if do_profs or do_fp:
+                # load the input tractogram
+                # and find the centroid to load it as well
+                refff = nib.load(fa_im)
+                if streamlines is None:
+                    with kperf.stage('load', inputfile) as rec:
+                        tck_in = load_tractogram(inputfile, refff).streamlines
+                        rec.update(kperf.counts(ktio.lengths(tck_in)))
+                else:
+                    tck_in = streamlines
+                n_sl = kperf.counts(ktio.lengths(tck_in))
+
+            if do_profs:
+                ims_l = [kimc.load_nifti(im)[0] for im in ims]
+
+                # profile all maps in one pass, weights are gaussian as before
+                with kperf.stage('profiles', inputfile, metrics=len(ims_l), **n_sl):
+                    profs = afq_profiles(ims_l, tck_in, refff.affine, weights='gaussian')
+
+                for m in range(len(metrics)):
+                    prof_tck = profs[m]
+                    if store:
+                        kstore.add_profile(store, in_nr[0], metrics[m], prof_tck)
+                    else:
+                        np.savetxt(prof_base[m] + '.csv', prof_tck, delimiter=',')
+                # the subject's maps are shared by all bundles, they are recorded by size and mtime
+                kman.record('profiles', [inputfile] + ims, prof_par, prof_outs, stat_only=ims[:len(metrics1)])
+
+            # make the conn_fp figure if its inputs changed, this used to be a check on conn_fp only
+            if do_fp:
+                # sparse fingerprint, see KUL_FWT_fingerprint.py
+                brain_map, bm_affine = kfp.load_labels(brain_m2[0])
 
                 ## we set the first row and column to zero before viewing
-                M, _ = utils.connectivity_matrix(tck_in, bm_affine, brain_map.astype(np.uint8), return_mapping=True, mapping_as_streamlines=True)
-                M[:1, :] = 0
-                M[:, :1] = 0
-                conn_FP = plt.imshow(np.log1p(M), interpolation='nearest')
-                conn_FP.figure.savefig(conn_fp, dpi = 300)
-                plt.close()
-                np.savetxt(connfp_csv, M, delimiter=',')
+                with kperf.stage('fingerprint', inputfile, **n_sl):
+                    M = kfp.drop_background(kfp.fingerprint(tck_in, brain_map, bm_affine))
+                kfp.save_fingerprint(M, connfp_npz, connfp_csv if csv and not store else None)
+                if store:
+                    kstore.add_fingerprint(store, in_nr[0], M)
+                kman.record('fingerprint', [inputfile] + brain_m2[:1], fp_par, fp_outs, stat_only=brain_m2[:1])
+
+            # figures are rendered now or queued, see KUL_FWT_render.py
+            # the profile values go with the job, so changed profiles mean new plots
+            if do_profs:
+                for m in range(len(metrics)):
+                    krend.submit({'kind': 'profile', 'inputs': [], 'outs': [prof_base[m] + '.pdf'], 'title': in_nr[0],
+                                  'ylabel': names[m], 'values': [float(v) for v in profs[m]]})
+            krend.submit({'kind': 'matrix', 'inputs': [connfp_npz], 'outs': [conn_fp], 'title': in_nr[0]})
+
+            return True
+    return False
+
+
+def main(argv):
+    inputfile = ''
+    mdir = ''
+    csv = True
+    try:
+        opts, args = getopt.getopt(argv,"hi:c:v:m:N",["ifile=","mdir=","scalars=","no_csv"])
+    except getopt.GetoptError:
+        print ('KUL_FWT_TCKsQQ.py -i <inputfile> -m <mdir> [-N]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('KUL_FWT_TCKsQQ.py -i <inputfile> -m <mdir> [-N]')
+            sys.exit()
+        elif opt in ("-i", "--ifile"):
+            inputfile = arg
+        elif opt in ("-m", "--mdir"):
+            mdir = arg
+        elif opt in ("-N", "--no_csv"):
+            # fingerprint only as .npz
+            csv = False
+    print ('Input TCK file is "', inputfile)
+    print ('Metrics folder is "', mdir)
+
+    tck_qq(inputfile, mdir, csv)
 
 
 if __name__ == "__main__":
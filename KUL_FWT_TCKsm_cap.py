@@ -1,22 +1,29 @@
 #!/usr/bin/env python3
 
-import nibabel as nib
-import numpy as np
-import os, sys, getopt, glob
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use('Qt5Agg')
-import dipy.tracking.streamline as dts
-from nilearn import plotting
-import subprocess
-from io import StringIO
-from dipy.io.image import load_nifti, load_nifti_data, save_nifti
-from dipy.viz import actor, window, colormap as cmap
+import os, sys, getopt
+import KUL_FWT_render as krend
 
 # inputfile = '/media/rad/Data/DF_final/sub-S5_KUL_WBTCK_Seg_output/sub-S5_TCKs_output/CST_LT_output/QQ/CST_LT_fin_WB_iFOD2_rs50_segments_MNI.nii.gz'
 
 # inputfile = '/media/rad/Data/DF_final/trial_warp_segment.nii.gz'
 
+def segments_screenshot(inputfile):
+    # insert if loop looking for inputfile here
+    # tck_seg_map to be saved as a fig as well
+    if os.path.isfile(inputfile):
+
+        # get paths and names
+        in_path, in_nam = os.path.split(inputfile)
+        in_name = os.path.splitext(os.path.splitext(in_nam)[0])[0]
+
+        # screenshot name
+        scnsht_map = os.path.join(in_path, in_name + '_segments_map.pdf')
+
+        # rendered now or queued, see KUL_FWT_render.py, skipped if the segmentation map did not change
+        return krend.submit({'kind': 'segments', 'inputs': [inputfile], 'outs': [scnsht_map], 'title': in_name})
+    return False
+
+
 def main(argv):
     inputfile = ''
     try:
@@ -32,23 +39,8 @@ def main(argv):
             inputfile = arg
     print ('Input TCK segmentation file is "', inputfile)
 
-    # insert if loop looking for inputfile here
-    # tck_seg_map to be saved as a fig as well
-    if os.path.isfile(inputfile):
-
-        # get paths and names
-        in_path, in_nam = os.path.split(inputfile)
-        in_name = os.path.splitext(os.path.splitext(in_nam)[0])[0]
-
-        # load the segmentation map
-        tckm_im = nib.load(inputfile)
-
-        # screenshot name
-        scnsht_map = os.path.join(in_path, in_name + '_segments_map.pdf')
-
-        maps_glass = plotting.plot_glass_brain(tckm_im, title= in_name, display_mode='lyrz', cmap= 'hsv', plot_abs=True, threshold=0.05, vmin=0.05, vmax=100, colorbar=True)
+    segments_screenshot(inputfile)
 
-        maps_glass.savefig(scnsht_map, dpi = 300)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# In-memory VOI generation, replaces the mrcalc chains of make_VOIs.sh for the PD25 nuclei and the
+# bundle VOI maps
+# PD25_lab_gen ran one mrcalc per PD25 label (76 of them) to split the atlas into temporary ROIs,
+# then summed, smoothed, took the largest component and masked every nucleus with one mrcalc |
+# mrfilter | maskfilter | mrcalc pipe each, and make_VOIs ran one mrcalc per VOI of a bundle plus
+# a long -replace chain to put them together, all reading the same label maps again.
+# Here every label map is read once, a VOI is a vectorized lookup of its label set, smoothing,
+# dilation and largest component are done on the arrays and each output is written once.
+#  - PD25 mode (-m PD25): the thalamic nuclei and red nuclei in custom_VOIs, same names as before.
+#    mrfilter smooth is a gaussian of 1 voxel stdev cut at 2 stdevs, thresholded at 0.5 for
+#    maskfilter connect (26 neighbours as -connectivity), dilate is 1 pass over the 6 neighbours.
+#  - maps mode (-m maps): all VOI sets listed in a spec file written by make_VOIs.sh, one per line
+#    as name|map_out|lut_out|VOI names|source maps|intensities (lists comma separated, a custom VOI
+#    has no source map and its own file as intensity). Earlier VOIs win where VOIs overlap, as with
+#    the -replace chain, and the _map, _bin and _LUT.csv files are the ones make_VOIs wrote.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt
+from collections import Counter
+import numpy as np
+import KUL_FWT_imcache as kimc
+
+# PD25 nucleus: (right hemisphere labels, smoothing op, masked by the FS thalamus)
+# left hemisphere labels are the right ones x 100
+PD25_NUCLEI = [
+    ('DM', [37, 40], 'smooth', True),
+    ('DL', [53], None, True),
+    ('VA', [26, 28, 36, 89], 'smooth', True),
+    ('VL', [86, 87, 88, 90, 91, 92, 93, 94, 104, 111, 112, 114, 120, 123], 'smooth', True),
+    ('VPL', [96, 97, 98, 115, 117, 118], 'smooth', True),
+    ('VPM', [95, 113], 'smooth', True),
+    ('Pulvi', [102, 103, 105, 106, 107, 116, 119], 'dilate', True),
+    ('RN', [48], 'smooth', False),
+]
+
+# FS aparc+aseg labels of the thalami
+FS_THAL = {'LT': 10, 'RT': 49}
+
+
+# index of the label of every voxel in labels (first one for repeats), len(labels) where none
+# one sorted lookup over the image for the whole label set
+def label_index(data, labels):
+    labels = np.asarray(labels, dtype=np.float64)
+    uniq, first = np.unique(labels, return_index=True)
+    pos = np.clip(np.searchsorted(uniq, data), 0, len(uniq) - 1)
+    return np.where(uniq[pos] == data, first[pos], len(labels))
+
+
+# boolean mask of the voxels whose label is in labels
+def label_set(data, labels):
+    return label_index(data, labels) < len(labels)
+
+
+def smooth(mask, stdev=1.0):
+    from scipy import ndimage
+    return ndimage.gaussian_filter(mask.astype(np.float32), stdev, truncate=2.0) > 0.5
+
+
+def dilate(mask, npass=1):
+    from scipy import ndimage
+    return ndimage.binary_dilation(mask, ndimage.generate_binary_structure(3, 1), iterations=npass)
+
+
+def largest_component(mask):
+    from scipy import ndimage
+    lab, n = ndimage.label(mask, ndimage.generate_binary_structure(3, 3))
+    if n < 2:
+        return lab > 0
+    sizes = np.bincount(lab.ravel())
+    sizes[0] = 0
+    return lab == np.argmax(sizes)
+
+
+# uint16 nifti on the grid of the given affine, as mrcalc -datatype uint16 wrote them
+def save_uint16(fname, data, affine):
+    import nibabel as nib
+    img = nib.Nifti1Image(np.asarray(data, dtype=np.uint16), affine)
+    img.set_data_dtype(np.uint16)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    nib.save(img, fname)
+
+
+def pd25_nuclei(pd25_f, csf_binv_f, aparc_f, out_d):
+    pd25, affine = kimc.load_nifti(pd25_f)
+    # CSF is taken out of the atlas first
+    pd25 = np.where(kimc.load_nifti_data(csf_binv_f) > 0, pd25, 0)
+    aparc = kimc.load_nifti_data(aparc_f)
+
+    outs = {}
+    for side in ('LT', 'RT'):
+        thal = aparc == FS_THAL[side]
+        outs['Thalamus_%s_FS_custom' % side] = thal
+        for name, labels, op, in_thal in PD25_NUCLEI:
+            if side == 'LT':
+                labels = [v * 100 for v in labels]
+            voi = label_set(pd25, labels)
+            if op == 'smooth':
+                voi = smooth(voi)
+            elif op == 'dilate':
+                voi = dilate(voi)
+            voi = largest_component(voi)
+            if in_thal:
+                voi = voi & thal
+            outs['PD25_%s_%s_custom' % (name, side)] = voi
+        # used for the ORs, ML and the thalamic radiations
+        outs['PD25_VA_VL_%s_custom' % side] = outs['PD25_VA_%s_custom' % side] | outs['PD25_VL_%s_custom' % side]
+        outs['PD25_VPL_VPM_%s_custom' % side] = outs['PD25_VPL_%s_custom' % side] | outs['PD25_VPM_%s_custom' % side]
+        outs['PD25_VPALPLPM_%s_custom' % side] = outs['PD25_VA_VL_%s_custom' % side] | outs['PD25_VPL_VPM_%s_custom' % side]
+
+    os.makedirs(out_d, exist_ok=True)
+    for name, voi in outs.items():
+        save_uint16(os.path.join(out_d, name + '.nii.gz'), voi, affine)
+    print ('%d PD25 derived VOIs written to %s' % (len(outs), out_d))
+
+
+def read_spec(spec_f):
+    sets = []
+    with open(spec_f) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, map_out, lut_out, names, sources, intens = line.split('|')
+            sets.append({'name': name, 'map': map_out, 'lut': lut_out, 'names': names.split(','),
+                         'sources': sources.split(','), 'intens': intens.split(',')})
+    return sets
+
+
+def _load_custom(path):
+    import nibabel as nib
+    img = nib.load(path)
+    return np.asanyarray(img.dataobj), img.affine
+
+
+# all VOI maps of the spec, every label map and custom VOI is read once
+def voi_maps(sets):
+    # label maps go through the image cache, custom VOIs are only read, and both are dropped
+    # once the last set using them is done
+    uses = Counter()
+    for s in sets:
+        uses.update(set(src or it for src, it in zip(s['sources'], s['intens'])))
+    loaded = {}
+
+    for s in sets:
+        n = len(s['names'])
+        # VOI indices per image, a custom VOI is its own image
+        by_img = {}
+        for z, (src, it) in enumerate(zip(s['sources'], s['intens'])):
+            by_img.setdefault(src or it, []).append((z, it if src else None))
+
+        # lowest VOI index in each voxel, the -replace chain kept the first VOI
+        first = None
+        affine = None
+        for path, vois in by_img.items():
+            if path not in loaded:
+                loaded[path] = _load_custom(path) if vois[0][1] is None else kimc.load_nifti(path)
+            data, aff = loaded[path]
+            if vois[0][0] == 0:
+                # mrcalc wrote the map on the grid of the first VOI
+                affine = aff
+            if vois[0][1] is None:
+                hit = np.where(data > 0, vois[0][0], n)
+            else:
+                order = np.array([z for z, it in vois] + [n])
+                hit = order[label_index(data, [float(it) for z, it in vois])]
+            first = hit if first is None else np.minimum(first, hit)
+
+        # VOI z gets value z + 1, voxels without VOI 0
+        vals = np.append(np.arange(1, n + 1), 0).astype(np.uint16)
+        vmap = vals[first]
+
+        os.makedirs(os.path.dirname(s['map']), exist_ok=True)
+        save_uint16(s['map'], vmap, affine)
+        save_uint16(s['map'].replace('_map.nii.gz', '_bin.nii.gz'), vmap > 0, affine)
+        with open(s['lut'], 'w') as f:
+            for z, name in enumerate(s['names']):
+                f.write('%s, %d \n' % (name, z + 1))
+        print ('%s: %d VOIs' % (s['name'], n))
+
+        for path in by_img:
+            uses[path] -= 1
+            if uses[path] == 0:
+                del loaded[path]
+
+
+def main(argv):
+    mode = ''
+    spec_f = ''
+    pd25_f = ''
+    csf_f = ''
+    aparc_f = ''
+    out_d = ''
+    usage = ('KUL_FWT_VOIengine.py -m maps -i <spec_file>\n'
+             'KUL_FWT_VOIengine.py -m PD25 -p <PD25_in_FA> -c <csf_mask_binv> -a <aparc_inFA> -o <custom_VOIs_dir>')
+    try:
+        opts, args = getopt.getopt(argv,"hm:i:p:c:a:o:",["mode=","ifile=","pd25=","csf=","aparc=","odir="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-m", "--mode"):
+            mode = arg
+        elif opt in ("-i", "--ifile"):
+            spec_f = arg
+        elif opt in ("-p", "--pd25"):
+            pd25_f = arg
+        elif opt in ("-c", "--csf"):
+            csf_f = arg
+        elif opt in ("-a", "--aparc"):
+            aparc_f = arg
+        elif opt in ("-o", "--odir"):
+            out_d = arg
+    print ('Mode is "', mode)
+
+    if mode == 'PD25':
+        for f in (pd25_f, csf_f, aparc_f):
+            if not os.path.isfile(f):
+                print ('"%s" not found, exitting' % f)
+                sys.exit(2)
+        pd25_nuclei(pd25_f, csf_f, aparc_f, out_d)
+    elif mode == 'maps':
+        if not os.path.isfile(spec_f):
+            print ('Spec file not found, exitting')
+            sys.exit(2)
+        voi_maps(read_spec(spec_f))
+    else:
+        print (usage)
+        sys.exit(2)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
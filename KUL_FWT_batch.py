@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Run the python QC steps of KUL_FWT_make_TCKs.sh for all bundles of a subject in one process
+# make_TCKs.sh calls KUL_FWT_QQengine.py, KUL_FWT_TCKsm_cap.py, KUL_FWT_TCKsQQ.py and
+# KUL_FWT_SCs_TCKs.py once per bundle, and every call imports dipy, nilearn and matplotlib again.
+# Here they are imported once, metric images are shared through KUL_FWT_imcache and the bundles
+# of the config file (KUL_FWT_tracks_list.txt format) are spread over a pool of workers.
+# Paths follow the naming of make_TCKs.sh, so this is run on its output dir once the mrtrix and
+# scilpy steps are done. The per script CLIs work as before.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, glob, time, traceback
+import importlib
+import multiprocessing as mp
+import KUL_FWT_QQengine as kqqe
+import KUL_FWT_TCKsm_cap as kcap
+import KUL_FWT_TCKsQQ as kqq
+import KUL_FWT_SCs_TCKs as kscs
+import KUL_FWT_render as krend
+
+# stages in the order make_TCKs.sh runs them
+STAGES = ('qqengine', 'segs', 'qq', 'scs')
+
+# the scripts import these on first use, see preload
+HEAVY = {'qqengine': ('nibabel', 'dipy.tracking.streamline', 'scipy.ndimage'),
+         'segs': ('nilearn.plotting',),
+         'qq': ('nibabel', 'matplotlib.pyplot', 'dipy.tracking.utils', 'dipy.io.streamline'),
+         'scs': ('nilearn.plotting',)}
+
+
+# import what the stages need once, before forking, so workers don't each import it again
+def preload(stages):
+    import matplotlib
+    if 'MPLBACKEND' not in os.environ:
+        matplotlib.use('Agg')
+    for stage in stages:
+        for mod in HEAVY[stage]:
+            importlib.import_module(mod)
+
+
+# bundle names from a config file in the KUL_FWT_tracks_list.txt format
+# commented lines are skipped, only the name before the comma is kept
+def read_bundles(conf_f):
+    bundles = []
+    with open(conf_f) as f:
+        for line in f:
+            line = line.strip()
+            if not line or '#' in line:
+                continue
+            bundles.append(line.split(',')[0].strip())
+    return bundles
+
+
+# start and end VOIs for reorienting, same rules as make_TCKs.sh
+def pick_vois(TCK, vois):
+    if len(vois) < 2:
+        return None, None
+    elif len(vois) == 2:
+        return vois[0], vois[1]
+    elif len(vois) == 3 and TCK.endswith('_Comm'):
+        return vois[1], vois[-1]
+    return vois[0], vois[-1]
+
+
+# all inputs of all stages for one bundle
+def bundle_paths(output_d, subj, ses, TCK, T, algo_f):
+    ses_str = '_ses-' + ses if ses else ''
+    TCKs_outd = os.path.join(output_d, 'sub-' + subj + ses_str + '_TCKs_output')
+    TCK_out = os.path.join(TCKs_outd, TCK + '_output')
+    ROIs_d = os.path.join(output_d, 'sub-' + subj + ses_str + '_VOIs')
+    fin = TCK + '_fin_' + T + '_' + algo_f
+    vois = sorted(glob.glob(os.path.join(ROIs_d, TCK + '_VOIs_inMNI', TCK + '_incs*_map_inMNI.nii.gz')))
+    voi1, voi2 = pick_vois(TCK, vois)
+    return {'prep_d': os.path.join(output_d, 'sub-' + subj + ses_str + '_prep'),
+            'vdir': os.path.join(ROIs_d, TCK + '_VOIs_inMNI'),
+            'tck_inT': os.path.join(TCK_out, fin + '_inMNI.tck'),
+            'tck_reor': os.path.join(TCK_out, 'QQ', fin + '_inMNI_rTCK.tck'),
+            'MNI_segs': os.path.join(TCK_out, 'QQ', fin + '_rs1c_segments_inMNI.nii.gz'),
+            'voi1': voi1 or '',
+            'voi2': voi2 or ''}
+
+
+def run_stage(stage, p):
+    if stage == 'qqengine':
+        # resampling, maps, reorientation and samples, the profiles are the qq stage
+        return kqqe.qq_bundle(p['tck_inT'], p['template'], p['prep_d'], p['voi1'], p['voi2'], p['stream'], profiles=False)
+    elif stage == 'segs':
+        return kcap.segments_screenshot(p['MNI_segs'])
+    elif stage == 'qq':
+        return kqq.tck_qq(p['tck_reor'], p['prep_d'])
+    elif stage == 'scs':
+        return kscs.bundle_screenshots(p['tck_inT'], p['vdir'], p['prep_d'])
+
+
+# run the stages for one bundle, a failing stage does not stop the others
+# returns the bundle, a status per stage and the wall time
+def run_bundle(job):
+    TCK, p, stages = job
+    t0 = time.time()
+    status = []
+    for stage in stages:
+        try:
+            status.append('done' if run_stage(stage, p) else 'skipped')
+        except Exception:
+            traceback.print_exc()
+            status.append('failed')
+    return TCK, status, time.time() - t0
+
+
+def main(argv):
+    output_d = ''
+    subj = ''
+    ses = ''
+    conf_f = ''
+    T_app = 2
+    algo_f = 'iFOD2'
+    nproc = 1
+    stages = STAGES
+    stream = False
+    # template grid of the tdi/length/curvature maps, the one make_TCKs.sh uses
+    template = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'KUL_FWT_templates', 'T1_preunbiased.nii.gz')
+    usage = 'KUL_FWT_batch.py -o <output_d> -p <subj> -c <conf_f> [-s <ses>] [-T <1|2>] [-a <algo>] [-n <nproc>] [-x <stage1,stage2,..>] [-S] [-t <template>]'
+    try:
+        opts, args = getopt.getopt(argv,"ho:p:s:c:T:a:n:x:St:",["output_d=","subj=","ses=","conf_f=","T_app=","algo=","nproc=","stages=","stream","template="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            print ('stages are ' + ','.join(STAGES))
+            sys.exit()
+        elif opt in ("-o", "--output_d"):
+            output_d = arg
+        elif opt in ("-p", "--subj"):
+            subj = arg
+        elif opt in ("-s", "--ses"):
+            ses = arg
+        elif opt in ("-c", "--conf_f"):
+            conf_f = arg
+        elif opt in ("-T", "--T_app"):
+            T_app = int(arg)
+        elif opt in ("-a", "--algo"):
+            algo_f = arg
+        elif opt in ("-n", "--nproc"):
+            nproc = int(arg)
+        elif opt in ("-x", "--stages"):
+            stages = tuple(arg.split(','))
+        elif opt in ("-S", "--stream"):
+            # streaming reorientation, see KUL_FWT_reorientTCKs.py
+            stream = True
+        elif opt in ("-t", "--template"):
+            template = arg
+    print ('Output dir is "', output_d)
+    print ('Subject is "', subj)
+    print ('Config file is "', conf_f)
+    print ('Stages are "', ','.join(stages))
+
+    if not os.path.isdir(output_d) or not os.path.isfile(conf_f):
+        print ('Output dir or config file not found, exitting')
+        sys.exit(2)
+    bad = [st for st in stages if st not in STAGES]
+    if bad:
+        print ('Unknown stages ' + ','.join(bad) + ', choose from ' + ','.join(STAGES))
+        sys.exit(2)
+
+    # same naming as make_TCKs.sh, 1 is BT and 2 is WB
+    T = 'BT' if T_app == 1 else 'WB'
+    bundles = read_bundles(conf_f)
+    jobs = [(TCK, bundle_paths(output_d, subj, ses, TCK, T, algo_f), stages) for TCK in bundles]
+    for job in jobs:
+        job[1]['stream'] = stream
+        job[1]['template'] = template
+
+    # figures of all bundles are queued and rendered together at the end, unless a queue is set already
+    ses_str = '_ses-' + ses if ses else ''
+    TCKs_outd = os.path.join(output_d, 'sub-' + subj + ses_str + '_TCKs_output')
+    own_queue = krend.queue_file() is None
+    n_figs_failed = 0
+    if own_queue:
+        os.environ['KUL_FWT_RENDER_QUEUE'] = os.path.join(TCKs_outd, 'sub-' + subj + ses_str + '_render_queue.jsonl')
+
+    # forked workers inherit the imports, each takes a whole bundle
+    t0 = time.time()
+    preload(stages)
+    if nproc > 1:
+        with mp.Pool(min(nproc, len(jobs))) as pool:
+            results = list(pool.imap_unordered(run_bundle, jobs))
+    else:
+        results = [run_bundle(job) for job in jobs]
+    order = {TCK: i for i, TCK in enumerate(bundles)}
+    results.sort(key=lambda r: order[r[0]])
+    if own_queue:
+        n_figs, n_figs_failed = krend.render_queue(krend.queue_file(), nproc)
+        del os.environ['KUL_FWT_RENDER_QUEUE']
+        print ('%d figures rendered, %d failed' % (n_figs, n_figs_failed))
+
+    # report per bundle, also as csv next to the bundles
+    report = os.path.join(TCKs_outd, 'sub-' + subj + ses_str + '_QC_batch_report.csv')
+    n_failed = 0
+    with open(report, 'w') as rf:
+        rf.write('bundle,' + ','.join(stages) + ',seconds\n')
+        for TCK, status, secs in results:
+            print ('%s: %s (%.1f s)' % (TCK, ', '.join(st + ' ' + s for st, s in zip(stages, status)), secs))
+            rf.write(TCK + ',' + ','.join(status) + ',%.1f\n' % secs)
+            n_failed += 'failed' in status
+    print ('%d bundles in %.1f s, %d with failures, report in "%s"' % (len(results), time.time() - t0, n_failed, report))
+
+    if n_failed or n_figs_failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Throughput benchmarks of the KUL_FWT python stages on synthetic data
+# Generates bundles of -s streamlines and smooth random metric maps (see KUL_FWT_synth.py), then
+# times .tck io, FBC filtering (grid engine and approximate mode), reorientation (orient_by_rois
+# as in the QQ engine, and the streaming flip of KUL_FWT_reorientTCKs.py -S) and multi-metric profiling.
+# Wall and cpu time and peak RSS come from KUL_FWT_perf.py. Like KUL_FWT_startup_bench.py, the
+# result can be saved as a baseline csv (-w) and a later run compared to it: a benchmark that got
+# slower than the baseline by more than the tolerance is flagged and the exit code is 1.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, tempfile, shutil
+import numpy as np
+import KUL_FWT_perf as kperf
+import KUL_FWT_tckio as ktio
+import KUL_FWT_synth as ksynth
+
+BENCHES = ('io', 'fbc', 'fbc_approx', 'reorient', 'reorient_stream', 'profiles')
+
+# run one benchmark, returns the KUL_FWT_perf record of the timed part
+def run_bench(bench, pts, offs, lens, vols, voi_fs, nproc, tmp_d):
+    if bench == 'io':
+        tck_f = os.path.join(tmp_d, 'bench.tck')
+        with kperf.stage(bench) as rec:
+            ktio.write_tck(tck_f, pts, offs, lens)
+            ktio.read_tck(tck_f)
+        os.remove(tck_f)
+    elif bench == 'fbc':
+        import KUL_FWT_fbc as kfbc
+        # the kernel comes from the on-disk cache, it is not part of the timing
+        k = kfbc.get_kernel()
+        with kperf.stage(bench) as rec:
+            kfbc.streamline_rfbc(ktio.as_arraysequence(pts, offs, lens), k, 'grid', nproc)
+    elif bench == 'fbc_approx':
+        import KUL_FWT_fbc as kfbc
+        k = kfbc.get_kernel()
+        with kperf.stage(bench) as rec:
+            kfbc.streamline_rfbc(ktio.as_arraysequence(pts, offs, lens), k, 'approx', nproc)
+    elif bench == 'reorient':
+        import dipy.tracking.streamline as dts
+        import KUL_FWT_QQengine as kqqe
+        import KUL_FWT_imcache as kimc
+        rs = kqqe.resample(pts.astype(np.float64), offs, lens)
+        v1, v_aff = kimc.load_nifti(voi_fs[0])
+        v2 = kimc.load_nifti_data(voi_fs[1])
+        with kperf.stage(bench) as rec:
+            dts.orient_by_rois(list(rs), v_aff, v1, v2, in_place=False, as_generator=False)
+    elif bench == 'reorient_stream':
+        import KUL_FWT_reorientTCKs as kreor
+        import KUL_FWT_QQengine as kqqe
+        rs = kqqe.resample(pts.astype(np.float64), offs, lens)
+        with kperf.stage(bench) as rec:
+            dmap1 = kreor.roi_distance(voi_fs[0])
+            dmap2 = kreor.roi_distance(voi_fs[1])
+            kreor.flip_mask(rs, dmap1, dmap2)
+    elif bench == 'profiles':
+        from KUL_FWT_profiles import afq_profiles
+        with kperf.stage(bench, metrics=len(vols)) as rec:
+            afq_profiles(vols, ktio.as_arraysequence(pts, offs, lens), ksynth.AFFINE, weights='gaussian')
+    return rec
+
+
+def read_baseline(bfile):
+    base = {}
+    with open(bfile) as f:
+        next(f)
+        for line in f:
+            bench, n_sl, wall, _ = line.strip().split(',')
+            base[(bench, int(n_sl))] = float(wall)
+    return base
+
+
+def main(argv):
+    sizes = [1000, 10000]
+    benches = BENCHES
+    n_metrics = 7
+    nproc = 1
+    bfile = ''
+    save = False
+    # slower than baseline by this fraction plus 50 ms counts as a regression
+    tol = 0.2
+    usage = 'KUL_FWT_bench.py [-s <n_sl1,n_sl2,..>] [-x <bench1,bench2,..>] [-m <n_metrics>] [-n <nproc>] [-b <baseline.csv>] [-w] [-t <tolerance>]'
+    try:
+        opts, args = getopt.getopt(argv,"hs:x:m:n:b:wt:",["sizes=","benches=","metrics=","nproc=","baseline=","write","tol="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            print ('benchmarks are ' + ','.join(BENCHES) + ', sizes go from 1000 up to 1000000 streamlines')
+            sys.exit()
+        elif opt in ("-s", "--sizes"):
+            sizes = [int(float(v)) for v in arg.split(',')]
+        elif opt in ("-x", "--benches"):
+            benches = tuple(arg.split(','))
+        elif opt in ("-m", "--metrics"):
+            n_metrics = int(arg)
+        elif opt in ("-n", "--nproc"):
+            nproc = int(arg)
+        elif opt in ("-b", "--baseline"):
+            bfile = arg
+        elif opt in ("-w", "--write"):
+            save = True
+        elif opt in ("-t", "--tol"):
+            tol = float(arg)
+
+    bad = [b for b in benches if b not in BENCHES]
+    if bad:
+        print ('Unknown benchmarks ' + ','.join(bad) + ', choose from ' + ','.join(BENCHES))
+        sys.exit(2)
+    base = read_baseline(bfile) if bfile and not save and os.path.isfile(bfile) else {}
+
+    # maps and VOIs are the same for all sizes
+    tmp_d = tempfile.mkdtemp(prefix='KUL_FWT_bench_')
+    vols = ksynth.synth_volumes(n_metrics)
+    voi_fs = [os.path.join(tmp_d, 'voi%d.nii.gz' % i) for i in (1, 2)]
+    for voi_f, voi in zip(voi_fs, ksynth.synth_vois()):
+        ksynth.save_nifti(voi_f, voi)
+
+    rows = []
+    n_slow = 0
+    try:
+        # one small untimed run per benchmark, so imports and caches don't count for the first size
+        w_pts, w_offs, w_lens = ksynth.synth_bundle(200, seed=1)
+        for bench in benches:
+            run_bench(bench, w_pts, w_offs, w_lens, vols, voi_fs, nproc, tmp_d)
+
+        for n_sl in sizes:
+            pts, offs, lens = ksynth.synth_bundle(n_sl)
+            print ('%d streamlines, %d points' % (n_sl, len(pts)))
+            for bench in benches:
+                rec = run_bench(bench, pts, offs, lens, vols, voi_fs, nproc, tmp_d)
+                rate = n_sl / rec['wall_s'] if rec['wall_s'] > 0 else float('inf')
+                rows.append((bench, n_sl, rec['wall_s'], rate))
+                flag = ''
+                if (bench, n_sl) in base:
+                    b_wall = base[(bench, n_sl)]
+                    flag = '  (baseline %.3f s)' % b_wall
+                    if rec['wall_s'] > b_wall * (1 + tol) + 0.05:
+                        flag += '  REGRESSION'
+                        n_slow += 1
+                print ('  %-16s wall %8.3f s  cpu %8.3f s  peak %7.0f MB  %10.0f streamlines/s%s'
+                       % (bench, rec['wall_s'], rec['cpu_s'], rec['peak_rss_mb'], rate, flag))
+    finally:
+        shutil.rmtree(tmp_d, ignore_errors=True)
+
+    if save and bfile:
+        with open(bfile, 'w') as f:
+            f.write('bench,streamlines,wall_s,streamlines_per_s\n')
+            for bench, n_sl, wall, rate in rows:
+                f.write('%s,%d,%.4f,%.1f\n' % (bench, n_sl, wall, rate))
+        print ('Baseline written to "', bfile)
+
+    if n_slow:
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
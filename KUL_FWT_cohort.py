@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Cohort aggregation of the KUL_FWT tract profiles
+# KUL_FWT_TCKsQQ.py leaves the scalar profiles of every bundle per subject, as csv files in
+# <bundle>_output/QQ or in the subject's QQ store (see KUL_FWT_store.py). This goes over the
+# subjects one at a time, never holding more than one subject's profiles of a bundle, and makes
+#  - per bundle, metric and node: n, mean, SD and percentiles of the cohort, mean and SD with
+#    Welford's update, percentiles with the P2 estimator (Jain & Chlamtac), both in constant memory
+#    (exact percentiles while a node has less than 5 values)
+#  - per subject: z-score profiles against those norms, in a second pass over the subjects
+# Subjects are given as their _TCKs_output dirs, in a text file (one per line) or as a glob pattern.
+# -z scores another list of subjects (e.g. patients) against the norms of -i.
+# Bundles come from the config file (KUL_FWT_tracks_list.txt format) and are spread over -n workers.
+# Writes <bundle>_fin_<T>_<algo>_norms.csv and <bundle>_fin_<T>_<algo>_zscores.csv to the output dir.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, glob, time
+import multiprocessing as mp
+import numpy as np
+import KUL_FWT_store as kstore
+from KUL_FWT_batch import read_bundles
+
+# metrics of KUL_FWT_TCKsQQ.py, the FOD ones only exist for iFOD1/2 bundles
+METRICS = ('FA', 'ADC', 'AD', 'RD', 'fd', 'disp', 'peaks', 'tdi', 'length', 'curve')
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+# streaming estimate of one quantile per node, P2 algorithm with 5 markers per node
+# nodes without a finite value are left out of an update
+class P2Quantile:
+
+    def __init__(self, p, n_nodes):
+        self.p = p
+        self.count = np.zeros(n_nodes, dtype=np.int64)
+        # marker heights, positions and desired positions
+        self.q = np.full((5, n_nodes), np.nan)
+        self.n = np.tile(np.arange(1., 6.)[:, None], (1, n_nodes))
+        self.nd = np.tile(np.array([1., 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.])[:, None], (1, n_nodes))
+        self.dn = np.array([0., p / 2, p, (1 + p) / 2, 1.])[:, None]
+
+    def update(self, x):
+        ok = np.isfinite(x)
+        act = np.flatnonzero(ok & (self.count >= 5))
+        # the first 5 values of a node are the markers
+        warm = np.flatnonzero(ok & (self.count < 5))
+        if len(warm):
+            self.q[self.count[warm], warm] = x[warm]
+            self.count[warm] += 1
+            done = warm[self.count[warm] == 5]
+            self.q[:, done] = np.sort(self.q[:, done], axis=0)
+        if not len(act):
+            return
+        self.count[act] += 1
+        xi = x[act]
+        q = self.q[:, act]
+        n = self.n[:, act]
+        q[0] = np.minimum(q[0], xi)
+        q[4] = np.maximum(q[4], xi)
+        # cell of x between the markers, the markers above it move up one position
+        k = np.sum(xi[None, :] >= q[1:4], axis=0)
+        n += np.arange(5)[:, None] > k[None, :]
+        nd = self.nd[:, act] + self.dn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for j in (1, 2, 3):
+                d = nd[j] - n[j]
+                move = ((d >= 1) & (n[j + 1] - n[j] > 1)) | ((d <= -1) & (n[j - 1] - n[j] < -1))
+                if not move.any():
+                    continue
+                s = np.where(move, np.sign(d), 0.)
+                # parabolic prediction, linear where it would leave the neighbours
+                qp = q[j] + s / (n[j + 1] - n[j - 1]) * ((n[j] - n[j - 1] + s) * (q[j + 1] - q[j]) / (n[j + 1] - n[j])
+                                                        + (n[j + 1] - n[j] - s) * (q[j] - q[j - 1]) / (n[j] - n[j - 1]))
+                qn = np.where(s > 0, q[j + 1], q[j - 1])
+                nn = np.where(s > 0, n[j + 1], n[j - 1])
+                ql = q[j] + s * (qn - q[j]) / (nn - n[j])
+                new = np.where((q[j - 1] < qp) & (qp < q[j + 1]), qp, ql)
+                q[j] = np.where(move, new, q[j])
+                n[j] = n[j] + s
+        self.q[:, act] = q
+        self.n[:, act] = n
+        self.nd[:, act] = nd
+
+    def result(self):
+        out = self.q[2].copy()
+        for node in np.flatnonzero(self.count < 5):
+            c = self.count[node]
+            out[node] = np.percentile(self.q[:c, node], self.p * 100) if c else np.nan
+        return out
+
+
+# n, mean, SD and percentiles per node, updated one profile at a time
+class NodeStats:
+
+    def __init__(self, n_nodes, percentiles=PERCENTILES):
+        self.count = np.zeros(n_nodes, dtype=np.int64)
+        self.mean = np.zeros(n_nodes)
+        self.m2 = np.zeros(n_nodes)
+        self.quants = [P2Quantile(p / 100., n_nodes) for p in percentiles]
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        ok = np.isfinite(x)
+        self.count += ok
+        delta = np.where(ok, x - self.mean, 0.)
+        self.mean += np.where(ok, delta / np.maximum(self.count, 1), 0.)
+        self.m2 += np.where(ok, delta * (x - self.mean), 0.)
+        for pq in self.quants:
+            pq.update(x)
+
+    def result(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sd = np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+        mean = np.where(self.count > 0, self.mean, np.nan)
+        return self.count, mean, sd, [pq.result() for pq in self.quants]
+
+
+# _TCKs_output dirs from a text file, one per line, or from a glob pattern
+def read_subjects(arg):
+    if os.path.isfile(arg):
+        with open(arg) as f:
+            subjs = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    else:
+        subjs = sorted(glob.glob(arg))
+    return [s.rstrip('/') for s in subjs]
+
+
+def subject_id(subj_d):
+    return os.path.basename(subj_d).replace('_TCKs_output', '')
+
+
+# all profiles of one bundle of one subject, metric -> profile
+# the subject's store is read first, csv files fill in what is not in it
+def subject_profiles(subj_d, TCK, T, algo, metrics):
+    profs = {}
+    store_f = os.path.join(subj_d, subject_id(subj_d) + '_QQ_store.h5')
+    if os.path.isfile(store_f):
+        cols = kstore.read(store_f, 'profiles', bundle=TCK, algo=algo, method=T, metric=list(metrics))
+        for m in metrics:
+            sel = cols['metric'] == m
+            if sel.any():
+                prof = np.full(int(cols['node'][sel].max()) + 1, np.nan)
+                prof[cols['node'][sel]] = cols['value'][sel]
+                profs[m] = prof
+    qq_d = os.path.join(subj_d, TCK + '_output', 'QQ')
+    for m in metrics:
+        prof_f = os.path.join(qq_d, '%s_fin_%s_%s_inMNI_%s_scalar_profile.csv' % (TCK, T, algo, m))
+        if m not in profs and os.path.isfile(prof_f):
+            profs[m] = np.atleast_1d(np.loadtxt(prof_f, delimiter=','))
+    return profs
+
+
+# norms and z-scores of one bundle, two passes over the subjects
+def aggregate_bundle(job):
+    TCK, subjects, z_subjects, T, algo, metrics, percentiles, out_d = job
+    t0 = time.time()
+    fin = '%s_fin_%s_%s' % (TCK, T, algo)
+
+    stats = {}
+    n_subj = 0
+    n_bad = 0
+    for subj_d in subjects:
+        profs = subject_profiles(subj_d, TCK, T, algo, metrics)
+        n_subj += len(profs) > 0
+        for m, prof in profs.items():
+            if m not in stats:
+                stats[m] = NodeStats(len(prof), percentiles)
+            if len(prof) != len(stats[m].count):
+                n_bad += 1
+                continue
+            stats[m].update(prof)
+
+    if not stats:
+        return TCK, 0, 0, 0, time.time() - t0
+
+    norms = {}
+    with open(os.path.join(out_d, fin + '_norms.csv'), 'w') as f:
+        f.write('metric,node,n,mean,sd,' + ','.join('p%g' % p for p in percentiles) + '\n')
+        for m in metrics:
+            if m not in stats:
+                continue
+            count, mean, sd, pcts = stats[m].result()
+            norms[m] = (mean, sd)
+            for node in range(len(count)):
+                f.write('%s,%d,%d,%g,%g,' % (m, node, count[node], mean[node], sd[node])
+                        + ','.join('%g' % pc[node] for pc in pcts) + '\n')
+
+    # z-scores are written as they are computed, one row per subject and metric
+    n_z = 0
+    n_nodes = max(len(v[0]) for v in norms.values())
+    with open(os.path.join(out_d, fin + '_zscores.csv'), 'w') as f:
+        f.write('subject,metric,' + ','.join('%d' % i for i in range(n_nodes)) + '\n')
+        for subj_d in z_subjects:
+            profs = subject_profiles(subj_d, TCK, T, algo, metrics)
+            n_z += len(profs) > 0
+            for m in metrics:
+                if m not in profs or m not in norms or len(profs[m]) != len(norms[m][0]):
+                    continue
+                mean, sd = norms[m]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    z = np.where(sd > 0, (profs[m] - mean) / sd, np.nan)
+                f.write('%s,%s,' % (subject_id(subj_d), m) + ','.join('%g' % v for v in z) + '\n')
+
+    if n_bad:
+        print ('%s: %d profiles with another number of nodes were left out' % (TCK, n_bad))
+    return TCK, n_subj, n_z, len(stats), time.time() - t0
+
+
+def main(argv):
+    subj_arg = ''
+    z_arg = ''
+    conf_f = ''
+    out_d = ''
+    T_app = 2
+    algo_f = 'iFOD2'
+    nproc = 1
+    metrics = METRICS
+    percentiles = PERCENTILES
+    usage = 'KUL_FWT_cohort.py -i <subjects.txt or glob> -c <conf_f> -o <out_d> [-z <subjects.txt or glob>] [-T <1|2>] [-a <algo>] [-m <metric1,..>] [-q <pct1,..>] [-n <nproc>]'
+    try:
+        opts, args = getopt.getopt(argv,"hi:z:c:o:T:a:m:q:n:",["subjects=","zsubjects=","conf_f=","out_d=","T_app=","algo=","metrics=","percentiles=","nproc="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            print ('subjects are their _TCKs_output dirs, -z defaults to the subjects of -i')
+            sys.exit()
+        elif opt in ("-i", "--subjects"):
+            subj_arg = arg
+        elif opt in ("-z", "--zsubjects"):
+            z_arg = arg
+        elif opt in ("-c", "--conf_f"):
+            conf_f = arg
+        elif opt in ("-o", "--out_d"):
+            out_d = arg
+        elif opt in ("-T", "--T_app"):
+            T_app = int(arg)
+        elif opt in ("-a", "--algo"):
+            algo_f = arg
+        elif opt in ("-m", "--metrics"):
+            metrics = tuple(arg.split(','))
+        elif opt in ("-q", "--percentiles"):
+            percentiles = tuple(float(v) for v in arg.split(','))
+        elif opt in ("-n", "--nproc"):
+            nproc = int(arg)
+    print ('Subjects are "', subj_arg)
+    print ('Config file is "', conf_f)
+    print ('Output dir is "', out_d)
+
+    if not os.path.isfile(conf_f):
+        print ('Config file not found, exitting')
+        sys.exit(2)
+    subjects = read_subjects(subj_arg)
+    z_subjects = read_subjects(z_arg) if z_arg else subjects
+    if not subjects:
+        print ('No subjects found, exitting')
+        sys.exit(2)
+    os.makedirs(out_d, exist_ok=True)
+
+    # same naming as make_TCKs.sh, 1 is BT and 2 is WB
+    T = 'BT' if T_app == 1 else 'WB'
+    bundles = read_bundles(conf_f)
+    jobs = [(TCK, subjects, z_subjects, T, algo_f, metrics, percentiles, out_d) for TCK in bundles]
+
+    t0 = time.time()
+    if nproc > 1:
+        with mp.Pool(min(nproc, len(jobs))) as pool:
+            results = list(pool.imap_unordered(aggregate_bundle, jobs))
+    else:
+        results = [aggregate_bundle(job) for job in jobs]
+    order = {TCK: i for i, TCK in enumerate(bundles)}
+    results.sort(key=lambda r: order[r[0]])
+
+    for TCK, n_subj, n_z, n_met, secs in results:
+        if n_subj:
+            print ('%s: norms of %d metrics from %d subjects, z-scores of %d subjects (%.1f s)' % (TCK, n_met, n_subj, n_z, secs))
+        else:
+            print ('%s: no profiles found' % TCK)
+    print ('%d bundles of %d subjects in %.1f s' % (len(results), len(subjects), time.time() - t0))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
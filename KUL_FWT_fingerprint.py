@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Connectivity fingerprints of bundles against a label image, used by KUL_FWT_TCKsQQ.py
+# utils.connectivity_matrix builds a per label pair mapping of streamlines that is never used,
+# and the full label by label matrix went to a text csv. Here the labels of all end points are
+# looked up at once and counted into a sparse matrix, saved as a scipy .npz (csv is optional).
+# The counts are the same as connectivity_matrix(..., symmetric=True) with default settings.
+# As a script, fingerprints of many bundles are made against one label image loaded once.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt
+import numpy as np
+import KUL_FWT_imcache as kimc
+import KUL_FWT_tckio as ktio
+
+
+# label volume as used for the fingerprints, MSBP scale1 fits in uint8
+def load_labels(label_file):
+    labels, affine = kimc.load_nifti(label_file)
+    return np.asarray(labels).astype(np.uint8), affine
+
+
+# labels at both end points of every streamline, shape (2, n_streamlines)
+def endpoint_labels(streamlines, labels, affine):
+    if hasattr(streamlines, 'get_data'):
+        # ArraySequence, the end points can be picked from its flat data directly
+        pts, first, lens = ktio.flatten(streamlines, np.float64)
+        ends = np.stack([pts[first], pts[first + lens - 1]], 1).reshape(-1, 3)
+    else:
+        ends = np.array([[sl[0], sl[-1]] for sl in streamlines], dtype=np.float64).reshape(-1, 3)
+    # same voxel rounding as dipy, truncation after a half voxel shift
+    inv = np.linalg.inv(affine)
+    inds = ends @ inv[:3, :3].T + inv[:3, 3] + 0.5
+    if inds.min().round(decimals=6) < 0:
+        raise IndexError("streamline has points that map to negative voxel indices")
+    inds = inds.astype(np.intp)
+    return labels[inds[:, 0], inds[:, 1], inds[:, 2]].reshape(-1, 2).T
+
+
+# symmetric sparse (n_labels, n_labels) count matrix of a bundle
+def fingerprint(streamlines, labels, affine, n_labels=None):
+    from scipy import sparse
+    if n_labels is None:
+        n_labels = int(labels.max()) + 1
+    if len(streamlines) == 0:
+        return sparse.csr_matrix((n_labels, n_labels), dtype=np.int64)
+    end = np.sort(endpoint_labels(streamlines, labels, affine), axis=0)
+    # duplicate pairs are summed when going to csr
+    M = sparse.coo_matrix((np.ones(end.shape[1], dtype=np.int64), (end[0], end[1])), shape=(n_labels, n_labels)).tocsr()
+    return M.maximum(M.T)
+
+
+# zero the first row and column (label 0, outside the parcellation)
+def drop_background(M):
+    from scipy import sparse
+    keep = sparse.diags((np.arange(M.shape[0]) > 0).astype(M.dtype), dtype=M.dtype)
+    M = (keep @ M @ keep).tocsr()
+    M.eliminate_zeros()
+    return M
+
+
+# the .npz always, the dense csv only when asked for
+def save_fingerprint(M, npz_file, csv_file=None):
+    from scipy import sparse
+    sparse.save_npz(npz_file, M)
+    if csv_file:
+        np.savetxt(csv_file, M.toarray(), delimiter=',')
+
+
+# fingerprints of several .tck files against one label image
+# returns {tck_file: sparse matrix}
+def bundle_fingerprints(tck_files, label_file):
+    import nibabel as nib
+    labels, affine = load_labels(label_file)
+    n_labels = int(labels.max()) + 1
+    fps = {}
+    for tck in tck_files:
+        streamlines = nib.streamlines.load(tck).streamlines
+        fps[tck] = fingerprint(streamlines, labels, affine, n_labels)
+    return fps
+
+
+def main(argv):
+    tck_files = []
+    label_file = ''
+    csv = False
+    usage = 'KUL_FWT_fingerprint.py -l <label_image> -i <tck1,tck2,..> [-c]'
+    try:
+        opts, args = getopt.getopt(argv,"hl:i:c",["labels=","ifiles=","csv"])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-l", "--labels"):
+            label_file = arg
+        elif opt in ("-i", "--ifiles"):
+            tck_files = arg.split(',')
+        elif opt in ("-c", "--csv"):
+            csv = True
+    print ('Label image is "', label_file)
+    print ('Input TCK files are "', ','.join(tck_files))
+
+    if os.path.isfile(label_file):
+        tck_files = [tck for tck in tck_files if os.path.isfile(tck)]
+        for tck, M in bundle_fingerprints(tck_files, label_file).items():
+            stem = os.path.splitext(tck)[0]
+            save_fingerprint(M, stem + '_conn_fingerprint.npz', stem + '_conn_grouping.csv' if csv else None)
+            print ('%s: %d connected label pairs' % (os.path.basename(tck), (M.nnz + np.count_nonzero(M.diagonal())) // 2))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Subject level cache of decompressed images for the KUL_FWT python tools
+# Every load of a .nii.gz gunzips the whole volume again, for every bundle and every script.
+# Here each image is decompressed once into a raw .npy (plus its affine) in a hidden
+# .KUL_FWT_cache dir next to it, and later loads memory-map that file. All processes then share
+# one page-cached copy. An entry is rebuilt when the size or mtime of its source changes.
+# Usage as a script warms the cache for all images in a dir, e.g. the subject's prep dir.
+
+import os, sys, getopt, glob, json, hashlib
+import numpy as np
+
+# bump this whenever the layout of a cache entry changes
+IMCACHE_VERSION = 1
+
+# images already opened by this process, for long-lived ones like KUL_FWT_batch.py
+# keyed on the source path, size and mtime so a rewritten image is picked up again
+_loaded = {}
+
+
+def cache_dir(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), '.KUL_FWT_cache')
+
+
+def _entry(path, cdir):
+    name = os.path.basename(path)
+    for ext in ('.nii.gz', '.nii', '.mgz'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]
+    return os.path.join(cdir, name + '_' + key)
+
+
+def _source_info(path):
+    st = os.stat(path)
+    return {'version': IMCACHE_VERSION, 'src': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+# write to a temp file first, so that readers never see half a file
+def _write_atomic(fname, write):
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, fname)
+
+
+# data (read-only memmap, scaling applied) and affine of an image
+# drop-in for dipy's load_nifti(path), except the data keeps its stored dtype
+def load_nifti(path, cdir=None):
+    if cdir is None:
+        cdir = cache_dir(path)
+    entry = _entry(path, cdir)
+    info = _source_info(path)
+    key = (info['src'], info['size'], info['mtime_ns'])
+    if key in _loaded:
+        return _loaded[key]
+
+    try:
+        with open(entry + '.json') as f:
+            meta = json.load(f)
+        if all(meta.get(k) == v for k, v in info.items()) and os.path.isfile(entry + '.npy'):
+            _loaded[key] = np.load(entry + '.npy', mmap_mode='r'), np.array(meta['affine'])
+            return _loaded[key]
+    except (OSError, ValueError):
+        pass
+
+    # cache hits only need numpy, nibabel is imported on a miss
+    import nibabel as nib
+    img = nib.load(path)
+    data = np.asanyarray(img.dataobj)
+    try:
+        os.makedirs(cdir, exist_ok=True)
+        _write_atomic(entry + '.npy', lambda f: np.save(f, data))
+        info['affine'] = img.affine.tolist()
+        _write_atomic(entry + '.json', lambda f: f.write(json.dumps(info).encode()))
+    except OSError:
+        # read-only location, work from memory
+        _loaded[key] = data, img.affine
+        return _loaded[key]
+    _loaded[key] = np.load(entry + '.npy', mmap_mode='r'), img.affine
+    return _loaded[key]
+
+
+def load_nifti_data(path, cdir=None):
+    return load_nifti(path, cdir)[0]
+
+
+# nibabel image backed by the cached data, for nilearn and friends
+def load_img(path, cdir=None):
+    import nibabel as nib
+    data, affine = load_nifti(path, cdir)
+    return nib.Nifti1Image(data, affine)
+
+
+def main(argv):
+    idir = ''
+    try:
+        opts, args = getopt.getopt(argv,"hd:",["idir="])
+    except getopt.GetoptError:
+        print ('KUL_FWT_imcache.py -d <image_dir>')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('KUL_FWT_imcache.py -d <image_dir>')
+            sys.exit()
+        elif opt in ("-d", "--idir"):
+            idir = arg
+    print ('Image dir is "', idir)
+
+    if os.path.isdir(idir):
+        for im in sorted(glob.glob(os.path.join(idir, '*.nii.gz')) + glob.glob(os.path.join(idir, '*.nii'))):
+            print ('Caching "', im)
+            load_nifti(im)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
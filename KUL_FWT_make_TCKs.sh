@@ -7,6 +7,10 @@ set -x
 
 cwd="$(pwd)"
 
+# keep the command line, KUL_FWT_scheduler.py reruns this script with it per bundle
+script_f="$(realpath "$0")"
+script_args=("$@")
+
 # conda init bash
 # conda deactivate
 # pip install 'numpy==1.18'
@@ -49,6 +53,7 @@ cat <<USAGE
     -Q:  If set quantitative and qualitative analyses will be done
     -S:  If set screenshots will taken of each bundle
     -n:  Number of cpu for parallelisation (default is 6)
+    -j:  Number of threads for the mrtrix calls of each bundle, bundles run in parallel within the -n budget (default is 4, or -n if lower)
     -h:  Prints help menu
 
 USAGE
@@ -84,7 +89,7 @@ if [ "$#" -lt 1 ]; then
 
 else
 
-    while getopts "p:s:T:M:F:c:d:o:a:n:f:hQS" OPT; do
+    while getopts "p:s:T:M:F:c:d:o:a:n:j:f:hQS" OPT; do
 
         case $OPT in
         p) #participant
@@ -137,6 +142,9 @@ else
             n_flag=1
             ncpu=$OPTARG
         ;;
+        j) #threads per bundle
+            bncpu=$OPTARG
+        ;;
         h) #help
             Usage >&2
             exit 0
@@ -172,25 +180,36 @@ fi
 
 # timestamp
 start=$(date +%s)
-d=$(date "+%Y-%m-%d_%H-%M-%S")
+# bundle steps started by the scheduler use the timestamp of the main run
+d=${KUL_FWT_RUN:-$(date "+%Y-%m-%d_%H-%M-%S")}
 
 # check for required inputs
 
 # config file
 srch_conf_str=($(basename ${conf_f})) ; conf_dir=($(dirname ${conf_f}))
-srch_conf_c=($(find ${conf_dir} -type f | grep  ${srch_conf_str}))
 
 # diffusion data dir
 srch_ddir_str=($(basename ${d_dir})) ; diff_dir=($(dirname ${d_dir}))
-srch_ddir_c=($(find ${diff_dir} -type d | grep  ${srch_ddir_str}))
 
 # FS dirs
 srch_FS_str=($(basename ${FS_apas_in})) ; FS_dir=($(dirname ${FS_apas_in}))
-srch_FS_c=($(find ${FS_dir} -type f | grep  ${srch_FS_str}))
 
 # MSBP dirs
 srch_MS_str=($(basename ${MS_sc3_in})) ; MS_dir=($(dirname ${MS_sc3_in}))
-srch_MS_c=($(find ${MS_dir} -type f | grep  ${srch_MS_str}))
+
+if [[ -z ${KUL_FWT_BUNDLE} ]]; then
+
+    srch_conf_c=($(find ${conf_dir} -type f | grep  ${srch_conf_str}))
+    srch_ddir_c=($(find ${diff_dir} -type d | grep  ${srch_ddir_str}))
+    srch_FS_c=($(find ${FS_dir} -type f | grep  ${srch_FS_str}))
+    srch_MS_c=($(find ${MS_dir} -type f | grep  ${srch_MS_str}))
+
+else
+
+    # bundle steps started by the scheduler don't search the input dirs again, the main run checked them
+    srch_conf_c=${conf_f} ; srch_ddir_c=${d_dir} ; srch_FS_c=${FS_apas_in} ; srch_MS_c=${MS_sc3_in}
+
+fi
 
 if [[ ${p_flag} -eq 0 ]] || [[ ${F_flag} -eq 0 ]] || [[ ${T_flag} -eq 0 ]] || [[ ${M_flag} -eq 0 ]] || [[ ${c_flag} -eq 0 ]] || [[ ${d_flag} -eq 0 ]]; then
 	
@@ -316,6 +335,13 @@ fi
 FSLPARALLEL=$ncpu; export FSLPARALLEL
 OMP_NUM_THREADS=$ncpu; export OMP_NUM_THREADS
 
+# threads per bundle, the rest of the -n budget goes to other bundles and the python steps
+if [[ -z ${bncpu} ]] || [[ ${bncpu} -gt ${ncpu} ]]; then
+
+    bncpu=$(( ncpu < 4 ? ncpu : 4 ))
+
+fi
+
 # Priors dir and check
 ## change the temps dir name later
 pr_d="${function_path}/KUL_FWT_templates"
@@ -359,15 +385,24 @@ mkdir -p ${TCKs_prepd} >/dev/null 2>&1
 
 # make your log file
 
-prep_log2="${output_d}/KUL_FWT_TCKs_log_${subj}_${d}.txt";
+if [[ -z ${KUL_FWT_BUNDLE} ]]; then
+
+    prep_log2="${output_d}/KUL_FWT_TCKs_log_${subj}_${d}.txt";
 
-if [[ ! -f ${prep_log2} ]] ; then
+    if [[ ! -f ${prep_log2} ]] ; then
 
-    touch ${prep_log2}
+        touch ${prep_log2}
+
+    else
+
+        echo "${prep_log2} already created"
+
+    fi
 
 else
 
-    echo "${prep_log2} already created"
+    # bundle steps started by the scheduler, their output goes to the per task logs of the scheduler
+    prep_log2="/dev/null"
 
 fi
 
@@ -456,7 +491,12 @@ fi
 
 # set mrtrix tmp dir to prep_d
 
-rm -rf ${TCKs_prepd}/tmp_dir_*
+# bundle steps started by the scheduler share the tmp dir of the main run
+if [[ -z ${KUL_FWT_BUNDLE} ]]; then
+
+    rm -rf ${TCKs_prepd}/tmp_dir_*
+
+fi
 
 tmpo_d="${TCKs_prepd}/tmp_dir_${d}"
 
@@ -464,6 +504,28 @@ mkdir -p "${tmpo_d}" >/dev/null 2>&1
 
 export MRTRIX_TMPFILE_DIR="${tmpo_d}"
 
+# a failing task in the background leaves this flag for the main shell
+task_fail_f="${tmpo_d}/task_failed_$$"
+
+# intermediate tcks of the filtering go to node local scratch, KUL_FWT_DEBUG=1 keeps them with the bundle
+scratch_d="${KUL_FWT_SCRATCH:-${TMPDIR:-/tmp}}/KUL_FWT_sub-${subj}${ses_str}_$$"
+
+# it is per process, so whatever a failed or killed run leaves in it goes when the script exits
+trap 'rm -rf "${scratch_d}"' EXIT
+
+# the scheduler task list and per task logs
+sched_d="${TCKs_prepd}/scheduler_${d}"
+
+task_f="${sched_d}/sub-${subj}${ses_str}_bundle_tasks.txt"
+
+if [[ -z ${KUL_FWT_BUNDLE} ]]; then
+
+    mkdir -p "${sched_d}" >/dev/null 2>&1
+
+    rm -f ${task_f}
+
+fi
+
 # report pid
 
 processId=$(ps -ef | grep 'ABCD' | grep -v 'grep' | awk '{ printf $2 }')
@@ -520,7 +582,7 @@ done
 echo "You have asked to segment the following bundles from whole brain TCK ${tck_list[@]}" | tee -a ${prep_log2}
 
 # Exec_all function
-# need to recreate this function to include proc. control
+# runs task_in, logs its real exit status and stops the workflow if it failed
 
 function task_exec {
 
@@ -530,37 +592,43 @@ function task_exec {
 
     echo " Started @ $(date "+%Y-%m-%d_%H-%M-%S")" | tee -a ${prep_log2}
 
-    eval ${task_in} 2>&1 | tee -a ${prep_log2} &
+    # pipefail, so we get the exit status of the task and not that of tee
+    ( set -o pipefail; eval ${task_in} 2>&1 | tee -a ${prep_log2} ) &
 
-    # echo " pid = $! basicPID = $BASHPID " | tee -a ${prep_log2}
+    pid=$!
 
-    echo " pid = $! " | tee -a ${prep_log2}
+    echo " pid = ${pid} " | tee -a ${prep_log2}
 
     wait ${pid}
 
-    sleep 5
+    task_status=$?
 
-    echo "exit status $?" | tee -a ${prep_log2}
+    # tasks started in the background before this one have to finish too
+    wait
 
-    # if [ $? -eq 0 ]; then
+    echo "exit status ${task_status}" | tee -a ${prep_log2}
 
-    #     echo Success >> ${prep_log2}
+    echo " Finished @ $(date "+%Y-%m-%d_%H-%M-%S")" | tee -a ${prep_log2}
 
-    # else
+    echo "-------------------------------------------------------------" | tee -a ${prep_log2}
 
-    #     echo Fail >> ${prep_log2}
+    echo "" | tee -a ${prep_log2}
 
-    #     exit 1
+    unset task_in
 
-    # fi
+    if [[ ${task_status} -ne 0 ]]; then
 
-    echo " Finished @ $(date "+%Y-%m-%d_%H-%M-%S")" | tee -a ${prep_log2}
+        touch ${task_fail_f}
 
-    echo "-------------------------------------------------------------" | tee -a ${prep_log2}
+    fi
 
-    echo "" | tee -a ${prep_log2}
+    if [[ -f ${task_fail_f} ]]; then
 
-    unset task_in
+        echo " A task failed, exitting " | tee -a ${prep_log2}
+
+        exit 1
+
+    fi
 
 }
 
@@ -811,13 +879,17 @@ function make_bundle {
 
     # processing control for initial tracking/segmentation
 
-    if [[ ! -f "${tck_init}" ]]; then
+    if [[ ${run_make} -eq 0 ]]; then
+
+        echo " ${TCK_2_make} segmentation and filtering are done in its make step " | tee -a ${prep_log2}
+
+    elif [[ ! -f "${tck_init}" ]]; then
 
         task_in="${cmd_str}"
 
         task_exec
 
-        task_in="tcktransform -force ${tck_init} ${TCKs_w2temp} ${tck_init_inT}"
+        task_in="KUL_FWT_warpTCKs.py -i ${tck_init} -w ${TCKs_w2temp} -o ${tck_init_inT}"
 
         task_exec
 
@@ -829,7 +901,7 @@ function make_bundle {
 
         if [[ ! -f ${tck_init_inT} ]]; then
           
-            task_in="tcktransform -force ${tck_init} ${TCKs_w2temp} ${tck_init_inT}"
+            task_in="KUL_FWT_warpTCKs.py -i ${tck_init} -w ${TCKs_w2temp} -o ${tck_init_inT}"
 
             task_exec
         fi
@@ -857,7 +929,7 @@ function make_bundle {
 
     # need to create combined incs_bin maps for QQ
     # loop from 2nd element in incs_bin array
-    if [[ ! -f "${TCK_out}/${TCK_2_make}_incs_map_agg_inMNI.nii.gz" ]]; then
+    if [[ ${run_make} -eq 1 ]] && [[ ! -f "${TCK_out}/${TCK_2_make}_incs_map_agg_inMNI.nii.gz" ]]; then
 
         ((funn=${#TCK_I_b[@]}-1));
         mrcal_strs=$(printf " %s "  "${TCK_I_b[0]}")
@@ -901,6 +973,17 @@ function make_bundle {
 
     tck_filt5="${TCK_out}/${TCK_2_make}_fin_${T}_${algo_f}.tck"
 
+    # only read by the next filtering step
+    if [[ ${KUL_FWT_DEBUG:-0} == 0 ]]; then
+
+        mkdir -p "${scratch_d}" >/dev/null 2>&1
+
+        tck_filt2="${scratch_d}/${TCK_2_make}_filt2_${T}_${algo_f}.tck"
+
+        tck_filt3="${scratch_d}/${TCK_2_make}_filt3_${T}_${algo_f}.tck"
+
+    fi
+
     tck_filt5_centroid1="${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_inMNI_centroid1.tck"
 
     tck_filt1_inT="${TCK_out}/${TCK_2_make}_filt1_${T}_${algo_f}_inMNI.tck"
@@ -939,7 +1022,7 @@ function make_bundle {
     tck_reor="${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_inMNI_rTCK.tck"
     tckc_reor="${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_inMNI_centroid_rTCK.tck"
 
-    if [[ ${count} -gt 10 ]] && [[ ! ${filt_fl2} == 0 ]]; then
+    if [[ ${run_make} -eq 1 ]] && [[ ${count} -gt 10 ]] && [[ ! ${filt_fl2} == 0 ]]; then
 
         if [[ ! -f "${TCK_out}/${TCK_2_make}_fin_map_${T}_${algo_f}_inMNI.nii.gz" ]]; then
 
@@ -953,8 +1036,6 @@ function make_bundle {
 
                     task_exec
 
-                    sleep 2
-
                     count2=($(tckstats -force -nthreads ${ncpu} -output count ${tck_filt1} -quiet ));
 
                 else
@@ -983,9 +1064,14 @@ function make_bundle {
 
                     task_exec
 
-                    task_in="tcktransform -force ${tck_filt3} ${TCKs_w2temp} ${tck_filt3_inT}"
+                    # nothing reads this one, only for debugging
+                    if [[ ! ${KUL_FWT_DEBUG:-0} == 0 ]]; then
 
-                    task_exec
+                        task_in="KUL_FWT_warpTCKs.py -i ${tck_filt3} -w ${TCKs_w2temp} -o ${tck_filt3_inT}"
+
+                        task_exec
+
+                    fi
 
                 else
 
@@ -999,13 +1085,12 @@ function make_bundle {
 
                 if [[ ! -f ${tck_filt1} ]]; then
 
-                    task_in="KUL_FWT_FBC_4TCKs.py -i ${tck_init} -r ${subj_FA} -o ${tck_filt1}"
+                    task_in="KUL_FWT_FBC_4TCKs.py -i ${tck_init} -r ${subj_FA} -o ${tck_filt1} -n ${ncpu}"
 
                     task_exec
 
-                    sleep 2
-
-                    count2=($(tckstats -force -nthreads ${ncpu} -output count ${tck_filt1} -quiet ));
+                    # the FBC script reports the surviving streamlines, no need for tckstats
+                    count2=($(awk -F, '$3 == 1 {print $2}' ${tck_filt1%.tck}_rfbc_sweep.csv));
 
                 else
 
@@ -1025,16 +1110,14 @@ function make_bundle {
 
                     task_exec
 
-                    task_in="tcktransform -force ${tck_filt1} ${TCKs_w2temp} ${tck_filt1_inT}"
-
-                    task_exec
+                    # nothing reads this one, only for debugging
+                    if [[ ! ${KUL_FWT_DEBUG:-0} == 0 ]]; then
 
-                    sleep 5
+                        task_in="KUL_FWT_warpTCKs.py -i ${tck_filt1} -w ${TCKs_w2temp} -o ${tck_filt1_inT}"
 
-                    task_in="tckmap -precise -force -nthreads ${ncpu} -template ${UKBB_temp} ${tck_filt5_inT} \
-                    ${TCK_out}/${TCK_2_make}_fin_map_${T}_${algo_f}_inMNI.nii.gz"
+                        task_exec
 
-                    task_exec
+                    fi
 
                 else
 
@@ -1052,12 +1135,10 @@ function make_bundle {
 
                 task_exec &
 
-                task_in="tcktransform -nthreads ${ncpu} -force ${tck_filt5} ${TCKs_w2temp} ${tck_filt5_inT}"
+                task_in="KUL_FWT_warpTCKs.py -i ${tck_filt5} -w ${TCKs_w2temp} -o ${tck_filt5_inT}"
 
                 task_exec
 
-                sleep 5
-
                 task_in="tckmap -precise -force -nthreads ${ncpu} \
                 -template ${UKBB_temp} ${tck_filt5_inT} \
                 ${TCK_out}/${TCK_2_make}_fin_map_${T}_${algo_f}_inMNI.nii.gz"
@@ -1110,32 +1191,14 @@ function make_bundle {
 
             mkdir -p "${TCK_out}/QQ/tmp"
 
-            task_in="tckresample -force -nthreads ${ncpu} -num_points 101 ${tck_filt5_inT} ${tck_rs1_inT}"
-
-            task_exec
-
-            task_in="scil_compute_centroid.py -f --reference ${UKBB_temp} --nb_points 101 ${tck_filt5_inT} ${tck_filt5_centroid1}"
-
-            task_exec
-
-            task_in="tckmap -force -nthreads ${ncpu} -template ${UKBB_temp} ${tck_filt5_centroid1} - | mrcalc - 0 -gt - | maskfilter - dilate - -npass 2 | mrcalc - ${TCK_out}/${TCK_2_make}_incs_map_agg_inMNI.nii.gz -mult ${tck_cent1_HT_map} -force -nthreads ${ncpu}"
-
-            task_exec
-
-            task_in="tckmap -precise -force -stat_vox max -contrast length -template ${UKBB_temp} ${tck_filt5_inT} ${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_length_inMNI.nii.gz \
-            && tckmap -precise -force -stat_vox max -contrast curvature -template ${UKBB_temp} ${tck_filt5_inT} ${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_curve_inMNI.nii.gz \
-            && tckmap -precise -force -stat_vox sum -contrast tdi -template ${UKBB_temp} ${tck_filt5_inT} ${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_tdi_inMNI.nii.gz"
-
-            task_exec
-
             # new heads and tails work, forget about the center
+            # pick the start and end VOIs for reorienting
+            voi_args=""
 
             if [[ "${#TCK_Is_MNI[@]}" -eq 2 ]]; then
 
                 # we want the first inc as the start and the second as the end
-                task_in="KUL_FWT_reorientTCKs.py -i ${tck_rs1_inT} -c ${tck_filt5_centroid1} -m ${prep_d} -s ${TCK_Is_MNI[0]} -e ${TCK_Is_MNI[1]}"
-
-                task_exec
+                voi_args="-s ${TCK_Is_MNI[0]} -e ${TCK_Is_MNI[1]}"
 
             elif [[ "${#TCK_Is_MNI[@]}" -eq 3 ]]; then
 
@@ -1143,16 +1206,12 @@ function make_bundle {
 
                     # we want the second inc as the start and the last as the end
 
-                    task_in="KUL_FWT_reorientTCKs.py -i ${tck_rs1_inT} -c ${tck_filt5_centroid1} -m ${prep_d} -s ${TCK_Is_MNI[1]} -e ${TCK_Is_MNI[-1]}"
-
-                    task_exec
+                    voi_args="-s ${TCK_Is_MNI[1]} -e ${TCK_Is_MNI[-1]}"
 
                 else
 
                     # we want the first inc as the start and the last as the end
-                    task_in="KUL_FWT_reorientTCKs.py -i ${tck_rs1_inT} -c ${tck_filt5_centroid1} -m ${prep_d} -s ${TCK_Is_MNI[0]} -e ${TCK_Is_MNI[-1]}"
-
-                    task_exec
+                    voi_args="-s ${TCK_Is_MNI[0]} -e ${TCK_Is_MNI[-1]}"
 
                 fi
 
@@ -1164,31 +1223,33 @@ function make_bundle {
                 # task_exec
 
                 # # we want the first inc as the start and the last as the end
-                task_in="KUL_FWT_reorientTCKs.py -i ${tck_rs1_inT} -c ${tck_filt5_centroid1} -m ${prep_d} -s ${TCK_Is_MNI[0]} -e ${TCK_Is_MNI[-1]}"
-
-                task_exec
+                voi_args="-s ${TCK_Is_MNI[0]} -e ${TCK_Is_MNI[-1]}"
 
 
             fi
 
-            # grab em by the scruff of their necks
-            # make new map of reoriented bundle, this should now be consistent
-            task_in="scil_compute_bundle_voxel_label_map.py -f --reference ${UKBB_temp} --out_labels_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_labels_inMNI.npz --out_distances_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_distances_inMNI.npz ${tck_reor} ${tckc_reor} ${MNI_segs}"
+            # one python pass does the resampling, centroid, tdi/length/curvature maps, reorientation,
+            # length histogram, per metric sampling, profiles and fingerprint, see KUL_FWT_QQengine.py
+            # this replaces tckresample, scil_compute_centroid.py, the tckmap passes, KUL_FWT_reorientTCKs.py,
+            # tckstats, the tcksample loop and KUL_FWT_TCKsQQ.py
+            task_in="KUL_FWT_QQengine.py -i ${tck_filt5_inT} -t ${UKBB_temp} -m ${prep_d} ${voi_args}"
 
             task_exec
 
-            # task_in="scil_compute_bundle_voxel_label_map.py -f --reference ${UKBB_temp} --out_labels_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_labels_inMNI_d.npz --out_distances_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_distances_inMNI_d.npz ${tck_filt5_inT} ${tck_filt5_centroid1} ${MNI_segsd}"
+            task_in="tckmap -force -nthreads ${ncpu} -template ${UKBB_temp} ${tck_filt5_centroid1} - | mrcalc - 0 -gt - | maskfilter - dilate - -npass 2 | mrcalc - ${TCK_out}/${TCK_2_make}_incs_map_agg_inMNI.nii.gz -mult ${tck_cent1_HT_map} -force -nthreads ${ncpu}"
 
             task_exec
 
-            task_in="antsApplyTransforms -d 3 -i ${CFP_aparc_inFA} \
-            -o ${CFP_aparc_inMNI} -r ${UKBB_temp} \
-            -t ${prep_d}/FS_2_UKBB_${subj}${ses_str}_1Warp.nii.gz -t [${prep_d}/FS_2_UKBB_${subj}${ses_str}_0GenericAffine.mat,0] \
-            -t ${prep_d}/fa_2_UKBB_vFS_${subj}${ses_str}_1Warp.nii.gz -t [${prep_d}/fa_2_UKBB_vFS_${subj}${ses_str}_0GenericAffine.mat,0] -n MultiLabel"
+            # grab em by the scruff of their necks
+            # make new map of reoriented bundle, this should now be consistent
+            task_in="scil_compute_bundle_voxel_label_map.py -f --reference ${UKBB_temp} --out_labels_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_labels_inMNI.npz --out_distances_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_distances_inMNI.npz ${tck_reor} ${tckc_reor} ${MNI_segs}"
 
             task_exec
 
-            
+            # task_in="scil_compute_bundle_voxel_label_map.py -f --reference ${UKBB_temp} --out_labels_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_labels_inMNI_d.npz --out_distances_npz ${TCK_out}/QQ/tmp/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_distances_inMNI_d.npz ${tck_filt5_inT} ${tck_filt5_centroid1} ${MNI_segsd}"
+
+            # task_exec
+
             task_in="KUL_FWT_TCKsm_cap.py -i ${MNI_segs}"
 
             task_exec &
@@ -1198,45 +1259,6 @@ function make_bundle {
 
             # task_exec &
 
-            # for met in metrics
-            # this list is conditional, if DTI only FA and MD 
-            # if CSD add FD, disp and peaks
-
-            task_in="tckstats -force -nthreads ${ncpu} ${tck_reor} -histogram ${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_lengths_histogram.csv | tee -a ${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_rs1c_lengths_report.csv"
-
-            task_exec
-
-            metrics=("FA" "ADC" "AD" "RD" "TDI" "Length" "Curve")
-            mets_fs=("${subj_FA_MNI}" "${subj_ADC_MNI}" "${subj_AD_MNI}" "${subj_RD_MNI}" "${TCKs_tdi}" "${TCKs_length}" "${TCKs_curve}")
-
-            if [[ ${algo_f} == "iFOD2" ]] || [[ ${algo_f} == "iFOD1" ]] || [[ ${algo_f} == "SD_Stream" ]]; then
-
-                metrics+=("FD" "Disp" "Peaks")
-                mets_fs+=("${subj_vfd_MNI}" "${subj_vdisp_MNI}" "${subj_vpk_MNI}")
-
-            fi
-
-            for mets in ${!metrics[@]}; do
-
-                met_name=${metrics[$mets]}
-
-                task_in="tcksample -nointerp -force -nthreads ${ncpu} ${tck_reor} ${mets_fs[$mets]} ${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_${met_name}.csv"
-
-                task_exec
-
-            done
-
-            sleep 10
-
-            # new KUL_QQ_TCKs.py should be in the for loop above
-            # this will take as input the resampled bundle, the centroid?, the metric of choice and the prep_d
-            # no need to make the QQ dir in there anymore
-            # csvs need to be read in then plotted line by line
-
-            task_in="KUL_FWT_TCKsQQ.py -i ${tck_reor} -m ${prep_d}"
-
-            task_exec
-
             touch "${TCK_out}/QQ/${TCK_2_make}_fin_${T}_${algo_f}_QQ_done.done" && echo "${TCK_2_make}_fin_${T}_${algo_f} QQ work is done" | tee -a ${prep_log2}
 
         fi
@@ -1303,11 +1325,101 @@ function make_bundle {
 
     fi
 
+    # tasks this bundle started in the background have to finish before the scheduler frees its threads
+    wait
+
+    rm -f "${scratch_d}/${TCK_2_make}_"*.tck
+
+    rmdir "${scratch_d}" >/dev/null 2>&1
+
+    if [[ -f ${task_fail_f} ]]; then
+
+        exit 1
+
+    fi
+
     unset TCK_out TCK_2_make
 
 }
 
 
+# bundles are run by KUL_FWT_scheduler.py, every bundle has a make step (segmentation and filtering)
+# followed by the QQ and screenshot steps, which only need their own make step
+# the make step gets bncpu threads, QQ and screenshots are mostly single threaded python
+# the scheduler reruns this script with KUL_FWT_BUNDLE and KUL_FWT_STEP set, which runs make_bundle
+# for that bundle and step only, without searching the inputs or redoing the subject wide steps
+# (metric maps, fixels, whole brain tractogram, CFP parcellation in MNI) of the main run
+
+function queue_bundle {
+
+    if [[ -z ${KUL_FWT_BUNDLE} ]]; then
+
+        b_cmd="KUL_FWT_BUNDLE=${TCK_to_make} KUL_FWT_RUN=${d} ${script_f} $(printf '%q ' "${script_args[@]}")"
+
+        echo "${TCK_to_make}_make||${bncpu}|KUL_FWT_STEP=make ${b_cmd} -n ${bncpu}" >> ${task_f}
+
+        if [[ "${Q_flag}" -eq 1 ]]; then
+
+            echo "${TCK_to_make}_QQ|${TCK_to_make}_make|1|KUL_FWT_STEP=QQ ${b_cmd} -n 1" >> ${task_f}
+
+        fi
+
+        if [[ "${S_flag}" -eq 1 ]]; then
+
+            echo "${TCK_to_make}_Sc|${TCK_to_make}_make|1|KUL_FWT_STEP=Sc ${b_cmd} -n 1" >> ${task_f}
+
+        fi
+
+    else
+
+        run_make=1
+
+        if [[ ${KUL_FWT_STEP} == "make" ]]; then
+
+            Q_flag=0
+            S_flag=0
+
+        elif [[ ${KUL_FWT_STEP} == "QQ" ]]; then
+
+            run_make=0
+            S_flag=0
+
+        elif [[ ${KUL_FWT_STEP} == "Sc" ]]; then
+
+            run_make=0
+            Q_flag=0
+
+        fi
+
+        make_bundle
+
+    fi
+
+}
+
+
+function run_bundles {
+
+    if [[ -z ${KUL_FWT_BUNDLE} ]] && [[ -s ${task_f} ]]; then
+
+        # the QC figures of all bundles are queued and rendered together once they are done, see KUL_FWT_render.py
+        export KUL_FWT_RENDER_QUEUE="${KUL_FWT_RENDER_QUEUE:-${sched_d}/render_queue.jsonl}"
+
+        task_in="KUL_FWT_scheduler.py -i ${task_f} -n ${ncpu} -o ${sched_d}"
+
+        # a failed bundle only leaves the task_fail_f flag in this subshell, so the figures of all
+        # other bundles are still rendered, then the render task_exec exits with the failure
+        ( task_exec )
+
+        task_in="KUL_FWT_render.py -q ${KUL_FWT_RENDER_QUEUE} -n ${ncpu}"
+
+        task_exec
+
+    fi
+
+}
+
+
 ###################################################################################
 # script start here
 # part 1 of this workflow is general purpose and should be run for all bundles
@@ -1316,6 +1428,37 @@ function make_bundle {
 # find your priors
 # all priors are in MNI space
 
+# uncompressed copies of the priors, prepared once and shared read-only by all subjects, see KUL_FWT_templates.py
+# a run only stats the sources when nothing changed, bundle steps of the scheduler use what the main run prepared
+# in the KUL_FWT user cache dir, keyed by the real path of the templates dir, same as cache_dir() there
+tpl_key=$(printf %s "$(cd "${pr_d}" && pwd -P)" | sha1sum | cut -c1-8)
+tpl_c="${KUL_FWT_TEMPLATE_CACHE:-${KUL_FWT_CACHE:-${HOME}/.cache/KUL_FWT}/templates_${tpl_key}}"
+
+if [[ -z ${KUL_FWT_BUNDLE} ]]; then
+
+    task_in="KUL_FWT_templates.py -d ${pr_d}"
+
+    task_exec
+
+fi
+
+# path of a prior, its copy in the templates cache unless the source is newer or there is none
+function prior {
+
+    local c_im="${tpl_c}/${1%.nii.gz}.nii"
+
+    if [[ -f ${c_im} ]] && [[ ${c_im} -nt ${pr_d}/${1} ]]; then
+
+        echo "${c_im}"
+
+    else
+
+        echo "${pr_d}/${1}"
+
+    fi
+
+}
+
 ROIs_d="${output_d}/sub-${subj}${ses_str}_VOIs"
 
 prep_d="${output_d}/sub-${subj}${ses_str}_prep"
@@ -1324,20 +1467,20 @@ UKBB_temp=($(find ${pr_d} -type f -name "T1_preunbiased.nii.gz"))
 
 UKBB_temp_mask=($(find ${pr_d} -type f -name "T1_UKBB_brain_mask.nii.gz"))
 
-UKBB_labels="${pr_d}/UKBB_BStem_VOIs_comb.nii.gz" # done
+UKBB_labels="$(prior UKBB_BStem_VOIs_comb.nii.gz)" # done
 # these would benefit from a propagate labels step probably
 
-JHU_labels="${pr_d}/JHU_WM_labels.nii.gz" # done
+JHU_labels="$(prior JHU_WM_labels.nii.gz)" # done
 
-JuHA_labels="${pr_d}/Juelich_GNs_inMNI.nii.gz" # done
+JuHA_labels="$(prior Juelich_GNs_inMNI.nii.gz)" # done
 
-Man_VOIs="${pr_d}/Manual_VOIs.nii.gz" # done
+Man_VOIs="$(prior Manual_VOIs.nii.gz)" # done
 
-PD25="${pr_d}/PD25_hist_1mm_RLinMNI.nii.gz" # done
+PD25="$(prior PD25_hist_1mm_RLinMNI.nii.gz)" # done
 
-SUIT="${pr_d}/SUIT_atlas_inMNI.nii.gz" # done
+SUIT="$(prior SUIT_atlas_inMNI.nii.gz)" # done
 
-RL_VOIs="${pr_d}/RL_hemi_masks.nii.gz" # done
+RL_VOIs="$(prior RL_hemi_masks.nii.gz)" # done
 
 TCKs_w2temp="${prep_d}/FS_2_UKBB_${subj}_inv_4TCKs.mif"
 
@@ -1577,8 +1720,11 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
     # metrics=("${subj_FA_MNI}" "${subj_ADC_MNI}" "${subj_AD_MNI}" "${subj_RD_MNI}")
 
+    # the subject wide maps and tractograms below are made by the main run only, bundle steps started by
+    # the scheduler skip straight to their bundle and use what the main run made
+
     # if we want to quantify we should add rd and ad
-    if [[ "${Q_flag}" -eq 1 ]] && [[ ! -f "${subj_RD_MNI}" ]]; then
+    if [[ -z ${KUL_FWT_BUNDLE} ]] && [[ "${Q_flag}" -eq 1 ]] && [[ ! -f "${subj_RD_MNI}" ]]; then
 
         task_in="tensor2metric -force -mask ${T1_brain_mask_inFA} -rd ${subj_RD} -ad ${subj_AD} ${subj_dt}"
 
@@ -1607,7 +1753,7 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
     # make some CSD based metrics
 
-    if [[ ! -f "${subj_vdisp_MNI}"  ]]; then
+    if [[ -z ${KUL_FWT_BUNDLE} ]] && [[ ! -f "${subj_vdisp_MNI}"  ]]; then
 
         if [[ -d "${prep_d}/fixel_metrics" ]]; then
 
@@ -1670,12 +1816,16 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
             subj_ADC="${prep_d}/sub-${subj}_dwi_dt_vecs_reg2T1w.mif"
 
-            echo " DT vectors file not found, we will make it" | tee -a ${prep_log2}
+            if [[ -z ${KUL_FWT_BUNDLE} ]]; then
 
-            task_in="tensor2metric -force -nthreads ${ncpu} -mask ${T1_BM_inFA_minCSF} -vec ${subj_DT_vecs} \
-            ${subj_dt}"
+                echo " DT vectors file not found, we will make it" | tee -a ${prep_log2}
 
-            task_exec
+                task_in="tensor2metric -force -nthreads ${ncpu} -mask ${T1_BM_inFA_minCSF} -vec ${subj_DT_vecs} \
+                ${subj_dt}"
+
+                task_exec
+
+            fi
 
         else
 
@@ -1717,6 +1867,12 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
         SIFT_srch=($(find ${TCKs_outd} -type f -name "sub-${subj}${ses_str}_sift2_ws.txt"));
 
+        if [[ ! -z ${KUL_FWT_BUNDLE} ]]; then
+
+            WB_tck_srch=${WB_tck} ; SIFT_srch="${TCKs_outd}/sub-${subj}${ses_str}_sift2_ws.txt"
+
+        fi
+
         if [[ -z ${WB_tck_srch} ]]; then
 
             echo " Whole brain tractogram not found, generating " | tee -a ${prep_log2}
@@ -1773,6 +1929,13 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
         for q in ${!tck_list[@]}; do
 
+            # a bundle step started by the scheduler only needs its own bundle
+            if [[ ! -z ${KUL_FWT_BUNDLE} ]] && [[ ! ${tck_list[$q]} == "${KUL_FWT_BUNDLE}" ]]; then
+
+                continue
+
+            fi
+
             echo $q
             echo ${tck_list[$q]}
 
@@ -1785,7 +1948,7 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
                 ns="${nosts_list[$q]}"
 
-                make_bundle
+                queue_bundle
 
                 unset TCK_to_make ns
 
@@ -1804,6 +1967,13 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
         for q in ${!tck_list[@]}; do
 
+            # a bundle step started by the scheduler only needs its own bundle
+            if [[ ! -z ${KUL_FWT_BUNDLE} ]] && [[ ! ${tck_list[$q]} == "${KUL_FWT_BUNDLE}" ]]; then
+
+                continue
+
+            fi
+
             echo $q
             echo ${tck_list[$q]}
 
@@ -1816,7 +1986,7 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
                 ns="${nosts_list[$q]}"
 
-                make_bundle
+                queue_bundle
 
                 unset TCK_to_make ns
 
@@ -1826,4 +1996,20 @@ elif [[ ! -z "${ROIs_d}/Part1.done" ]] && [[ ! -z "${ROIs_d}/Part2.done" ]]; the
 
     fi
 
+    # the CFP parcellation in MNI is needed for the connectivity fingerprints in the QQ engine
+    # it is the same for all bundles, so the main run makes it once before the QQ steps start
+    if [[ -z ${KUL_FWT_BUNDLE} ]] && [[ "${Q_flag}" -eq 1 ]] && { [[ ! -f ${CFP_aparc_inMNI} ]] || [[ ${CFP_aparc_inFA} -nt ${CFP_aparc_inMNI} ]]; }; then
+
+        task_in="antsApplyTransforms -d 3 -i ${CFP_aparc_inFA} \
+        -o ${CFP_aparc_inMNI} -r ${UKBB_temp} \
+        -t ${prep_d}/FS_2_UKBB_${subj}${ses_str}_1Warp.nii.gz -t [${prep_d}/FS_2_UKBB_${subj}${ses_str}_0GenericAffine.mat,0] \
+        -t ${prep_d}/fa_2_UKBB_vFS_${subj}${ses_str}_1Warp.nii.gz -t [${prep_d}/fa_2_UKBB_vFS_${subj}${ses_str}_0GenericAffine.mat,0] -n MultiLabel"
+
+        task_exec
+
+    fi
+
+    # now run all queued bundle steps
+    run_bundles
+
 fi
@@ -358,6 +358,9 @@ mkdir -p "${tmpo_d}" >/dev/null 2>&1
 
 export MRTRIX_TMPFILE_DIR="${tmpo_d}"
 
+# a failing task in the background leaves this flag for the main shell
+task_fail_f="${tmpo_d}/task_failed_$$"
+
 # report pid
 
 processId=$(ps -ef | grep 'ABCD' | grep -v 'grep' | awk '{ printf $2 }')
@@ -413,7 +416,7 @@ done
 echo "You have asked to segment the following bundles from whole brain TCK ${tck_list[@]}" | tee -a ${prep_log2}
 
 # Exec_all function
-# need to recreate this function to include proc. control
+# runs task_in, logs its real exit status and stops the workflow if it failed
 
 function task_exec {
 
@@ -423,37 +426,43 @@ function task_exec {
 
     echo " Started @ $(date "+%Y-%m-%d_%H-%M-%S")" | tee -a ${prep_log2}
 
-    eval ${task_in} 2>&1 | tee -a ${prep_log2} &
+    # pipefail, so we get the exit status of the task and not that of tee
+    ( set -o pipefail; eval ${task_in} 2>&1 | tee -a ${prep_log2} ) &
 
-    # echo " pid = $! basicPID = $BASHPID " | tee -a ${prep_log2}
+    pid=$!
 
-    echo " pid = $! " | tee -a ${prep_log2}
+    echo " pid = ${pid} " | tee -a ${prep_log2}
 
     wait ${pid}
 
-    sleep 5
+    task_status=$?
 
-    echo "exit status $?" | tee -a ${prep_log2}
+    # tasks started in the background before this one have to finish too
+    wait
 
-    # if [ $? -eq 0 ]; then
+    echo "exit status ${task_status}" | tee -a ${prep_log2}
 
-    #     echo Success >> ${prep_log2}
+    echo " Finished @ $(date "+%Y-%m-%d_%H-%M-%S")" | tee -a ${prep_log2}
 
-    # else
+    echo "-------------------------------------------------------------" | tee -a ${prep_log2}
 
-    #     echo Fail >> ${prep_log2}
+    echo "" | tee -a ${prep_log2}
 
-    #     exit 1
+    unset task_in
 
-    # fi
+    if [[ ${task_status} -ne 0 ]]; then
 
-    echo " Finished @ $(date "+%Y-%m-%d_%H-%M-%S")" | tee -a ${prep_log2}
+        touch ${task_fail_f}
 
-    echo "-------------------------------------------------------------" | tee -a ${prep_log2}
+    fi
 
-    echo "" | tee -a ${prep_log2}
+    if [[ -f ${task_fail_f} ]]; then
 
-    unset task_in
+        echo " A task failed, exitting " | tee -a ${prep_log2}
+
+        exit 1
+
+    fi
 
 }
 
@@ -464,24 +473,51 @@ function task_exec {
 # find your priors
 # all priors are in MNI space
 
+# uncompressed copies of the priors, prepared once and shared read-only by all subjects, see KUL_FWT_templates.py
+# a run only stats the sources when nothing changed
+# in the KUL_FWT user cache dir, keyed by the real path of the templates dir, same as cache_dir() there
+tpl_key=$(printf %s "$(cd "${pr_d}" && pwd -P)" | sha1sum | cut -c1-8)
+tpl_c="${KUL_FWT_TEMPLATE_CACHE:-${KUL_FWT_CACHE:-${HOME}/.cache/KUL_FWT}/templates_${tpl_key}}"
+
+task_in="KUL_FWT_templates.py -d ${pr_d}"
+
+task_exec
+
+# path of a prior, its copy in the templates cache unless the source is newer or there is none
+function prior {
+
+    local c_im="${tpl_c}/${1%.nii.gz}.nii"
+
+    if [[ -f ${c_im} ]] && [[ ${c_im} -nt ${pr_d}/${1} ]]; then
+
+        echo "${c_im}"
+
+    else
+
+        echo "${pr_d}/${1}"
+
+    fi
+
+}
+
 UKBB_temp=($(find ${pr_d} -type f -name "T1_preunbiased.nii.gz"))
 
 UKBB_temp_mask=($(find ${pr_d} -type f -name "T1_UKBB_brain_mask.nii.gz"))
 
-UKBB_labels="${pr_d}/UKBB_BStem_VOIs_comb.nii.gz" # done
+UKBB_labels="$(prior UKBB_BStem_VOIs_comb.nii.gz)" # done
 # these would benefit from a propagate labels step probably
 
-JHU_labels="${pr_d}/JHU_WM_labels.nii.gz" # done
+JHU_labels="$(prior JHU_WM_labels.nii.gz)" # done
 
-JuHA_labels="${pr_d}/Juelich_GNs_inMNI.nii.gz" # done
+JuHA_labels="$(prior Juelich_GNs_inMNI.nii.gz)" # done
 
-Man_VOIs="${pr_d}/Manual_VOIs.nii.gz" # done
+Man_VOIs="$(prior Manual_VOIs.nii.gz)" # done
 
-PD25="${pr_d}/PD25_hist_1mm_RLinMNI.nii.gz" # done
+PD25="$(prior PD25_hist_1mm_RLinMNI.nii.gz)" # done
 
-SUIT="${pr_d}/SUIT_atlas_inMNI.nii.gz" # done
+SUIT="$(prior SUIT_atlas_inMNI.nii.gz)" # done
 
-RL_VOIs="${pr_d}/RL_hemi_masks.nii.gz" # done
+RL_VOIs="$(prior RL_hemi_masks.nii.gz)" # done
 
 ####
 
@@ -544,254 +580,15 @@ qo=4;
 
 function PD25_lab_gen {
 
-    PD25_labels_LT=("PD25_DM_LT" "PD25_DL_LT" "PD25_VA_LT" "PD25_VL_LT" "PD25_VPL_LT" "PD25_VPM_LT" "PD25_Pulvi_LT" \
-    "PD25_MG_LT" "PD25_RN_LT");
-
-    PD25_labels_RT=("PD25_DM_RT" "PD25_DL_RT" "PD25_VA_RT" "PD25_VL_RT" "PD25_VPL_RT" "PD25_VPM_RT" "PD25_Pulvi_RT" \
-    "PD25_MG_RT" "PD25_RN_RT");
-
-    PD25_vals_RT=("37" "40" "53" "26" "28" "36" "89" \
-    "86" "87" "88" "90" "91" "92" "93" "94" "104" \
-    "111" "112" "114" "120" "123" "96" "97" "98" \
-    "115" "117" "118" "95" "113" \
-    "102" "103" "105" "106" "107" "116" "119" "68" "48");
-
-    PD25_vals_LT=("3700" "4000" "5300" "2600" "2800" "3600" "8900" \
-    "8600" "8700" "8800" "9000" "9100" "9200" "9300" "9400" "10400" \
-    "11100" "11200" "11400" "12000" "12300" "9600" "9700" "9800" \
-    "11500" "11700" "11800" "9500" "11300" \
-    "10200" "10300" "10500" "10600" "10700" "11600" "11900" "6800" "4800");
-
-    # this should be 36 entries per side + RNs
-    # vals outnumber labels, as each nucleus (label) constitutes
-    # multiple ROIs from the atlas
-
     srch_PD25Ls=($(find ${ROIs_d}/custom_VOIs -type f | grep "PD25_VPALPLPM_RT_custom.nii.gz"))
 
     if [[ ! ${srch_PD25Ls} ]]; then
 
-        qs=0;
-
-        for hl in ${!PD25_vals_LT[@]}; do
-
-            ((qs++))
-            ((qs=${qs}%${qo}))
-
-            echo " separating PD25_LT ROIs" >> ${prep_log2}
-
-            # isolate rois
-
-            task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${PD25_in_FOD} ${MSBP_csf_mask_binv} -mult ${PD25_vals_LT[$hl]} \
-            -eq ${tmpo_d}/PD25_ROI_${PD25_vals_LT[$hl]}_LT_custom.nii.gz" 
-            
-            task_exec &
-
-            if [[ ${qs} == 0 ]]; then
-
-                wait
-
-            fi
-
-        done
-
-        # sleep 200
-
-        wait
-
-        # unset hl
-
-        qs=0;
-
-        for hr in ${!PD25_vals_RT[@]}; do
-
-            ((qs++))
-            ((qs=${qs}%${qo}))
-
-            echo " separating PD25_RT ROIs" >> ${prep_log2}
-
-            # isolate rois
-
-            task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${PD25_in_FOD} ${MSBP_csf_mask_binv} -mult ${PD25_vals_RT[$hr]} \
-            -eq ${tmpo_d}/PD25_ROI_${PD25_vals_RT[$hr]}_RT_custom.nii.gz" 
-            
-            task_exec &
-
-            if [[ ${qs} == 0 ]]; then
-
-                wait
-                
-            fi
-
-        done
-
-        wait
-
-        sleep 50
-
-        # unset hr
-
-        # make nuclei
-
         echo " Creating PD25 derived thalamic VOIs " >> ${prep_log2}
 
-        ##################
-
-        VA_rois_RT=("26" "28" "36" "89");
-        VA_rois_LT=("2600" "2800" "3600" "8900");
-        VL_rois_RT=("86" "87" "88" "90" "91" "92" "93" "94" "104" \
-        "111" "112" "114" "120" "123");
-        VL_rois_LT=("8600" "8700" "8800" "9000" "9100" "9200" "9300" "9400" "10400" \
-        "11100" "11200" "11400" "12000" "12300");
-        VPL_rois_RT=("96" "97" "98" "115" "117" "118");
-        VPL_rois_LT=("9600" "9700" "9800" "11500" "11700" "11800");
-        VPM_rois_RT=("95" "113");
-        VPM_rois_LT=("9500" "11300");
-        PUL_rois_RT=("102" "103" "105" "106" "107" "116" "119");
-        PUL_rois_LT=("10200" "10300" "10500" "10600" "10700" "11600" "11900");
-
-        # Isolate the thalamus from the aparc
-        # We use this to refine PD25 thalamic VOIs
-        task_in="mrcalc -force -datatype uint16 -force -nthreads ${ncpu} ${subj_aparc_in_FOD} 10 -eq 0 -gt ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz \
-        && mrcalc -force -datatype uint16 -force -nthreads ${ncpu} ${subj_aparc_in_FOD} 49 -eq 0 -gt ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz"
-
-        task_exec
-
-        # DM
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_37_RT_custom.nii.gz ${tmpo_d}/PD25_ROI_40_RT_custom.nii.gz \
-        -add 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_DM_RT_custom.nii.gz -force"
-        task_exec &
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_3700_LT_custom.nii.gz ${tmpo_d}/PD25_ROI_4000_LT_custom.nii.gz \
-        -add 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_DM_LT_custom.nii.gz -force"
-        task_exec &
-
-        #################################
-
-        # DL
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_53_RT_custom.nii.gz 0.5 -gt  - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - \
-        0.5 -gt ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_DL_RT_custom.nii.gz"
-        task_exec &
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_5300_LT_custom.nii.gz 0.5 -gt  - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - \
-        0.5 -gt ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_DL_LT_custom.nii.gz"
-        task_exec &
-
-        #################################
-
-        # VA
-        VA_adds_RT=$(printf " ${tmpo_d}/PD25_ROI_%s_RT_custom.nii.gz -add"  "${VA_rois_RT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_26_RT_custom.nii.gz ${tmpo_d}/PD25_ROI_28_RT_custom.nii.gz -add \
-        ${VA_adds_RT} 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VA_RT_custom.nii.gz -force"
-        task_exec
-
-        VA_adds_LT=$(printf " ${tmpo_d}/PD25_ROI_%s_LT_custom.nii.gz -add"  "${VA_rois_LT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_2600_LT_custom.nii.gz ${tmpo_d}/PD25_ROI_2800_LT_custom.nii.gz -add \
-        ${VA_adds_LT} 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VA_LT_custom.nii.gz -force"
-        task_exec
-
-        #################################
-
-        # VL
-        VL_adds_RT=$(printf " ${tmpo_d}/PD25_ROI_%s_RT_custom.nii.gz -add"  "${VL_rois_RT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_86_RT_custom.nii.gz ${tmpo_d}/PD25_ROI_87_RT_custom.nii.gz -add \
-        ${VL_adds_RT} 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VL_RT_custom.nii.gz -force"
-        task_exec &
-
-        VL_adds_LT=$(printf " ${tmpo_d}/PD25_ROI_%s_LT_custom.nii.gz -add"  "${VL_rois_LT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_8600_LT_custom.nii.gz ${tmpo_d}/PD25_ROI_8700_LT_custom.nii.gz -add \
-        ${VL_adds_LT} 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VL_LT_custom.nii.gz -force"
-        task_exec &
-
-        #################################
-
-        # VPL
-        VPL_adds_RT=$(printf " ${tmpo_d}/PD25_ROI_%s_RT_custom.nii.gz -add"  "${VPL_rois_RT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_96_RT_custom.nii.gz ${tmpo_d}/PD25_ROI_97_RT_custom.nii.gz -add \
-        ${VPL_adds_RT} 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VPL_RT_custom.nii.gz -force"
-        task_exec &
-
-        VPL_adds_LT=$(printf " ${tmpo_d}/PD25_ROI_%s_LT_custom.nii.gz -add"  "${VPL_rois_LT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_9600_LT_custom.nii.gz ${tmpo_d}/PD25_ROI_9700_LT_custom.nii.gz -add \
-        ${VPL_adds_LT} 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VPL_LT_custom.nii.gz -force"
-        task_exec &
-
-        #################################
-
-        # VPM
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_95_RT_custom.nii.gz ${tmpo_d}/PD25_ROI_113_RT_custom.nii.gz -add \
-        0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VPM_RT_custom.nii.gz -force"
-        task_exec
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_9500_LT_custom.nii.gz ${tmpo_d}/PD25_ROI_11300_LT_custom.nii.gz -add \
-        0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_VPM_LT_custom.nii.gz -force"
-        task_exec
-
-        #################################
-
-        # Pulvi
-        # switched to -npass 2 dilation with maskfilter from mrfilter only for the pulvies
-        PUL_adds_RT=$(printf " ${tmpo_d}/PD25_ROI_%s_RT_custom.nii.gz -add"  "${PUL_rois_RT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_102_RT_custom.nii.gz ${tmpo_d}/PD25_ROI_103_RT_custom.nii.gz -add \
-        ${PUL_adds_RT} 0.5 -gt - | maskfilter - dilate -npass 1 - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_Pulvi_RT_custom.nii.gz -force"
-        task_exec &
-
-        PUL_adds_LT=$(printf " ${tmpo_d}/PD25_ROI_%s_LT_custom.nii.gz -add"  "${PUL_rois_LT[@]:2}")
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_10200_LT_custom.nii.gz ${tmpo_d}/PD25_ROI_10300_LT_custom.nii.gz -add \
-        ${PUL_adds_LT} 0.5 -gt - | maskfilter - dilate -npass 1 - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_Pulvi_LT_custom.nii.gz -force"
-        task_exec &
-
-        #################################
-
-        # # MG
-        # task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_68_RT_custom.nii.gz 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        # ${ROIs_d}/custom_VOIs/Thalamus_RT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_MG_RT_custom.nii.gz -force"
-        # task_exec &
-
-        # task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_6800_LT_custom.nii.gz 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        # ${ROIs_d}/custom_VOIs/Thalamus_LT_FS_custom.nii.gz -mult ${ROIs_d}/custom_VOIs/PD25_MG_LT_custom.nii.gz -force"
-        # task_exec &
-
-        #################################
-
-        # Red Nucleus
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_48_RT_custom.nii.gz 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/PD25_RN_RT_custom.nii.gz -force"
-        task_exec
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${tmpo_d}/PD25_ROI_4800_LT_custom.nii.gz 0.5 -gt - | mrfilter - smooth - | maskfilter - connect -largest -connectivity - | mrcalc -force -datatype uint16 - 0.5 -gt \
-        ${ROIs_d}/custom_VOIs/PD25_RN_LT_custom.nii.gz -force"
-        task_exec
-
-        ###
-
-        # this will be used for the ORs, ML and the thalamic radiations
-
-        task_in="mrcalc -force -datatype uint16 -force -nthreads 1 ${ROIs_d}/custom_VOIs/PD25_VA_LT_custom.nii.gz ${ROIs_d}/custom_VOIs/PD25_VL_LT_custom.nii.gz -add 0.5 -gt ${ROIs_d}/custom_VOIs/PD25_VA_VL_LT_custom.nii.gz && \
-        mrcalc -force -datatype uint16 -force -nthreads 1 ${ROIs_d}/custom_VOIs/PD25_VPL_LT_custom.nii.gz ${ROIs_d}/custom_VOIs/PD25_VPM_LT_custom.nii.gz -add 0.5 -gt ${ROIs_d}/custom_VOIs/PD25_VPL_VPM_LT_custom.nii.gz && \
-        mrcalc -force -datatype uint16 -force -nthreads 1 ${ROIs_d}/custom_VOIs/PD25_VA_VL_LT_custom.nii.gz ${ROIs_d}/custom_VOIs/PD25_VPL_VPM_LT_custom.nii.gz -add 0.5 -gt ${ROIs_d}/custom_VOIs/PD25_VPALPLPM_LT_custom.nii.gz \
-        && mrcalc -force -datatype uint16 -force -nthreads 1 ${ROIs_d}/custom_VOIs/PD25_VA_RT_custom.nii.gz ${ROIs_d}/custom_VOIs/PD25_VL_RT_custom.nii.gz -add 0.5 -gt ${ROIs_d}/custom_VOIs/PD25_VA_VL_RT_custom.nii.gz && \
-        mrcalc -force -datatype uint16 -force -nthreads 1 ${ROIs_d}/custom_VOIs/PD25_VPL_RT_custom.nii.gz ${ROIs_d}/custom_VOIs/PD25_VPM_RT_custom.nii.gz -add 0.5 -gt ${ROIs_d}/custom_VOIs/PD25_VPL_VPM_RT_custom.nii.gz && \
-        mrcalc -force -datatype uint16 -force -nthreads 1 ${ROIs_d}/custom_VOIs/PD25_VA_VL_RT_custom.nii.gz ${ROIs_d}/custom_VOIs/PD25_VPL_VPM_RT_custom.nii.gz -add 0.5 -gt ${ROIs_d}/custom_VOIs/PD25_VPALPLPM_RT_custom.nii.gz"
+        # the PD25 nuclei (DM, DL, VA, VL, VPL, VPM, Pulvi and RN) and the FS thalami we refine them with,
+        # from one read of the atlas, labels and steps per nucleus are in KUL_FWT_VOIengine.py
+        task_in="KUL_FWT_VOIengine.py -m PD25 -p ${PD25_in_FOD} -c ${MSBP_csf_mask_binv} -a ${subj_aparc_in_FOD} -o ${ROIs_d}/custom_VOIs"
 
         task_exec
 
@@ -1243,6 +1040,8 @@ if [[ -z ${srch_pt1_done} ]]; then
 
         done
 
+        wait
+
         # use the PD25 labels function
         PD25_lab_gen
 
@@ -1703,7 +1502,7 @@ function make_VOIs {
     # to use dynamic variable definitions in bash
     # eval v_array=( \${${tck}_array[@]})
 
-    unset Vs_Ls Vs_Is source_map val Vs_1_str Vs_other_str VOIs_LUT
+    unset Vs_Ls Vs_Is source_map val Vs_srcs Vs_ints VOIs_LUT
 
     eval Vs_Ls=( \${${tck_VOIs_2seg}_Ls[@]});
     eval Vs_Is=( \${${tck_VOIs_2seg}_Is[@]});
@@ -1720,15 +1519,6 @@ function make_VOIs {
     mkdir -p "${MNI_VOIs_dir}"
     VOIs_LUT="${VOIs_dir}/${tck_VOIs_2seg}_LUT.csv"
 
-    # do we need a long string or not?
-    if [[ ${#Vs_Ls[@]} -gt 1 ]]; then
-
-        declare -a Vs_other_str
-        declare -a Vs_nms_other_str
-        declare -a tmpo_Vs
-
-    fi
-
     for z in ${!Vs_Ls[@]}; do
 
         echo ${Vs_Ls[$z]} | tee -a ${prep_log2}
@@ -1796,93 +1586,34 @@ function make_VOIs {
         ((val=${z}+1))
 
         # Vs_Is encodes the VOIs intensity in source map
-        # no source map in case of a custom VOI
-        # val encodes the new value we give it
-
-        # first condition is a lone custom VOI
-        ## stopped here
-        ## condition with backticks doesnt work
+        # a custom VOI has no source map, its own file takes the place of the intensity
+        # val is the index of the VOI + 1, KUL_FWT_VOIengine.py gives it that value in the map
 
         if [[ ! -z ${source_map} ]]; then
 
-            source_n=$(basename ${source_map});
+            Vs_srcs[$z]="${source_map}"
+            Vs_ints[$z]="${Vs_Is[$z]}"
 
         else
 
-            source_n="Custom_VOIs";
-
-        fi
-
-
-        if [[ ${z} == 0 ]] && [[ -z ${source_map} ]]; then
-
-            Vs_1_str=" ${ROIs_d}/custom_VOIs/${Vs_Ls[$z]}.nii.gz 0 -gt ${val} -mult "
-            # Vs_nms_1_str=" ${Vs_Ls[$z]} is scaled to ${val} "
-
-        elif [[ ${z} == 0 ]] && [[ ! -z ${source_map} ]]; then
-
-            Vs_1_str=" ${source_map} ${Vs_Is[$z]} -eq 0 -gt ${val} -mult "
-            # Vs_nms_1_str=" ${Vs_Ls[$z]} is scaled to ${val} from ${source_n}"
-
-            # printf '%s, %s, %s, %s \n' "${Vs_Ls[$z]}" "${val}" "${source_n}" "${Vs_Is[$z]}" >> ${VOIs_LUT}
-            # echo "${Vs_Ls[$z]} ${val} ${source_n} ${Vs_Is[$z]}" | tr " " "," >> ${VOIs_LUT}
-
-        elif [[ ${z} -gt 0 ]] && [[ ! -z ${source_map} ]]; then
-
-            tmpo_Vs[$z]="${tmpo_d}/${Vs_Ls[$z]}_tmp.nii.gz"
-            task_in="mrcalc -force -datatype uint16 -quiet -nthreads 1 -force ${source_map} ${Vs_Is[$z]} -eq 0 -gt ${val} -mult ${tmpo_Vs[$z]}"
-            task_exec &
-            Vs_other_str[$z]=" 0 ${tmpo_Vs[$z]} -replace "
-            # Vs_nms_other_str[$z]=" ${Vs_Ls[$z]} is scaled to ${val} from ${source_n}"
-
-            # printf '%s, %s, %s, %s \n' "${Vs_Ls[$z]}" "${val}" "${source_n}" "${Vs_Is[$z]}" >> ${VOIs_LUT}
-            # echo  "${Vs_Ls[$z]} ${val} ${source_n} ${Vs_Is[$z]}" | tr " " "," >> ${VOIs_LUT}
-
-        elif [[ ${z} -gt 0 ]] && [[ -z ${source_map} ]]; then
-
-            tmpo_Vs[$z]="${tmpo_d}/${Vs_Ls[$z]}_tmp.nii.gz"
-            task_in="mrcalc -force -datatype uint16 -quiet -nthreads 1 -force ${ROIs_d}/custom_VOIs/${Vs_Ls[$z]}.nii.gz 0 -gt ${val} -mult ${tmpo_Vs[$z]}"
-            task_exec &
-            Vs_other_str[$z]=" 0 ${tmpo_Vs[$z]} -replace "
-            # Vs_other_str[$z]=" 0 ${ROIs_d}/custom_VOIs/${Vs_Ls[$z]}.nii.gz -replace "
-            # Vs_nms_other_str[$z]=" ${Vs_Ls[$z]} is scaled to ${val} "
-
-            # printf '%s, %s, %s, %s \n' "${Vs_Ls[$z]}" "${val}" "Custom_VOI" "1" >> ${VOIs_LUT}
-            # echo  "${Vs_Ls[$z]} ${val} Custom_VOI 1" | tr " " "," >> ${VOIs_LUT}
+            Vs_srcs[$z]=""
+            Vs_ints[$z]="${ROIs_d}/custom_VOIs/${Vs_Ls[$z]}.nii.gz"
 
         fi
 
-        # make the LUTs
-
-        printf '%s, %s \n' "${Vs_Ls[$z]}" "${val}" >> ${VOIs_LUT}
-        
         # insert subdivision workflow here
 
     done
 
-    sleep 5
-
-    # so the mrcalc -force -datatype uint16 command should read as follows
-
-    # task_in="mrcalc -force -datatype uint16 -force -nthreads ${ncpu} -quiet ${Vs_1_str} ${ROIs_d}/${tck_VOIs_2seg}_VOIs/${tck_VOIs_2seg}.nii.gz"
-
-    # task_exec
-
-    # echo "${Vs_nms_1_str}" >> ${VOIs_LUT}
-
-    # if with multiple constituent VOIs
+    # the maps, binary masks and LUTs of all bundles are made in one go after the bundle loop
     # remember to include a -datatype with 32bituint if using tck2conn and conn2tck
-    # should include a transform to MNI step here
+    echo "${tck_VOIs_2seg}|${VOIs_dir}/${tck_VOIs_2seg}_map.nii.gz|${VOIs_LUT}|$(IFS=,; echo "${Vs_Ls[*]}")|$(IFS=,; echo "${Vs_srcs[*]}")|$(IFS=,; echo "${Vs_ints[*]}")" >> ${VOIs_spec}
 
-    task_in="mrcalc -force -datatype uint16 -force -nthreads 1 -quiet ${Vs_1_str} ${Vs_other_str[@]} ${VOIs_dir}/${tck_VOIs_2seg}_map.nii.gz \
-    && mrcalc -force -datatype uint16 -force -nthreads 1 -quiet ${VOIs_dir}/${tck_VOIs_2seg}_map.nii.gz 0 -gt ${VOIs_dir}/${tck_VOIs_2seg}_bin.nii.gz \
-    && antsApplyTransforms -d 3 -i ${VOIs_dir}/${tck_VOIs_2seg}_map.nii.gz \
+    VOIs_2MNI+=("antsApplyTransforms -d 3 -i ${VOIs_dir}/${tck_VOIs_2seg}_map.nii.gz \
     -o ${MNI_VOIs_dir}/${tck_VOIs_2seg}_map_inMNI.nii.gz -r ${UKBB_temp} \
     -t ${prep_d}/FS_2_UKBB_${subj}${ses_str}_1Warp.nii.gz -t [${prep_d}/FS_2_UKBB_${subj}${ses_str}_0GenericAffine.mat,0] \
     -t ${prep_d}/fod_2_UKBB_vFS_${subj}${ses_str}_1Warp.nii.gz -t [${prep_d}/fod_2_UKBB_vFS_${subj}${ses_str}_0GenericAffine.mat,0] \
-    -n multilabel"
-
-    task_exec &
+    -n multilabel")
 
     # task_in="mrcalc -force -datatype uint16 -force -nthreads 1 -quiet ${VOIs_dir}/${tck_VOIs_2seg}_map.nii.gz 0 -gt \
     # ${VOIs_dir}/${tck_VOIs_2seg}_bin.nii.gz"
@@ -1891,7 +1622,7 @@ function make_VOIs {
 
     # echo "${Vs_nms_other_str[@]}" > ${VOIs_LUT}
 
-    echo "${tck_list[$q]}_VOIs done" >> "${ROIs_d}/${tck_list[$q]}_VOIs.done"
+    VOIs_dones+=("${tck_list[$q]}")
 
     unset z
 
@@ -1926,6 +1657,14 @@ echo " Bundle specific VOIs gen " | tee -a ${prep_log2}
 
 declare -a dotdones
 
+# make_VOIs lists the VOI sets here, the MNI warps and .done files follow once they are made
+VOIs_spec="${tmpo_d}/VOIs_spec_${d}.txt"
+: > ${VOIs_spec}
+
+declare -a VOIs_2MNI
+
+declare -a VOIs_dones
+
 declare -a srch_dotdones
 
 # parallelization
@@ -4828,8 +4567,6 @@ for q in ${!tck_list[@]}; do
 
             fi
 
-            sleep 5
-
         else
 
             echo ""
@@ -4850,6 +4587,43 @@ for q in ${!tck_list[@]}; do
 
 done
 
+# all VOI maps from one read of every label map
+
+if [[ -s ${VOIs_spec} ]]; then
+
+    task_in="KUL_FWT_VOIengine.py -m maps -i ${VOIs_spec}"
+
+    task_exec
+
+    qs=0;
+
+    for vm in ${!VOIs_2MNI[@]}; do
+
+        ((qs++))
+        ((qs=${qs}%${qo}))
+
+        task_in="${VOIs_2MNI[$vm]}"
+
+        task_exec &
+
+        if [[ ${qs} == 0 ]]; then
+
+            wait
+
+        fi
+
+    done
+
+    wait
+
+    for vd in ${VOIs_dones[@]}; do
+
+        echo "${vd}_VOIs done" >> "${ROIs_d}/${vd}_VOIs.done"
+
+    done
+
+fi
+
 
 # dotdones[$q]="${ROIs_d}/${tck_list[$q]}_VOIs.done"
 
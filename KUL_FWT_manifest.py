@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Content hash manifests for the python stages of KUL_FWT, so reruns only redo what changed
+# Every stage run records the sha1 of its inputs, its parameters and the sha1 of the outputs it
+# wrote, in <output dir>/.KUL_FWT_manifest/<stage>_<key>.json. A stage is up to date when all
+# outputs are still there and unchanged, and inputs and parameters hash the same as last time.
+# Outputs of one stage are the inputs of the next, so a changed VOI only invalidates what is
+# downstream of it. Files whose size and mtime match the record are not hashed again. Subject wide
+# images that every bundle reads (metric maps, templates) can be recorded by size and mtime only
+# (stat_only), else the first run of each bundle would hash all of them again.
+# KUL_FWT_FORCE=1 in the environment recomputes everything.
+# Usage as a script lists the records in a dir and whether they are up to date.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, glob, json, hashlib
+
+# bump this whenever the layout of a record changes
+MANIFEST_VERSION = 1
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# sha1 of a file, taken from the old record when size and mtime did not change
+def _file_entry(path, old=None, stat_only=False):
+    st = os.stat(path)
+    if old and old.get('size') == st.st_size and old.get('mtime_ns') == st.st_mtime_ns:
+        return old
+    if stat_only:
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return {'sha1': file_hash(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+# same size and mtime as recorded, or else the same sha1, files recorded without one go by stat alone
+def _unchanged(path, old):
+    if not os.path.isfile(path):
+        return False
+    st = os.stat(path)
+    if old.get('size') == st.st_size and old.get('mtime_ns') == st.st_mtime_ns:
+        return True
+    return 'sha1' in old and file_hash(path) == old['sha1']
+
+
+# stages that only write to a store have no output files, their record goes next to their first input
+def _record_file(stage, outputs, inputs=()):
+    out0 = os.path.abspath((list(outputs) or list(inputs))[0])
+    key = hashlib.sha1(out0.encode()).hexdigest()[:8]
+    return os.path.join(os.path.dirname(out0), '.KUL_FWT_manifest', stage + '_' + key + '.json')
+
+
+def _load_record(rfile):
+    try:
+        with open(rfile) as f:
+            rec = json.load(f)
+        if rec.get('version') == MANIFEST_VERSION:
+            return rec
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _same_files(paths, old):
+    if sorted(os.path.abspath(p) for p in paths) != sorted(old):
+        return False
+    return all(_unchanged(p, old[os.path.abspath(p)]) for p in paths)
+
+
+# params go through json, so tuples and lists compare equal
+def _params(params):
+    return json.loads(json.dumps(params or {}, sort_keys=True))
+
+
+# True when the stage can be skipped
+def up_to_date(stage, inputs, params, outputs):
+    if os.environ.get('KUL_FWT_FORCE', '0') not in ('', '0'):
+        return False
+    rec = _load_record(_record_file(stage, outputs, inputs))
+    if rec is None or rec['params'] != _params(params):
+        return False
+    if not _same_files(outputs, rec['outputs']) or not _same_files(inputs, rec['inputs']):
+        return False
+    print ('%s is up to date for "%s", skipping' % (stage, (list(outputs) or list(inputs))[0]))
+    return True
+
+
+# call after the stage wrote its outputs, inputs in stat_only are recorded without their sha1
+def record(stage, inputs, params, outputs, stat_only=()):
+    rfile = _record_file(stage, outputs, inputs)
+    old = _load_record(rfile) or {'inputs': {}, 'outputs': {}}
+    stat_only = set(os.path.abspath(p) for p in stat_only)
+    rec = {'version': MANIFEST_VERSION, 'stage': stage, 'params': _params(params),
+           'inputs': {os.path.abspath(p): _file_entry(p, old['inputs'].get(os.path.abspath(p)), os.path.abspath(p) in stat_only)
+                      for p in inputs},
+           'outputs': {os.path.abspath(p): _file_entry(p) for p in outputs if os.path.isfile(p)}}
+    try:
+        os.makedirs(os.path.dirname(rfile), exist_ok=True)
+        tmp = '%s.%d.tmp' % (rfile, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(rec, f, indent=1)
+        os.replace(tmp, rfile)
+    except OSError:
+        # no record then, the stage simply runs again next time
+        pass
+
+
+def main(argv):
+    odir = ''
+    try:
+        opts, args = getopt.getopt(argv,"hd:",["odir="])
+    except getopt.GetoptError:
+        print ('KUL_FWT_manifest.py -d <output_dir>')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('KUL_FWT_manifest.py -d <output_dir>')
+            sys.exit()
+        elif opt in ("-d", "--odir"):
+            odir = arg
+    print ('Output dir is "', odir)
+
+    for rfile in sorted(glob.glob(os.path.join(odir, '**', '.KUL_FWT_manifest', '*.json'), recursive=True)):
+        rec = _load_record(rfile)
+        if rec is None:
+            continue
+        outputs = list(rec['outputs'])
+        ok = outputs and _same_files(outputs, rec['outputs']) and _same_files(list(rec['inputs']), rec['inputs'])
+        print ('%-10s %-8s %s' % (rec['stage'], 'ok' if ok else 'stale', outputs[0] if outputs else rfile))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
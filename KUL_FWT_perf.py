@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Stage timing and memory log of the KUL_FWT python tools
+# task_exec in make_TCKs.sh only logs when a task started and finished. The python tools now wrap
+# their stages (load, FBC, reorientation, profiling, fingerprint, rendering, ..) in stage(), which
+# appends one json line per stage to KUL_FWT_perf.jsonl in the bundle's <bundle>_output dir (or
+# next to the file the stage works on): tool, stage, wall and cpu time (children included), peak
+# RSS while the stage ran, and the streamline and point counts the stage reports.
+# The peak RSS is the high water mark of the process (VmHWM), reset when a stage starts, so it is
+# the stage's own peak. Where it cannot be reset (not linux) the record has rss_scope 'process'
+# and the peak is that of the process so far. Child processes that ended during the stage report
+# their largest peak as children_peak_rss_mb.
+# The log is off by default, KUL_FWT_PERF=1 in the environment turns it on.
+# As a script, it sums the logs under a dir per stage (-d), or per bundle and stage (-b).
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, glob, json, time, resource, fcntl, socket, threading
+from contextlib import contextmanager
+
+LOG_NAME = 'KUL_FWT_perf.jsonl'
+
+# peak RSS so far of every stage that is running, nested stages and stages in threads share the
+# high water mark of the process, every reset first passes the old mark on to all of them
+_open = []
+_open_lock = threading.Lock()
+
+
+def enabled():
+    return os.environ.get('KUL_FWT_PERF', '0') not in ('', '0')
+
+
+# <subj>_TCKs_output/<bundle>_output of a path, or the dir of the path outside of a bundle
+def bundle_dir(path):
+    d = os.path.dirname(os.path.abspath(path))
+    p = d
+    for i in range(4):
+        parent = os.path.dirname(p)
+        if os.path.basename(p).endswith('_output') and os.path.basename(parent).endswith('_TCKs_output'):
+            return p
+        p = parent
+    return d
+
+
+# cpu time of the process and its children, and the largest peak RSS of the children, in MB
+def _usage():
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kB on linux
+    return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime, c.ru_maxrss / 1024.
+
+
+# high water mark of the process RSS in MB
+def _hwm():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _reset_hwm():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# pass the current mark on to every open stage, then start a new one if possible
+def _peak_reset():
+    with _open_lock:
+        cur = _hwm()
+        for peak in _open:
+            peak[0] = max(peak[0], cur)
+        return _reset_hwm()
+
+
+def _append(log_f, rec):
+    try:
+        with open(log_f, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(rec) + '\n')
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except OSError:
+        # no log then, the stage itself is fine
+        pass
+
+
+# with stage('fbc', outputfile, streamlines=n) as rec: ...
+# counts can also be set on rec inside the block, timings are added to rec when it ends
+# path None only measures, nothing is written
+@contextmanager
+def stage(name, path=None, **counts):
+    rec = dict(counts)
+    start = time.strftime('%Y-%m-%dT%H:%M:%S')
+    cpu0, c_rss0 = _usage()
+    peak = [0.]
+    scope = 'stage' if _peak_reset() else 'process'
+    with _open_lock:
+        _open.append(peak)
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        yield rec
+        ok = True
+    finally:
+        wall = time.perf_counter() - t0
+        cpu1, c_rss1 = _usage()
+        with _open_lock:
+            peak[0] = max(peak[0], _hwm())
+            _open.remove(peak)
+        rec.update(wall_s=round(wall, 4), cpu_s=round(cpu1 - cpu0, 4), peak_rss_mb=round(peak[0], 1), rss_scope=scope)
+        if c_rss1 > c_rss0:
+            rec['children_peak_rss_mb'] = round(c_rss1, 1)
+        if path is not None and enabled():
+            b_dir = bundle_dir(path)
+            entry = {'tool': os.path.basename(sys.argv[0]), 'stage': name, 'bundle': os.path.basename(b_dir)[:-len('_output')]
+                     if b_dir.endswith('_output') else '', 'file': os.path.abspath(path), 'start': start, 'ok': ok,
+                     'host': socket.gethostname(), 'pid': os.getpid()}
+            entry.update(rec)
+            _append(os.path.join(b_dir, LOG_NAME), entry)
+
+
+# streamline and point counts of a flat bundle
+def counts(lens):
+    return {'streamlines': int(len(lens)), 'points': int(sum(lens))}
+
+
+def read_logs(log_d):
+    recs = []
+    for log_f in sorted(glob.glob(os.path.join(log_d, '**', LOG_NAME), recursive=True)):
+        with open(log_f) as f:
+            for line in f:
+                try:
+                    recs.append(json.loads(line))
+                except ValueError:
+                    continue
+    return recs
+
+
+def main(argv):
+    log_d = ''
+    by_bundle = False
+    out_f = ''
+    usage = 'KUL_FWT_perf.py -d <dir> [-b] [-o <out.csv>]'
+    try:
+        opts, args = getopt.getopt(argv,"hd:bo:",["dir=","by_bundle","ofile="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-d", "--dir"):
+            log_d = arg
+        elif opt in ("-b", "--by_bundle"):
+            by_bundle = True
+        elif opt in ("-o", "--ofile"):
+            out_f = arg
+    print ('Log dir is "', log_d)
+
+    # totals per stage, or per bundle and stage
+    tot = {}
+    for rec in read_logs(log_d):
+        key = (rec.get('bundle', '') if by_bundle else '', rec['tool'], rec['stage'])
+        t = tot.setdefault(key, {'n': 0, 'wall_s': 0., 'cpu_s': 0., 'peak_rss_mb': 0., 'streamlines': 0, 'points': 0, 'failed': 0})
+        t['n'] += 1
+        t['failed'] += not rec.get('ok', True)
+        for k in ('wall_s', 'cpu_s', 'streamlines', 'points'):
+            t[k] += rec.get(k, 0)
+        t['peak_rss_mb'] = max(t['peak_rss_mb'], rec.get('peak_rss_mb', 0))
+
+    rows = sorted(tot.items(), key=lambda kv: -kv[1]['wall_s'])
+    cols = ('n', 'wall_s', 'cpu_s', 'peak_rss_mb', 'streamlines', 'points', 'failed')
+    for (bundle, tool, st), t in rows:
+        print ('%-16s %-26s %-12s %5d runs  wall %9.1f s  cpu %9.1f s  peak %7.0f MB  %d streamlines%s'
+               % (bundle, tool, st, t['n'], t['wall_s'], t['cpu_s'], t['peak_rss_mb'], t['streamlines'],
+                  ', %d failed' % t['failed'] if t['failed'] else ''))
+    if out_f:
+        with open(out_f, 'w') as f:
+            f.write('bundle,tool,stage,' + ','.join(cols) + '\n')
+            for (bundle, tool, st), t in rows:
+                f.write('%s,%s,%s,' % (bundle, tool, st) + ','.join('%g' % t[c] for c in cols) + '\n')
+        print ('Summary written to "', out_f)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
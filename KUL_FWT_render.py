@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Figure rendering for the QC steps of KUL_FWT
+# KUL_FWT_SCs_TCKs.py, KUL_FWT_TCKsm_cap.py and KUL_FWT_TCKsQQ.py used to draw their figures
+# themselves, one after the other inside the chain of every bundle. They now hand a job to submit:
+#  - by default the job is rendered right away, as before
+#  - with KUL_FWT_RENDER_QUEUE=<file> in the environment the job is appended to that queue, and
+#    the queue is rendered later over a pool of processes (KUL_FWT_render.py -q <file> -n <nproc>),
+#    with nilearn and matplotlib imported once and every image loaded once per worker
+# A job is skipped when its inputs and parameters hash the same as for the existing figures,
+# see KUL_FWT_manifest.py. Renders of one queue take turns, and the jobs of a render that died
+# (its <queue>.<pid>.running file is left behind) are done by the next one.
+# KUL_FWT_RENDER_DPI=<dpi> renders quick previews at a lower resolution (default is 300), and
+# KUL_FWT_RENDER_MERGE=1 draws the inclusion VOIs as one merged overlay, one contour pass instead
+# of one per VOI (touching VOIs then share an outline).
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, glob, json, time, fcntl, traceback
+import multiprocessing as mp
+import numpy as np
+import KUL_FWT_imcache as kimc
+import KUL_FWT_manifest as kman
+import KUL_FWT_perf as kperf
+
+DPI = 300
+
+
+def queue_file():
+    return os.environ.get('KUL_FWT_RENDER_QUEUE', '') or None
+
+
+def render_dpi():
+    return int(os.environ.get('KUL_FWT_RENDER_DPI', '') or DPI)
+
+
+def merge_vois():
+    return os.environ.get('KUL_FWT_RENDER_MERGE', '0') not in ('', '0')
+
+
+# headless plotting stack, imported once per process, nilearn only for the glass brains
+def preload(nilearn=False):
+    import matplotlib
+    if 'MPLBACKEND' not in os.environ:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot
+    if nilearn:
+        from nilearn import plotting
+
+
+# a job is a dict with its kind, inputs (files), outs (figures), title and kind specific entries
+# kinds are glass_vois (tdi map, with and without inclusion VOIs), segments, profile and matrix
+def submit(job):
+    job = dict(job, dpi=render_dpi(), merge=merge_vois())
+    queue_f = queue_file()
+    if queue_f is None:
+        return render(job)
+    with open(queue_f, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(job) + '\n')
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return True
+
+
+def _params(job):
+    return {k: v for k, v in job.items() if k not in ('inputs', 'outs')}
+
+
+def _glass_vois(job):
+    from nilearn import plotting
+    tckm_im = kimc.load_img(job['inputs'][0])
+    incs = job['inputs'][1:]
+    # the same display takes the VOI contours once the plain one is saved
+    gbd = plotting.plot_glass_brain(tckm_im, title=job['title'], display_mode='lyrz', cmap='cool')
+    gbd.savefig(job['outs'][0], dpi=job['dpi'])
+    if incs and job['merge']:
+        import nibabel as nib
+        vois = kimc.load_img(incs[0])
+        union = np.asarray(vois.dataobj) > 0
+        for el in incs[1:]:
+            union = union | (kimc.load_nifti_data(el) > 0)
+        gbd.add_contours(nib.Nifti1Image(union.astype(np.uint8), vois.affine), levels=[0.5], colors='gold', linewidths=0.75)
+    else:
+        for el in incs:
+            gbd.add_contours(kimc.load_img(el), colors='gold', linewidths=0.75)
+    gbd.savefig(job['outs'][1], dpi=job['dpi'])
+    gbd.close()
+
+
+def _segments(job):
+    from nilearn import plotting
+    tckm_im = kimc.load_img(job['inputs'][0])
+    maps_glass = plotting.plot_glass_brain(tckm_im, title=job['title'], display_mode='lyrz', cmap='hsv', plot_abs=True,
+                                           threshold=0.05, vmin=0.05, vmax=100, colorbar=True)
+    maps_glass.savefig(job['outs'][0], dpi=job['dpi'])
+    maps_glass.close()
+
+
+def _profile(job):
+    import matplotlib.pyplot as plt
+    fig, (ax1) = plt.subplots(1,1)
+    ax1.plot(job['values'])
+    ax1.set_ylabel(job['ylabel'])
+    ax1.set_xlabel('Node along bundle')
+    ax1.ticklabel_format(axis="y", style="sci", scilimits=(0,0))
+    plt.title(job['title'])
+    plt.tight_layout()
+    fig.savefig(job['outs'][0], bbox_inches='')
+    plt.close(fig)
+
+
+# log of the sparse fingerprint saved by KUL_FWT_fingerprint.py
+def _matrix(job):
+    import matplotlib.pyplot as plt
+    from scipy import sparse
+    M = sparse.load_npz(job['inputs'][0])
+    conn_FP = plt.imshow(np.log1p(M.toarray()), interpolation='nearest')
+    conn_FP.figure.savefig(job['outs'][0], dpi=job['dpi'])
+    plt.close()
+
+
+KINDS = {'glass_vois': _glass_vois, 'segments': _segments, 'profile': _profile, 'matrix': _matrix}
+
+
+def render(job):
+    if kman.up_to_date('render_' + job['kind'], job['inputs'], _params(job), job['outs']):
+        return True
+    preload()
+    with kperf.stage('render', job['outs'][0], kind=job['kind'], dpi=job['dpi']):
+        KINDS[job['kind']](job)
+    kman.record('render_' + job['kind'], job['inputs'], _params(job), job['outs'])
+    return True
+
+
+# status of one job in a pool, a failing job does not stop the others
+def render_job(job):
+    try:
+        render(job)
+        return 'done'
+    except Exception:
+        traceback.print_exc()
+        return 'failed'
+
+
+# render all jobs queued so far, jobs queued meanwhile stay for the next run
+def render_queue(queue_f, nproc=1):
+    if not os.path.isfile(queue_f) and not glob.glob(queue_f + '.*.running'):
+        return 0, 0
+    with open(queue_f + '.lock', 'a') as lock:
+        # one render of a queue at a time, so any running file found here was left by one that died
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        run_fs = sorted(glob.glob(queue_f + '.*.running'), key=os.path.getmtime)
+        run_f = '%s.%d.running' % (queue_f, os.getpid())
+        try:
+            os.replace(queue_f, run_f)
+            run_fs.append(run_f)
+        except FileNotFoundError:
+            pass
+        jobs = {}
+        for rf in run_fs:
+            with open(rf) as f:
+                for line in f:
+                    if line.strip():
+                        job = json.loads(line)
+                        # a figure queued twice is rendered once, from the last job
+                        jobs[tuple(job['outs'])] = job
+        # jobs on the same image next to each other, so one worker tends to get them
+        jobs = sorted(jobs.values(), key=lambda j: (j['inputs'][:1], j['kind']))
+
+        status = []
+        if jobs:
+            preload(any(j['kind'] in ('glass_vois', 'segments') for j in jobs))
+            if nproc > 1 and len(jobs) > 1:
+                with mp.Pool(min(nproc, len(jobs))) as pool:
+                    status = list(pool.imap_unordered(render_job, jobs, chunksize=max(1, len(jobs) // (4 * nproc))))
+            else:
+                status = [render_job(job) for job in jobs]
+        for rf in run_fs:
+            os.remove(rf)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return len(jobs), status.count('failed')
+
+
+def main(argv):
+    queue_f = ''
+    nproc = 1
+    usage = 'KUL_FWT_render.py -q <queue_file> [-n <nproc>]'
+    try:
+        opts, args = getopt.getopt(argv,"hq:n:",["queue=","nproc="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-q", "--queue"):
+            queue_f = arg
+        elif opt in ("-n", "--nproc"):
+            nproc = int(arg)
+    print ('Queue is "', queue_f)
+
+    t0 = time.time()
+    n_jobs, n_failed = render_queue(queue_f, nproc)
+    print ('%d figure jobs in %.1f s, %d failed' % (n_jobs, time.time() - t0, n_failed))
+    if n_failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
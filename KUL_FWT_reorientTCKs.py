@@ -3,20 +3,12 @@
 # A small python script to reorient a TCK bundle and its centroid based on VOIs
 # AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
 
-import nibabel as nib
 import numpy as np
 import os, sys, getopt, glob
-import scipy
-import dipy
-import dipy.stats.analysis as dsa
-import dipy.tracking.streamline as dts
-from dipy.tracking import utils
-from dipy.io.image import load_nifti, load_nifti_data, save_nifti
-from dipy.io.stateful_tractogram import Space, StatefulTractogram
-from dipy.io.streamline import load_tractogram, save_tractogram
-import dipy.data as dpd
-import pkgutil
-from dipy.io.utils import create_nifti_header, get_reference_info
+import KUL_FWT_imcache as kimc
+import KUL_FWT_manifest as kman
+import KUL_FWT_perf as kperf
+import KUL_FWT_tckio as ktio
 
 # import matplotlib
 # import csv
@@ -34,36 +26,71 @@ from dipy.io.utils import create_nifti_header, get_reference_info
 # voi2 = '/media/rad/Data/DF_final/sub-DF_KUL_WBTCK_Seg_output/sub-DF_VOIs/CST_LT_VOIs_inMNI/CST_LT_incs2_map_inMNI.nii.gz'
 # mdir = '/media/rad/Data/DF_final/sub-DF_KUL_WBTCK_Seg_output/sub-DF_prep'
 
-def main(argv):
-    inf1 = ''
-    inf2 = ''
-    mdir = ''
-    voi1 = ''
-    voi2 = ''
-    try:
-        opts, args = getopt.getopt(argv,"hi:c:m:s:e:",["inf1=","inf2=","mdir=","voi1=","voi2="])
-    except getopt.GetoptError:
-        print ('KUL_FWT_reorientTCKs.py -i <ifile> -c <cfile> -m <mdir> -s <voi1> -e <voi2>')
-        sys.exit(2)
-    for opt, arg in opts:
-        if opt == '-h':
-            print ('KUL_FWT_reorientTCKs.py -i <ifile> -c <cfile> -m <mdir> -s <voi1> -e <voi2>')
-            sys.exit()
-        elif opt in ("-i", "--ifile"):
-            inf1 = arg
-        elif opt in ("-c", "--cfile"):
-            inf2 = arg
-        elif opt in ("-m", "--mdir"):
-            mdir = arg
-        elif opt in ("-s", "--voi1"):
-            voi1 = arg
-        elif opt in ("-e", "--voi2"):
-            voi2 = arg
-    print ('Input bundle TCK file is "', inf1)
-    print ('Input centroid TCK file is "', inf2)
-    print ('Start VOI file is  "', voi1)
-    print ('End VOI file is  "', voi2)
-    print ('Metrics folder is "', mdir)
+# streaming mode (-S)
+# orient_by_rois needs the whole bundle in memory and compares every point to every ROI voxel.
+# Instead each VOI is binarized once and turned into a distance map (mm to the nearest VOI voxel),
+# the .tck is read and written lazily, and a streamline is flipped when its end point is closer
+# to the start VOI and its first point closer to the end VOI than the other way around.
+# Only the end points of a chunk of streamlines are looked up, so memory use stays flat.
+
+# distance map of a VOI and its affine
+def roi_distance(voi):
+    from scipy.ndimage import distance_transform_edt
+    data, affine = kimc.load_nifti(voi)
+    roi = np.asarray(data) != 0
+    if not roi.any():
+        raise ValueError('VOI ' + voi + ' is empty')
+    vox_size = np.sqrt(np.sum(affine[:3, :3] ** 2, 0))
+    return distance_transform_edt(~roi, sampling=vox_size), affine
+
+
+# distance map values at world coordinates, clamped at the edges of the map
+def sample_distance(dmap, pts):
+    from scipy.ndimage import map_coordinates
+    dist, affine = dmap
+    inv = np.linalg.inv(affine)
+    vox = pts @ inv[:3, :3].T + inv[:3, 3]
+    return map_coordinates(dist, vox.T, order=1, mode='nearest')
+
+
+# which streamlines of a chunk run from the end VOI to the start VOI
+def flip_mask(chunk, dmap1, dmap2):
+    ends = np.array([[sl[0], sl[-1]] for sl in chunk], dtype=np.float64).reshape(-1, 3)
+    d1 = sample_distance(dmap1, ends).reshape(-1, 2)
+    d2 = sample_distance(dmap2, ends).reshape(-1, 2)
+    return d1[:, 1] + d2[:, 0] < d1[:, 0] + d2[:, 1]
+
+
+# reorient a .tck file into another, chunk streamlines at a time
+def stream_reorient(inf, outf, dmap1, dmap2, chunk=10000):
+    from nibabel.streamlines import TckFile
+    from nibabel.streamlines.tractogram import LazyTractogram
+
+    tck = TckFile.load(inf, lazy_load=True)
+
+    def reoriented():
+        buf = []
+        for sl in tck.streamlines:
+            buf.append(sl)
+            if len(buf) == chunk:
+                for sl_b, flip in zip(buf, flip_mask(buf, dmap1, dmap2)):
+                    yield sl_b[::-1] if flip else sl_b
+                buf = []
+        if buf:
+            for sl_b, flip in zip(buf, flip_mask(buf, dmap1, dmap2)):
+                yield sl_b[::-1] if flip else sl_b
+
+    # keep the header of the input, the count is written by nibabel
+    hdr = {k: v for k, v in tck.header.items() if k not in ('count', 'nb_streamlines', '_offset_data')}
+    TckFile(LazyTractogram(reoriented, affine_to_rasmm=np.eye(4)), header=hdr).save(outf)
+
+
+def reorient_bundle(inf1, inf2, mdir, voi1, voi2, stream=False, chunk=10000):
+    # dipy is only imported when a bundle is reoriented
+    import nibabel as nib
+    import dipy.tracking.streamline as dts
+    from dipy.io.stateful_tractogram import Space, StatefulTractogram
+    from dipy.io.streamline import load_tractogram, save_tractogram
 
     # sanity checks
     if os.path.isfile(inf1):
@@ -71,19 +98,6 @@ def main(argv):
             if os.path.isfile(voi1):
                 if os.path.isfile(voi2):
                     if os.path.isdir(mdir):
-                        # define metric images
-                        refff = glob.glob(os.path.join(mdir, 'FS_2_UKBB_*_Warped.nii.gz'))[0]
-
-                        # for refff we should load FS warped to MNI from prep dir
-                        reff = nib.load(refff)
-                        tckv1 = nib.load(voi1)
-                        tckv2 = nib.load(voi2)
-
-                        # binarize on the fly
-                        tckv1.get_fdata()[tckv1.get_fdata()>1] = 1
-                        tckv2.get_fdata()[tckv2.get_fdata()>1] = 1
-
-                        # get name of input ??
                         # get paths and names
                         in_path, _ = os.path.split(inf1)
                         in_nr = str.rsplit((str.split(inf1, '/')[-1]), '_',2)
@@ -95,17 +109,53 @@ def main(argv):
                         outf1 = os.path.join(o_dir, (in_nr[0]) + '_inMNI_rTCK.tck')
                         outf2 = os.path.join(o_dir, (in_nr[0]) + '_inMNI_centroid_rTCK.tck')
 
+                        # the non-streaming path writes its outputs in the space of the subject's FS_2_UKBB image
+                        refff = None if stream else glob.glob(os.path.join(mdir, 'FS_2_UKBB_*_Warped.nii.gz'))[0]
+
+                        # nothing to do if neither the bundles, the VOIs nor the reference changed
+                        # the reference is shared by all bundles, it is recorded by size and mtime
+                        m_in = [inf1, inf2, voi1, voi2] + ([refff] if refff else [])
+                        m_out = [outf1, outf2]
+                        if kman.up_to_date('reorient', m_in, {'stream': stream}, m_out):
+                            return True
+
+                        if stream:
+                            with kperf.stage('reorient', outf1, stream=True):
+                                dmap1 = roi_distance(voi1)
+                                dmap2 = roi_distance(voi2)
+                                stream_reorient(inf1, outf1, dmap1, dmap2, chunk)
+                                stream_reorient(inf2, outf2, dmap1, dmap2, chunk)
+                            kman.record('reorient', m_in, {'stream': stream}, m_out)
+                            return True
+
+                        # for refff we should load FS warped to MNI from prep dir
+                        # only its header is used, so no need to decompress it
+                        reff = nib.load(refff)
+                        # VOI data comes from the image cache
+                        tckv1 = kimc.load_nifti_data(voi1)
+                        tckv2 = kimc.load_nifti_data(voi2)
+
+                        # binarize on the fly
+                        tckv1 = np.minimum(tckv1, 1)
+                        tckv2 = np.minimum(tckv2, 1)
+
                         # load the input tractogram centroid
-                        tck_in = load_tractogram(inf1, reff, bbox_valid_check=False).streamlines
-                        tck_cent = load_tractogram(inf2, reff, bbox_valid_check=False).streamlines
+                        with kperf.stage('load', outf1) as rec:
+                            tck_in = load_tractogram(inf1, reff, bbox_valid_check=False).streamlines
+                            tck_cent = load_tractogram(inf2, reff, bbox_valid_check=False).streamlines
+                            rec.update(kperf.counts(ktio.lengths(tck_in)))
 
-                        reor_tck = dts.orient_by_rois(tck_in, (reff.affine), (tckv1.get_fdata()), (tckv2.get_fdata()), in_place=False, as_generator=False)
-                        reor_c = dts.orient_by_rois(tck_cent, (reff.affine), (tckv1.get_fdata()), (tckv2.get_fdata()), in_place=False, as_generator=False)
+                        with kperf.stage('reorient', outf1, stream=False, **kperf.counts(ktio.lengths(tck_in))):
+                            reor_tck = dts.orient_by_rois(tck_in, (reff.affine), tckv1, tckv2, in_place=False, as_generator=False)
+                            reor_c = dts.orient_by_rois(tck_cent, (reff.affine), tckv1, tckv2, in_place=False, as_generator=False)
 
                         reor_c_out = StatefulTractogram(reor_c, reff, Space.RASMM)
                         reor_TCK_out = StatefulTractogram(reor_tck, reff, Space.RASMM)
                         save_tractogram(reor_TCK_out, outf1, bbox_valid_check=False)
                         save_tractogram(reor_c_out, outf2, bbox_valid_check=False)
+                        kman.record('reorient', m_in, {'stream': stream}, m_out, stat_only=[refff])
+
+                        return True
 
                         # reor_tck = dts.orient_by_streamline(tck_in, reor_tckc, n_points=100, in_place=False, as_generator=False)
 
@@ -126,6 +176,49 @@ def main(argv):
 
                         # reor_cent_out = StatefulTractogram(reor_tckc, reff, Space.RASMM)
                         # save_tractogram(reor_tck_out, outf1, bbox_valid_check=False)
+    return False
+
+
+def main(argv):
+    inf1 = ''
+    inf2 = ''
+    mdir = ''
+    voi1 = ''
+    voi2 = ''
+    stream = False
+    chunk = 10000
+    try:
+        opts, args = getopt.getopt(argv,"hi:c:m:s:e:Sk:",["inf1=","inf2=","mdir=","voi1=","voi2=","stream","chunk="])
+    except getopt.GetoptError:
+        print ('KUL_FWT_reorientTCKs.py -i <ifile> -c <cfile> -m <mdir> -s <voi1> -e <voi2> [-S] [-k <chunk>]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('KUL_FWT_reorientTCKs.py -i <ifile> -c <cfile> -m <mdir> -s <voi1> -e <voi2> [-S] [-k <chunk>]')
+            sys.exit()
+        elif opt in ("-i", "--ifile"):
+            inf1 = arg
+        elif opt in ("-c", "--cfile"):
+            inf2 = arg
+        elif opt in ("-m", "--mdir"):
+            mdir = arg
+        elif opt in ("-s", "--voi1"):
+            voi1 = arg
+        elif opt in ("-e", "--voi2"):
+            voi2 = arg
+        elif opt in ("-S", "--stream"):
+            stream = True
+        elif opt in ("-k", "--chunk"):
+            chunk = int(arg)
+    print ('Input bundle TCK file is "', inf1)
+    print ('Input centroid TCK file is "', inf2)
+    print ('Start VOI file is  "', voi1)
+    print ('End VOI file is  "', voi2)
+    print ('Metrics folder is "', mdir)
+    if stream:
+        print ('Streaming in chunks of "', chunk)
+
+    reorient_bundle(inf1, inf2, mdir, voi1, voi2, stream, chunk)
 
 
 if __name__ == "__main__":
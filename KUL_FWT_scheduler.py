@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Dependency graph scheduler for the bundle steps of KUL_FWT_make_TCKs.sh
+# task_exec ran every command one after the other with a fixed sleep in between, so the bundles of
+# the config file were done one at a time even though they don't depend on each other.
+# Tasks come from a text file, one per line as name|deps|threads|command (deps comma separated,
+# lines with a # are skipped). A task starts as soon as all its deps are done and its threads fit
+# in the -n budget, so multi-threaded mrtrix steps and single threaded python steps share the cpus.
+# Real start and end times and exit status are logged per task, the output of every task goes to
+# <out_dir>/<task>_log.txt. After a failure no new tasks are started (-k starts the ones that
+# don't depend on the failed task) and the exit code is 1.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, time, subprocess, threading, queue
+
+
+def read_tasks(task_f):
+    tasks = []
+    with open(task_f) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            # the command itself may contain a |
+            name, deps, threads, cmd = line.split('|', 3)
+            tasks.append({'name': name.strip(), 'deps': [d.strip() for d in deps.split(',') if d.strip()],
+                          'threads': int(threads or 1), 'cmd': cmd.strip()})
+    return tasks
+
+
+# unknown deps and cycles would leave tasks waiting forever
+def check_graph(tasks):
+    names = [t['name'] for t in tasks]
+    if len(set(names)) != len(names):
+        raise ValueError('task names are not unique')
+    deps = {t['name']: t['deps'] for t in tasks}
+    for name in names:
+        for d in deps[name]:
+            if d not in deps:
+                raise ValueError('task %s depends on unknown task %s' % (name, d))
+    done = set()
+    while len(done) < len(names):
+        ready = [n for n in names if n not in done and all(d in done for d in deps[n])]
+        if not ready:
+            raise ValueError('tasks have circular dependencies: ' + ','.join(n for n in names if n not in done))
+        done.update(ready)
+
+
+def _now():
+    return time.strftime('%Y-%m-%d_%H-%M-%S')
+
+
+def _start(task, threads, out_d):
+    env = dict(os.environ)
+    # ants and openmp would otherwise take all cores
+    for var in ('KUL_FWT_NTHREADS', 'MRTRIX_NTHREADS', 'OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'):
+        env[var] = str(threads)
+    out = None
+    if out_d:
+        out = open(os.path.join(out_d, task['name'] + '_log.txt'), 'a')
+    p = subprocess.Popen(task['cmd'], shell=True, executable='/bin/bash', env=env,
+                         stdout=out, stderr=subprocess.STDOUT if out else None)
+    if out:
+        out.close()
+    return p
+
+
+# run the tasks within ncpu threads
+# returns {task name: 'done', 'failed' or 'cancelled'} and {task name: (start, end, exit status)}
+def run_tasks(tasks, ncpu, out_d=None, keep_going=False):
+    check_graph(tasks)
+    if out_d:
+        os.makedirs(out_d, exist_ok=True)
+    status = {}
+    times = {}
+    pending = list(tasks)
+    running = {}
+    used = 0
+    stop = False
+    # one waiter thread per task reports back here, the loop blocks on it instead of polling
+    finished = queue.Queue()
+
+    def waiter(name, p):
+        finished.put((name, p.wait()))
+
+    try:
+        while pending or running:
+            # tasks whose deps failed or were cancelled will never run
+            for task in list(pending):
+                if stop or any(status.get(d) in ('failed', 'cancelled') for d in task['deps']):
+                    status[task['name']] = 'cancelled'
+                    print ('%s cancelled' % task['name'])
+                    pending.remove(task)
+            # in file order, smaller tasks fill up threads a bigger one can't use yet
+            for task in list(pending):
+                threads = min(task['threads'], ncpu)
+                if used + threads > ncpu or not all(status.get(d) == 'done' for d in task['deps']):
+                    continue
+                p = _start(task, threads, out_d)
+                running[task['name']] = (p, threads, time.time())
+                used += threads
+                pending.remove(task)
+                print ('-------------------------------------------------------------')
+                print ('%s: %s' % (task['name'], task['cmd']))
+                print (' Started @ %s with %d threads, pid = %d' % (_now(), threads, p.pid))
+                sys.stdout.flush()
+                threading.Thread(target=waiter, args=(task['name'], p), daemon=True).start()
+            if not running:
+                break
+            name, rc = finished.get()
+            p, threads, t0 = running.pop(name)
+            used -= threads
+            status[name] = 'done' if rc == 0 else 'failed'
+            times[name] = (t0, time.time(), rc)
+            print (' %s finished @ %s, exit status %d (%.1f s)' % (name, _now(), rc, time.time() - t0))
+            sys.stdout.flush()
+            if rc != 0 and not keep_going:
+                print ('%s failed, no new tasks are started' % name)
+                stop = True
+    except KeyboardInterrupt:
+        for p, threads, t0 in running.values():
+            p.terminate()
+        raise
+    return status, times
+
+
+def main(argv):
+    task_f = ''
+    ncpu = 6
+    out_d = ''
+    keep_going = False
+    usage = 'KUL_FWT_scheduler.py -i <task_file> [-n <ncpu>] [-o <out_dir>] [-k]'
+    try:
+        opts, args = getopt.getopt(argv,"hi:n:o:k",["ifile=","ncpu=","odir=","keep_going"])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            print ('task file lines are name|deps|threads|command')
+            sys.exit()
+        elif opt in ("-i", "--ifile"):
+            task_f = arg
+        elif opt in ("-n", "--ncpu"):
+            ncpu = int(arg)
+        elif opt in ("-o", "--odir"):
+            out_d = arg
+        elif opt in ("-k", "--keep_going"):
+            keep_going = True
+    print ('Task file is "', task_f)
+    print ('Number of threads is "', ncpu)
+
+    if not os.path.isfile(task_f):
+        print ('Task file not found, exitting')
+        sys.exit(2)
+    tasks = read_tasks(task_f)
+    try:
+        check_graph(tasks)
+    except ValueError as e:
+        print (e)
+        sys.exit(2)
+
+    t0 = time.time()
+    status, times = run_tasks(tasks, max(1, ncpu), out_d or None, keep_going)
+
+    # summary in task order
+    print ('-------------------------------------------------------------')
+    for task in tasks:
+        name = task['name']
+        if name in times:
+            print ('%-30s %-9s exit %d  %.1f s' % (name, status[name], times[name][2], times[name][1] - times[name][0]))
+        else:
+            print ('%-30s %s' % (name, status[name]))
+    n_bad = sum(st != 'done' for st in status.values())
+    print ('%d tasks in %.1f s, %d failed or cancelled' % (len(tasks), time.time() - t0, n_bad))
+
+    if n_bad:
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
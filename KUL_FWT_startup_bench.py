@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Startup latency of the KUL_FWT python tools
+# make_TCKs.sh starts a few hundred python processes per subject, so the time a script needs
+# before it does any work adds up. This times, each in a fresh interpreter
+#  - the import of every KUL_FWT module and of the heavy packages they use (import:<module>)
+#  - "<script> -h" for every KUL_FWT_*.py script with a CLI (imports plus argument parsing)
+#  - a minimal real call of the scripts make_TCKs.sh runs most, on a tiny synthetic bundle and
+#    images (run:<script>), so imports done lazily inside the work are timed as well.
+# The result can be saved as a baseline csv and a later run compared against it. Anything that got
+# slower than the baseline by more than the tolerance is flagged and the exit code is 1, so it can
+# run after changes to the imports.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, glob, time, json, shutil, tempfile, subprocess
+import numpy as np
+
+# third party modules the tools import, timed on their own to tell them from our own import time
+DEPS = ('numpy', 'scipy.ndimage', 'nibabel', 'dipy.tracking.streamline', 'dipy.denoise.enhancement_kernel',
+        'matplotlib.pyplot', 'nilearn.plotting', 'h5py')
+
+# streamlines in the synthetic bundle of the real calls
+N_SL = 50
+
+
+# scripts next to this one that can be called from the command line
+def find_scripts(sdir):
+    scripts = []
+    for sc in sorted(glob.glob(os.path.join(sdir, 'KUL_FWT_*.py'))):
+        if os.path.basename(sc) == os.path.basename(__file__):
+            continue
+        with open(sc) as f:
+            if '__main__' in f.read():
+                scripts.append(sc)
+    return scripts
+
+
+def find_modules(sdir):
+    return [os.path.basename(m)[:-3] for m in sorted(glob.glob(os.path.join(sdir, 'KUL_FWT_*.py')))
+            if os.path.basename(m) != os.path.basename(__file__)]
+
+
+# wall time of n runs of "python <args>", in seconds, setup (if any) runs before each and is not timed
+# a run that fails gives nan, so a broken call is not mistaken for a fast one
+def time_cmd(args, n=5, setup=None, cwd=None):
+    times = []
+    for i in range(n):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        ret = subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd)
+        times.append(time.perf_counter() - t0 if ret.returncode == 0 else np.nan)
+    return np.array(times)
+
+
+def time_startup(script, n=5):
+    return time_cmd([script, '-h'], n)
+
+
+# the module is imported from the scripts dir, as the scripts do
+def time_import(module, sdir, n=5):
+    return time_cmd(['-c', 'import ' + module], n, cwd=sdir)
+
+
+# the first call is not timed, it warms up the disk cache and fills the FBC kernel cache
+def time_real(args, setup, n=5):
+    time_cmd(args, 1, setup)
+    return time_cmd(args, n, setup)
+
+
+# tiny bundle, reference image, labels and a profile figure job in wdir
+# returns (name, script args, setup) of every real call, the setup clears the outputs of the last run
+# so the manifests do not skip the work
+def real_calls(sdir, wdir):
+    sys.path.insert(0, sdir)
+    import KUL_FWT_synth as ksynth
+    import KUL_FWT_tckio as ktio
+
+    tck = os.path.join(wdir, 'tiny.tck')
+    ktio.write_tck(tck, *ksynth.synth_bundle(N_SL, 0))
+    ref = os.path.join(wdir, 'ref.nii.gz')
+    ksynth.save_nifti(ref, np.zeros(ksynth.SHAPE, np.float32))
+    voi1, voi2 = ksynth.synth_vois()
+    labels = os.path.join(wdir, 'labels.nii.gz')
+    ksynth.save_nifti(labels, (voi1 + 2 * voi2).astype(np.int16))
+    out_d = os.path.join(wdir, 'out')
+    queue = os.path.join(out_d, 'render_queue.jsonl')
+    job = {'kind': 'profile', 'inputs': [tck], 'outs': [os.path.join(out_d, 'tiny_FA_profile.png')],
+           'title': 'tiny FA', 'ylabel': 'FA', 'values': np.linspace(0.3, 0.6, 100).tolist(), 'dpi': 100, 'merge': False}
+
+    def clear_out():
+        shutil.rmtree(out_d, ignore_errors=True)
+        os.makedirs(out_d)
+        shutil.copy(tck, os.path.join(out_d, 'tiny.tck'))
+        with open(queue, 'w') as f:
+            f.write(json.dumps(job) + '\n')
+
+    sc = lambda name: os.path.join(sdir, name)
+    return [('run:KUL_FWT_tckio.py', [sc('KUL_FWT_tckio.py'), '-i', tck], None),
+            ('run:KUL_FWT_FBC_4TCKs.py', [sc('KUL_FWT_FBC_4TCKs.py'), '-i', tck, '-r', ref,
+                                          '-o', os.path.join(out_d, 'tiny_fbc.tck'), '-f'], clear_out),
+            ('run:KUL_FWT_fingerprint.py', [sc('KUL_FWT_fingerprint.py'), '-l', labels,
+                                            '-i', os.path.join(out_d, 'tiny.tck')], clear_out),
+            ('run:KUL_FWT_render.py', [sc('KUL_FWT_render.py'), '-q', queue], clear_out)]
+
+
+def read_baseline(bfile):
+    base = {}
+    with open(bfile) as f:
+        next(f)
+        for line in f:
+            name, median, _ = line.strip().split(',')
+            base[name] = float(median)
+    return base
+
+
+def main(argv):
+    n = 5
+    bfile = ''
+    save = False
+    # slower than baseline by this fraction plus 50 ms counts as a regression
+    tol = 0.2
+    usage = 'KUL_FWT_startup_bench.py [-n <runs>] [-b <baseline.csv>] [-w] [-t <tolerance>]'
+    try:
+        opts, args = getopt.getopt(argv,"hn:b:wt:",["runs=","baseline=","write","tol="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-n", "--runs"):
+            n = int(arg)
+        elif opt in ("-b", "--baseline"):
+            bfile = arg
+        elif opt in ("-w", "--write"):
+            save = True
+        elif opt in ("-t", "--tol"):
+            tol = float(arg)
+
+    base = read_baseline(bfile) if bfile and not save and os.path.isfile(bfile) else {}
+    sdir = os.path.dirname(os.path.abspath(__file__))
+    wdir = tempfile.mkdtemp(prefix='KUL_FWT_startup_')
+
+    # one warm up run so the first script doesn't pay for a cold disk cache
+    time_startup(os.path.abspath(__file__), 1)
+
+    cases = [('import:' + m, lambda m=m: time_import(m, sdir, n)) for m in DEPS + tuple(find_modules(sdir))]
+    cases += [(os.path.basename(sc), lambda sc=sc: time_startup(sc, n)) for sc in find_scripts(sdir)]
+    cases += [(name, lambda args=args, setup=setup: time_real(args, setup, n)) for name, args, setup in real_calls(sdir, wdir)]
+
+    rows = []
+    n_slow = 0
+    n_failed = 0
+    try:
+        for name, run in cases:
+            times = run()
+            if np.isnan(times).any():
+                print ('%-36s failed' % name)
+                n_failed += 1
+                continue
+            med = np.median(times)
+            rows.append((name, med, times.min()))
+            flag = ''
+            if name in base:
+                flag = '  (baseline %.3f s)' % base[name]
+                if med > base[name] * (1 + tol) + 0.05:
+                    flag += '  REGRESSION'
+                    n_slow += 1
+            print ('%-36s median %.3f s, min %.3f s%s' % (name, med, times.min(), flag))
+    finally:
+        shutil.rmtree(wdir, ignore_errors=True)
+
+    if save and bfile:
+        with open(bfile, 'w') as f:
+            f.write('script,median_s,min_s\n')
+            for name, med, mn in rows:
+                f.write('%s,%.4f,%.4f\n' % (name, med, mn))
+        print ('Baseline written to "', bfile)
+
+    if n_slow or n_failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+# Columnar per-subject store for the QQ outputs of KUL_FWT
+# Every bundle used to leave one small csv per metric profile, per tcksample metric, a length
+# histogram and a conn_grouping csv, so reading a cohort meant opening tens of thousands of files.
+# With KUL_FWT_STORE=1 in the environment these go into one HDF5 file per subject instead,
+# <subject TCKs output>/sub-<subj>_QQ_store.h5 (KUL_FWT_STORE=/path/file.h5 picks the file), and the
+# csv files are not written. Figures, maps, .tck and .npz outputs are not affected.
+# Each table (profiles, samples, histograms, fingerprints) is a group of chunked, gzipped columns
+# plus an index of row ranges per bundle, algorithm, method (WB/BT) and metric, so a selection only
+# reads the chunks it needs. A block that is written again with the same number of rows is
+# overwritten in place, otherwise it is appended and replaces the old one in the index. Once more than
+# DEAD_FRAC of a table's rows are such old blocks, the store is rewritten with the live rows only.
+# Writers take a lock file, bundles running in parallel can share the store.
+# As a script, it lists a store or writes a selection of one table as csv.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, fcntl
+from contextlib import contextmanager
+import numpy as np
+
+# columns of every table, on top of the index keys
+TABLES = {
+    'profiles': (('node', '<i2'), ('value', '<f4')),
+    'samples': (('streamline', '<i4'), ('node', '<i2'), ('value', '<f4')),
+    'histograms': (('length', '<i4'), ('count', '<i8')),
+    'fingerprints': (('row', '<i4'), ('col', '<i4'), ('count', '<i8')),
+}
+KEYS = ('bundle', 'algo', 'method', 'metric')
+
+# elements per chunk of a column
+CHUNK = 65536
+
+# fraction of unreferenced rows in a table that triggers a compaction of the store
+DEAD_FRAC = 0.25
+
+
+# the store of the subject a QQ dir belongs to, None when the store is not used
+# qq_d is <subject>_TCKs_output/<bundle>_output/QQ
+def store_file(qq_d):
+    val = os.environ.get('KUL_FWT_STORE', '0')
+    if val in ('', '0'):
+        return None
+    try:
+        import h5py
+    except ImportError:
+        print ('KUL_FWT_STORE is set but h5py is not installed, writing csv files')
+        return None
+    if val != '1':
+        return val
+    subj_d = os.path.dirname(os.path.dirname(os.path.abspath(qq_d)))
+    return os.path.join(subj_d, os.path.basename(subj_d).replace('_TCKs_output', '') + '_QQ_store.h5')
+
+
+# bundle, method and algorithm from <bundle>_fin_<T>_<algo>
+# the algorithm can hold an underscore itself (SD_Stream), so the method is the first field after _fin_
+def parse_name(fin):
+    bundle, sep, rest = fin.rpartition('_fin_')
+    method, sep2, algo = rest.partition('_')
+    if sep and sep2 and bundle and method and algo:
+        return bundle, method, algo
+    return fin, '', ''
+
+
+@contextmanager
+def _locked(store_f, exclusive):
+    with open(store_f + '.lock', 'a') as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def _read_index(g):
+    if 'index' not in g:
+        return {k: [] for k in KEYS + ('start', 'stop')}
+    ix = g['index']
+    idx = {k: [v.decode() if isinstance(v, bytes) else v for v in ix[k][()]] for k in KEYS}
+    idx['start'] = list(ix['start'][()])
+    idx['stop'] = list(ix['stop'][()])
+    return idx
+
+
+def _write_index(g, idx):
+    import h5py
+    if 'index' in g:
+        del g['index']
+    ix = g.create_group('index')
+    for k in KEYS:
+        ix.create_dataset(k, data=np.array(idx[k], dtype=object), dtype=h5py.string_dtype())
+    ix.create_dataset('start', data=np.array(idx['start'], dtype=np.int64))
+    ix.create_dataset('stop', data=np.array(idx['stop'], dtype=np.int64))
+
+
+def _create_columns(g, table):
+    for name, dt in TABLES[table]:
+        if name not in g:
+            g.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dt, chunks=(CHUNK,),
+                             compression='gzip', shuffle=True)
+
+
+# rows of a table, and how many of them no block references any more
+def _dead_rows(g, table, idx):
+    n_rows = g[TABLES[table][0][0]].shape[0]
+    return n_rows, n_rows - int(np.sum(np.subtract(idx['stop'], idx['start'])))
+
+
+# add one block of rows to a table, cols holds all columns of the table
+def append(store_f, table, bundle, algo, method, metric, **cols):
+    import h5py
+    key = (bundle, algo, method, metric)
+    n = len(cols[TABLES[table][0][0]])
+    with _locked(store_f, True):
+        with h5py.File(store_f, 'a') as h:
+            g = h.require_group(table)
+            _create_columns(g, table)
+            idx = _read_index(g)
+            old = [i for i in range(len(idx['start'])) if tuple(idx[k][i] for k in KEYS) == key]
+            if old and idx['stop'][old[0]] - idx['start'][old[0]] == n:
+                # same size as the block it replaces, written over it and the index stays as it is
+                start = idx['start'][old[0]]
+                for name, dt in TABLES[table]:
+                    g[name][start:start + n] = np.asarray(cols[name], dtype=dt)
+                return
+            start = g[TABLES[table][0][0]].shape[0]
+            for name, dt in TABLES[table]:
+                ds = g[name]
+                ds.resize((start + n,))
+                ds[start:] = np.asarray(cols[name], dtype=dt)
+            # the rows of an older block with the same key stay in the columns, unreferenced
+            keep = [i for i in range(len(idx['start'])) if i not in old]
+            idx = {k: [v[i] for i in keep] for k, v in idx.items()}
+            for k, v in zip(KEYS, key):
+                idx[k].append(v)
+            idx['start'].append(start)
+            idx['stop'].append(start + n)
+            _write_index(g, idx)
+            n_rows, n_dead = _dead_rows(g, table, idx)
+        if n_dead > DEAD_FRAC * n_rows:
+            _compact(store_f)
+
+
+# rewrite the store with the live rows of every table, hdf5 does not give back the space of
+# deleted or shrunk datasets, so this goes to a new file that replaces the old one
+# the caller holds the exclusive lock
+def _compact(store_f):
+    import h5py
+    tmp = '%s.%d.compact' % (store_f, os.getpid())
+    with h5py.File(store_f, 'r') as h, h5py.File(tmp, 'w') as out:
+        for table in h:
+            g = h[table]
+            idx = _read_index(g)
+            o = out.create_group(table)
+            _create_columns(o, table)
+            n = int(np.sum(np.subtract(idx['stop'], idx['start'])))
+            for name, dt in TABLES[table]:
+                o[name].resize((n,))
+            # blocks keep their order, each one is copied on its own so a large table is never read whole
+            new = {k: [] for k in idx}
+            pos = 0
+            for i in np.argsort(idx['start'], kind='stable'):
+                start, stop = idx['start'][i], idx['stop'][i]
+                for name, dt in TABLES[table]:
+                    o[name][pos:pos + stop - start] = g[name][start:stop]
+                for k in KEYS:
+                    new[k].append(idx[k][i])
+                new['start'].append(pos)
+                new['stop'].append(pos + stop - start)
+                pos += stop - start
+            _write_index(o, new)
+    os.replace(tmp, store_f)
+
+
+def _match(val, sel):
+    return sel is None or val == sel or (isinstance(sel, (list, tuple)) and val in sel)
+
+
+# index rows of a table matching the selection, each key can be a value or a list of values
+def blocks(store_f, table, bundle=None, algo=None, method=None, metric=None):
+    import h5py
+    if not os.path.isfile(store_f):
+        return []
+    sel = dict(zip(KEYS, (bundle, algo, method, metric)))
+    with _locked(store_f, False), h5py.File(store_f, 'r') as h:
+        if table not in h:
+            return []
+        idx = _read_index(h[table])
+    return [dict({k: idx[k][i] for k in KEYS}, start=int(idx['start'][i]), stop=int(idx['stop'][i]))
+            for i in range(len(idx['start'])) if all(_match(idx[k][i], sel[k]) for k in KEYS)]
+
+
+def has(store_f, table, bundle, algo, method, metric):
+    return len(blocks(store_f, table, bundle, algo, method, metric)) > 0
+
+
+# selected rows of a table as columns, the keys repeated per row
+def read(store_f, table, bundle=None, algo=None, method=None, metric=None):
+    import h5py
+    sel = blocks(store_f, table, bundle, algo, method, metric)
+    out = {k: [] for k in KEYS}
+    out.update({name: [] for name, dt in TABLES[table]})
+    if sel:
+        with _locked(store_f, False), h5py.File(store_f, 'r') as h:
+            g = h[table]
+            for b in sel:
+                for name, dt in TABLES[table]:
+                    out[name].append(g[name][b['start']:b['stop']])
+                for k in KEYS:
+                    out[k].append(np.full(b['stop'] - b['start'], b[k], dtype=object))
+    for name, dt in TABLES[table]:
+        out[name] = np.concatenate(out[name]) if sel else np.zeros(0, dtype=dt)
+    for k in KEYS:
+        out[k] = np.concatenate(out[k]) if sel else np.zeros(0, dtype=object)
+    return out
+
+
+# writers used by the QQ stages
+
+def add_profile(store_f, fin, metric, prof):
+    bundle, method, algo = parse_name(fin)
+    append(store_f, 'profiles', bundle, algo, method, metric, node=np.arange(len(prof)), value=prof)
+
+
+# vals of streamlines that all have the same number of points
+def add_samples(store_f, fin, metric, vals, n_points):
+    bundle, method, algo = parse_name(fin)
+    n_sl = len(vals) // n_points if n_points else 0
+    append(store_f, 'samples', bundle, algo, method, metric, streamline=np.repeat(np.arange(n_sl), n_points),
+           node=np.tile(np.arange(n_points), n_sl), value=vals)
+
+
+def add_histogram(store_f, fin, counts):
+    bundle, method, algo = parse_name(fin)
+    append(store_f, 'histograms', bundle, algo, method, 'length', length=np.arange(len(counts)), count=counts)
+
+
+def add_fingerprint(store_f, fin, M):
+    bundle, method, algo = parse_name(fin)
+    C = M.tocoo()
+    append(store_f, 'fingerprints', bundle, algo, method, 'conn', row=C.row, col=C.col, count=C.data)
+
+
+def main(argv):
+    store_f = ''
+    table = ''
+    sel = {}
+    out_f = ''
+    usage = 'KUL_FWT_store.py -s <store.h5> [-t <table> [-b <bundle>] [-a <algo>] [-w <WB/BT>] [-m <metric>] -o <out.csv>]'
+    try:
+        opts, args = getopt.getopt(argv,"hs:t:b:a:w:m:o:",["store=","table=","bundle=","algo=","method=","metric=","ofile="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            print ('tables are ' + ', '.join(TABLES) + ', selections take comma separated values')
+            sys.exit()
+        elif opt in ("-s", "--store"):
+            store_f = arg
+        elif opt in ("-t", "--table"):
+            table = arg
+        elif opt in ("-b", "--bundle"):
+            sel['bundle'] = arg.split(',')
+        elif opt in ("-a", "--algo"):
+            sel['algo'] = arg.split(',')
+        elif opt in ("-w", "--method"):
+            sel['method'] = arg.split(',')
+        elif opt in ("-m", "--metric"):
+            sel['metric'] = arg.split(',')
+        elif opt in ("-o", "--ofile"):
+            out_f = arg
+    print ('Store is "', store_f)
+
+    if not os.path.isfile(store_f):
+        print ('Store not found, exitting')
+        sys.exit(2)
+    if table and table not in TABLES:
+        print ('Unknown table %s, tables are %s' % (table, ', '.join(TABLES)))
+        sys.exit(2)
+
+    if table and out_f:
+        cols = read(store_f, table, **sel)
+        names = list(KEYS) + [name for name, dt in TABLES[table]]
+        with open(out_f, 'w') as f:
+            f.write(','.join(names) + '\n')
+            for row in zip(*[cols[n] for n in names]):
+                f.write(','.join(str(v) for v in row) + '\n')
+        print ('%d rows of %s written to %s' % (len(cols[KEYS[0]]), table, out_f))
+    else:
+        for t in ([table] if table else TABLES):
+            for b in blocks(store_f, t, **sel):
+                print ('%-12s %-20s %-10s %-3s %-10s %d rows' % (t, b['bundle'], b['algo'], b['method'], b['metric'], b['stop'] - b['start']))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
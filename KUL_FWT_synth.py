@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Synthetic data for the KUL_FWT benchmarks and tests
+# Bundles of curved tracts between two VOIs (half of them running the other way, 40 to 120 points
+# at ~1 mm steps), optionally with straight spurious streamlines appended after them, smooth random
+# metric maps and the two end VOIs, all on a 2 mm MNI grid. Used by KUL_FWT_bench.py,
+# KUL_FWT_startup_bench.py, KUL_FWT_fbc.py -s and the tests.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import numpy as np
+
+# 2 mm MNI grid
+SHAPE = (91, 109, 91)
+AFFINE = np.array([[2., 0, 0, -90], [0, 2., 0, -126], [0, 0, 2., -72], [0, 0, 0, 1]])
+
+# start, bend and end of the synthetic tract, in mm
+TRACT = np.array([[-20., -40, -20], [-35., -10, 5], [-20., 20, 30]])
+
+
+# flat bundle of n_sl quadratic curves between the ends of TRACT, every other one reversed
+def synth_bundle(n_sl, seed=0):
+    rng = np.random.default_rng(seed)
+    ends = TRACT[None] + rng.normal(0, [[3.], [6.], [3.]], (n_sl, 3, 3))
+    lens = rng.integers(40, 121, n_sl).astype(np.intp)
+    sl = np.repeat(np.arange(n_sl), lens)
+    offs = np.concatenate([[0], np.cumsum(lens)[:-1]]).astype(np.intp)
+    t = (np.arange(len(sl)) - offs[sl]) / (lens[sl] - 1.)
+    t = np.where(sl % 2 == 1, 1 - t, t)[:, None]
+    pts = (1 - t) ** 2 * ends[sl, 0] + 2 * (1 - t) * t * ends[sl, 1] + t ** 2 * ends[sl, 2]
+    pts += rng.normal(0, 0.2, pts.shape)
+    return pts.astype(np.float32), offs, lens
+
+
+# frac of n_sl extra streamlines for the FBC to drop: straight lines of 40 to 120 points at 1 mm,
+# from a random point of the bundle in a random direction, appended after the bundle ones
+def add_spurious(pts, offs, lens, frac=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    n = max(1, int(len(lens) * frac))
+    s_lens = rng.integers(40, 121, n).astype(np.intp)
+    dirs = rng.normal(size=(n, 3))
+    dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+    sl = np.repeat(np.arange(n), s_lens)
+    s_offs = np.concatenate([[0], np.cumsum(s_lens)[:-1]]).astype(np.intp)
+    step = np.arange(len(sl)) - s_offs[sl]
+    s_pts = pts[rng.integers(len(pts), size=n)][sl] + step[:, None] * dirs[sl]
+    return (np.concatenate([pts, s_pts.astype(np.float32)]), np.concatenate([offs, s_offs + len(pts)]),
+            np.concatenate([lens, s_lens]))
+
+
+def synth_volumes(n_metrics, seed=0):
+    from scipy.ndimage import gaussian_filter
+    rng = np.random.default_rng(seed)
+    return [gaussian_filter(rng.random(SHAPE, dtype=np.float32), 2) for m in range(n_metrics)]
+
+
+# the two end VOIs as 6 mm spheres
+def synth_vois():
+    ijk = np.indices(SHAPE).reshape(3, -1).T
+    xyz = ijk * 2. + AFFINE[:3, 3]
+    return [(np.linalg.norm(xyz - c, axis=1) < 6).reshape(SHAPE).astype(np.uint8) for c in TRACT[[0, 2]]]
+
+
+def save_nifti(fname, data):
+    import nibabel as nib
+    nib.save(nib.Nifti1Image(data, AFFINE), fname)
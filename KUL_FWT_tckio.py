@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Flat .tck reading and writing for the python stages of KUL_FWT
+# nibabel and dipy build one array per streamline when reading a .tck and go through them again to
+# write one, for every intermediate of every bundle. Here a bundle is one float32 (n_points, 3)
+# buffer with the offset and length of every streamline, read and written in one go. Stages hand
+# this on in memory, as_arraysequence hands it to dipy/nibabel code as an ArraySequence.
+# Intermediate .tck files of the stages are only written when KUL_FWT_DEBUG=1 is set.
+# As a script, it reports the number of streamlines and points of .tck files.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt
+import numpy as np
+
+_DTYPES = {'Float32LE': '<f4', 'Float32BE': '>f4', 'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+
+# True when intermediate files are wanted for debugging
+def keep_intermediates():
+    return os.environ.get('KUL_FWT_DEBUG', '0') not in ('', '0')
+
+
+# header as a list of (key, value), keys can repeat in mrtrix headers
+def read_header(fname):
+    header = []
+    with open(fname, 'rb') as f:
+        if f.readline().strip() != b'mrtrix tracks':
+            raise ValueError('"%s" is not a mrtrix tracks file' % fname)
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            header.append((key.strip(), value.strip()))
+    return header
+
+
+def _get(header, key):
+    for k, v in header:
+        if k == key:
+            return v
+    return None
+
+
+# points (float32), offsets and lengths of all streamlines, and the header
+def read_tck(fname):
+    header = read_header(fname)
+    dtype = _DTYPES[_get(header, 'datatype') or 'Float32LE']
+    offset = int(_get(header, 'file').split()[1])
+    data = np.fromfile(fname, dtype=dtype, offset=offset)
+    data = data[:len(data) // 3 * 3].reshape(-1, 3)
+    # the file ends at the first inf triplet, streamlines are separated by nan triplets
+    end = np.flatnonzero(np.isinf(data[:, 0]))
+    if len(end):
+        data = data[:end[0]]
+    delim = np.isnan(data[:, 0])
+    d_idx = np.flatnonzero(delim)
+    # a last streamline without delimiter (truncated file) is kept
+    stops = np.concatenate([d_idx, [len(data)]]) if len(data) and not delim[-1] else d_idx
+    starts = np.concatenate([[0], d_idx + 1])[:len(stops)]
+    lens = (stops - starts).astype(np.intp)
+    # point offsets once the delimiters are gone
+    offs = (starts - np.arange(len(starts))).astype(np.intp)
+    pts = np.ascontiguousarray(data[~delim], dtype=np.float32)
+    return pts, offs, lens, header
+
+
+# number of points of every streamline, ArraySequence has no public lengths
+def lengths(streamlines):
+    return np.fromiter((len(s) for s in streamlines), dtype=np.intp, count=len(streamlines))
+
+
+# same as read_tck for anything that holds streamlines (list of arrays, ArraySequence)
+def flatten(streamlines, dtype=np.float32):
+    lens = lengths(streamlines)
+    if hasattr(streamlines, 'get_data'):
+        pts = streamlines.get_data()
+    else:
+        pts = np.concatenate([np.asarray(s) for s in streamlines]) if len(lens) else np.zeros((0, 3))
+    offs = np.concatenate([[0], np.cumsum(lens)[:-1]]).astype(np.intp)
+    return np.asarray(pts, dtype=dtype).reshape(-1, 3), offs, lens
+
+
+# nibabel ArraySequence of a flat bundle, built through its public api so the points are copied once
+def as_arraysequence(pts, offs, lens):
+    from nibabel.streamlines import ArraySequence
+    return ArraySequence([pts[o:o + l] for o, l in zip(offs, lens)])
+
+
+# write a flat bundle as .tck, header entries of the input (e.g. from read_tck) are kept
+def write_tck(fname, pts, offs, lens, header=None):
+    n_sl = len(lens)
+    n_pts = int(np.sum(lens))
+    out = np.full((n_pts + n_sl + 1, 3), np.nan, dtype='<f4')
+    # every streamline moves down by the number of delimiters before it
+    sl_of_pt = np.repeat(np.arange(n_sl), lens)
+    packed = np.cumsum(lens) - lens
+    src = np.arange(n_pts) + np.repeat(np.asarray(offs) - packed, lens)
+    out[np.arange(n_pts) + sl_of_pt] = pts[src]
+    out[-1] = np.inf
+
+    lines = ['mrtrix tracks']
+    for key, value in header or []:
+        if key not in ('count', 'datatype', 'file', 'total_count'):
+            lines.append('%s: %s' % (key, value))
+    lines += ['count: %d' % n_sl, 'datatype: Float32LE']
+    head = '\n'.join(lines) + '\n'
+    # the data offset is written in the header itself
+    offset = len(head) + len('file: . \nEND\n')
+    while len(head) + len('file: . %d\nEND\n' % offset) != offset:
+        offset = len(head) + len('file: . %d\nEND\n' % offset)
+    with open(fname, 'wb') as f:
+        f.write((head + 'file: . %d\nEND\n' % offset).encode('latin-1'))
+        out.tofile(f)
+
+
+# the bounding box check of dipy's load_tractogram, True when all points are inside the grid
+def in_grid(pts, affine, shape, chunk=1000000):
+    inv = np.linalg.inv(affine)
+    hi = np.array(shape[:3]) + 1e-3
+    for i in range(0, len(pts), chunk):
+        vox = pts[i:i + chunk] @ inv[:3, :3].T + inv[:3, 3] + 0.5
+        if vox.min() < -1e-3 or np.any(vox.max(0) > hi):
+            return False
+    return True
+
+
+# list of arrays to .tck
+def save_streamlines(fname, streamlines, header=None):
+    pts, offs, lens = flatten(streamlines)
+    write_tck(fname, pts, offs, lens, header)
+
+
+def main(argv):
+    tck_files = []
+    usage = 'KUL_FWT_tckio.py -i <tck1,tck2,..>'
+    try:
+        opts, args = getopt.getopt(argv,"hi:",["ifiles="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-i", "--ifiles"):
+            tck_files = arg.split(',')
+
+    for tck in tck_files:
+        if os.path.isfile(tck):
+            pts, offs, lens, header = read_tck(tck)
+            print ('%s: %d streamlines, %d points' % (os.path.basename(tck), len(lens), len(pts)))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# One-time preparation of the KUL_FWT priors for multi-subject runs
+# Every subject run reads the same gzipped atlases and masks from KUL_FWT_templates again, and every
+# ANTs or mrtrix call on them gunzips the whole volume first. Running this once (-d <KUL_FWT_templates>)
+# fills a cache dir with an uncompressed .nii of every prior, which the make_VOIs/make_TCKs scripts
+# hand to ANTs and mrtrix instead of the .nii.gz (see prior() there). Label atlases and masks are
+# stored in the smallest integer type that holds them.
+# The cache dir is KUL_FWT_TEMPLATE_CACHE, or templates_<key> in the KUL_FWT user cache dir
+# (KUL_FWT_CACHE, ~/.cache/KUL_FWT by default), the key being a hash of the real path of the
+# templates dir, so checkouts with other templates don't share a cache.
+# Only assets whose source changed (size or mtime) are redone, so later runs only stat the sources.
+# The cache files are written read-only, concurrent subject runs on a node share them through the
+# page cache. A run that finds no (or a stale) cache keeps using the .nii.gz files.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, glob, json, fcntl, time, hashlib
+import numpy as np
+
+# bump this whenever the layout of the cache changes
+TEMPLATES_VERSION = 2
+
+INDEX_NAME = 'KUL_FWT_templates.json'
+
+# label images and masks the VOIs are cut from, their copies get an integer type
+VOI_SOURCES = ('JHU_WM_labels', 'SUIT_atlas_inMNI', 'Juelich_GNs_inMNI', 'PD25_hist_1mm_RLinMNI',
+               'Manual_VOIs', 'UKBB_BStem_VOIs_comb', 'Temp_BStem_labels', 'Temp_lobes_w_cereb_nuc',
+               'HRT1_Prior_segmentation', 'RL_hemi_masks', 'Lt_hemi_mask', 'Rt_hemi_mask',
+               'Lt_hemi_mask_temp', 'Rt_hemi_mask_temp', 'T1_UKBB_brain_mask', 'Temp_T1_brain_mask',
+               'adult_BET_mask')
+
+
+def templates_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'KUL_FWT_templates')
+
+
+# make_VOIs/make_TCKs find the same dir, keep prior() there in line with this
+def cache_dir(temp_d=None):
+    if os.environ.get('KUL_FWT_TEMPLATE_CACHE', ''):
+        return os.environ['KUL_FWT_TEMPLATE_CACHE']
+    key = hashlib.sha1(os.path.realpath(temp_d or templates_dir()).encode()).hexdigest()[:8]
+    root = os.environ.get('KUL_FWT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'KUL_FWT'))
+    return os.path.join(root, 'templates_' + key)
+
+
+def asset_name(path):
+    name = os.path.basename(path)
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _source_info(path):
+    st = os.stat(path)
+    return {'src': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _sources(temp_d):
+    return sorted(glob.glob(os.path.join(temp_d, '*.nii.gz')))
+
+
+# save to a temp file first, readers never see half a file, and leave it read-only
+# the temp name keeps the extension, nibabel and numpy go by it
+def _write_atomic(fname, save):
+    tmp = os.path.join(os.path.dirname(fname), '.%d.%s' % (os.getpid(), os.path.basename(fname)))
+    save(tmp)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, fname)
+
+
+def _save_json(fname, obj):
+    with open(fname, 'w') as f:
+        json.dump(obj, f, indent=1)
+
+
+def read_index(cdir):
+    try:
+        with open(os.path.join(cdir, INDEX_NAME)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return index if index.get('version') == TEMPLATES_VERSION else {}
+
+
+def _fresh(entry, path):
+    if not entry:
+        return False
+    try:
+        return all(entry.get(k) == v for k, v in _source_info(path).items())
+    except OSError:
+        return False
+
+
+def _prep_image(im, cdir):
+    import nibabel as nib
+    name = asset_name(im)
+    img = nib.load(im)
+    data = np.asanyarray(img.dataobj)
+    # labels and masks come as float64 or float32, their copy takes the smallest integer type that holds them
+    if name in VOI_SOURCES and data.dtype.kind == 'f' and np.array_equal(data, np.rint(data)):
+        for dt in (np.uint8, np.int16, np.uint16, np.int32):
+            if data.min() >= np.iinfo(dt).min and data.max() <= np.iinfo(dt).max:
+                data = data.astype(dt)
+                break
+    entry = _source_info(im)
+    entry.update(kind='image', shape=list(data.shape), dtype=str(data.dtype))
+
+    # scaling is applied already, the copy is stored as is
+    hdr = img.header.copy()
+    hdr.set_data_dtype(data.dtype)
+    out = nib.Nifti1Image(data, img.affine, hdr)
+    out.header.set_slope_inter(1, 0)
+    nii = os.path.join(cdir, name + '.nii')
+    _write_atomic(nii, lambda tmp: nib.save(out, tmp))
+    entry['nii'] = nii
+    return name, entry
+
+
+# bring the cache of temp_d up to date, returns the number of assets redone
+def prepare(temp_d=None, cdir=None, force=False):
+    temp_d = temp_d or templates_dir()
+    cdir = cdir or cache_dir(temp_d)
+    os.makedirs(cdir, exist_ok=True)
+    ims = _sources(temp_d)
+    # one preparation at a time, a second run waits and then finds everything done
+    with open(os.path.join(cdir, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = {} if force else read_index(cdir)
+        assets = index.get('assets', {})
+        n_done = 0
+        for im in ims:
+            if _fresh(assets.get(asset_name(im)), im):
+                continue
+            print ('Preparing "', im)
+            name, entry = _prep_image(im, cdir)
+            assets[name] = entry
+            n_done += 1
+        # assets whose source is gone are dropped from the index, their files are left in the cache dir
+        names = set(asset_name(im) for im in ims)
+        assets = {k: v for k, v in assets.items() if k in names}
+        if n_done or len(assets) != len(index.get('assets', {})):
+            index = {'version': TEMPLATES_VERSION, 'templates': os.path.abspath(temp_d),
+                     'prepared': time.strftime('%Y-%m-%dT%H:%M:%S'), 'assets': assets}
+            _write_atomic(os.path.join(cdir, INDEX_NAME), lambda tmp: _save_json(tmp, index))
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return n_done
+
+
+def main(argv):
+    temp_d = templates_dir()
+    cdir = ''
+    force = False
+    usage = 'KUL_FWT_templates.py [-d <KUL_FWT_templates>] [-c <cache_dir>] [-f]'
+    try:
+        opts, args = getopt.getopt(argv,"hd:c:f",["tdir=","cdir=","force"])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            sys.exit()
+        elif opt in ("-d", "--tdir"):
+            temp_d = arg
+        elif opt in ("-c", "--cdir"):
+            cdir = arg
+        elif opt in ("-f", "--force"):
+            force = True
+    cdir = cdir or cache_dir(temp_d)
+    print ('Templates dir is "', temp_d)
+    print ('Cache dir is "', cdir)
+
+    if not os.path.isdir(temp_d):
+        print ('KUL_FWT templates dir not found, exiting')
+        sys.exit(2)
+    try:
+        t0 = time.time()
+        n_done = prepare(temp_d, cdir, force)
+    except OSError as e:
+        # cache dir not writable, the runs use the .nii.gz files
+        print ('Templates cache not written (%s), the priors are read from "%s"' % (e, temp_d))
+        return
+    print ('%d template assets prepared in %.1f s' % (n_done, time.time() - t0))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Streamline warping to template space, replaces tcktransform in make_TCKs.sh
+# tcktransform read and interpolated the whole nonlinear warp again for every bundle. Here the
+# warp (the _inv_4TCKs.mif made by warpinit, antsApplyTransforms and warpcorrect) is memory-mapped,
+# so all bundles, and all bundle tasks running at the same time, share one page-cached copy.
+# Every point is mapped with vectorized trilinear interpolation of the warp, as tcktransform does:
+# a point outside the warp or where the warp is not valid (NaN) is dropped, and so is a streamline
+# with no points left. Several bundles can be warped in one run, over -n threads.
+# -c compares the output with the tcktransform output of the same bundle(s) and reports the
+# largest difference between points.
+# AR @ ahmed.radwan@kuleuven.be, radwanphd@gmail.com
+
+import os, sys, getopt, time
+import numpy as np
+import KUL_FWT_imcache as kimc
+import KUL_FWT_tckio as ktio
+import KUL_FWT_perf as kperf
+
+_MIF_DTYPES = {'Float32LE': '<f4', 'Float32BE': '>f4', 'Float64LE': '<f8', 'Float64BE': '>f8',
+               'Float32': '=f4', 'Float64': '=f8'}
+
+
+# uncompressed .mif as a read-only memmap in (i, j, k, volume) order, and its affine
+def load_mif(fname):
+    head = {}
+    transform = []
+    with open(fname, 'rb') as f:
+        if f.readline().strip() != b'mrtrix image':
+            raise ValueError('"%s" is not a mrtrix image' % fname)
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            if key.strip() == 'transform':
+                transform.append([float(v) for v in value.split(',')])
+            else:
+                head[key.strip()] = value.strip()
+    dims = [int(v) for v in head['dim'].split(',')]
+    vox = [float(v) for v in head['vox'].split(',')]
+    dtype = np.dtype(_MIF_DTYPES[head['datatype']])
+    fname_d, offset = head['file'].split()
+    if fname_d != '.':
+        raise ValueError('"%s": only single file .mif images are supported' % fname)
+
+    # layout: sign and rank of every axis in memory, rank 0 is the fastest
+    layout = head.get('layout', ','.join('+%d' % i for i in range(len(dims)))).split(',')
+    ranks = [int(v[1:]) for v in layout]
+    strides = [0] * len(dims)
+    step = dtype.itemsize
+    for ax in sorted(range(len(dims)), key=lambda a: ranks[a]):
+        strides[ax] = step
+        step *= dims[ax]
+    raw = np.memmap(fname, dtype=dtype, mode='r', offset=int(offset), shape=(int(np.prod(dims)),))
+    # reversed axes start at their last voxel
+    start = sum(strides[a] * (dims[a] - 1) for a in range(len(dims)) if layout[a][0] == '-')
+    data = np.lib.stride_tricks.as_strided(raw[start // dtype.itemsize:], shape=dims,
+                                           strides=[-s if layout[a][0] == '-' else s for a, s in enumerate(strides)],
+                                           writeable=False)
+    if 'scaling' in head:
+        offs, scale = [float(v) for v in head['scaling'].split(',')]
+        if (offs, scale) != (0.0, 1.0):
+            data = data * scale + offs
+
+    affine = np.eye(4)
+    affine[:3, :] = np.array(transform[:3])
+    affine[:3, :3] = affine[:3, :3] * np.array(vox[:3])
+    return data, affine
+
+
+# the warp (memmapped, x y z target position per voxel) and its affine
+def load_warp(fname):
+    if fname.endswith('.mif'):
+        return load_mif(fname)
+    return kimc.load_nifti(fname)
+
+
+# target positions of pts, and which ones the warp could map
+# trilinear as mrtrix' linear interpolator: voxel centres are integers, points up to half a voxel
+# outside still map, using the border voxels
+def warp_points(pts, warp, affine, chunk=1000000):
+    inv = np.linalg.inv(affine)
+    dims = np.array(warp.shape[:3])
+    out = np.empty((len(pts), 3))
+    for i in range(0, len(pts), chunk):
+        vox = pts[i:i + chunk] @ inv[:3, :3].T + inv[:3, 3]
+        inside = np.all((vox >= -0.5) & (vox <= dims - 0.5), axis=1)
+        i0 = np.floor(vox).astype(np.intp)
+        frac = vox - i0
+        res = np.zeros((len(vox), 3))
+        for corner in range(8):
+            off = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+            idx = np.clip(i0 + off, 0, dims - 1)
+            w = np.prod(np.where(off, frac, 1 - frac), axis=1)
+            res += w[:, None] * warp[idx[:, 0], idx[:, 1], idx[:, 2], :3]
+        res[~inside] = np.nan
+        out[i:i + chunk] = res
+    return out, np.all(np.isfinite(out), axis=1)
+
+
+# warp one flat bundle, returns the flat warped bundle
+def warp_bundle(pts, offs, lens, warp, affine):
+    # delimiters gone, points in streamline order
+    pts = pts[np.repeat(offs - (np.cumsum(lens) - lens), lens) + np.arange(int(np.sum(lens)))]
+    new, ok = warp_points(pts, warp, affine)
+    sl = np.repeat(np.arange(len(lens)), lens)
+    new_lens = np.bincount(sl[ok], minlength=len(lens))
+    new = new[ok].astype(np.float32)
+    new_lens = new_lens[new_lens > 0]
+    new_offs = np.concatenate([[0], np.cumsum(new_lens)[:-1]]).astype(np.intp)
+    return new, new_offs, new_lens
+
+
+def warp_tck(in_f, out_f, warp, affine):
+    t0 = time.time()
+    with kperf.stage('warp', out_f) as rec:
+        pts, offs, lens, header = ktio.read_tck(in_f)
+        rec.update(kperf.counts(lens))
+        new, new_offs, new_lens = warp_bundle(pts, offs, lens, warp, affine)
+        ktio.write_tck(out_f, new, new_offs, new_lens, header)
+    return '%s: %d streamlines warped, %d points dropped (%.1f s)' % (os.path.basename(out_f), len(new_lens),
+                                                                     int(np.sum(lens)) - len(new), time.time() - t0)
+
+
+# largest distance between matching points of two .tck files
+def compare(tck1, tck2):
+    p1, o1, l1, _ = ktio.read_tck(tck1)
+    p2, o2, l2, _ = ktio.read_tck(tck2)
+    if len(l1) != len(l2) or not np.array_equal(l1, l2):
+        return None
+    return float(np.max(np.linalg.norm(p1 - p2, axis=1))) if len(p1) else 0.0
+
+
+def main(argv):
+    in_files = []
+    out_files = []
+    warp_f = ''
+    ncpu = 1
+    ref_files = []
+    usage = 'KUL_FWT_warpTCKs.py -i <tck1,tck2,..> -w <warp.mif> [-o <out1,out2,..>] [-n <ncpu>] [-c <ref1,ref2,..>]'
+    try:
+        opts, args = getopt.getopt(argv,"hi:w:o:n:c:",["ifiles=","warp=","ofiles=","ncpu=","compare="])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print (usage)
+            print ('outputs default to <input>_inMNI.tck')
+            sys.exit()
+        elif opt in ("-i", "--ifiles"):
+            in_files = arg.split(',')
+        elif opt in ("-w", "--warp"):
+            warp_f = arg
+        elif opt in ("-o", "--ofiles"):
+            out_files = arg.split(',')
+        elif opt in ("-n", "--ncpu"):
+            ncpu = int(arg)
+        elif opt in ("-c", "--compare"):
+            ref_files = arg.split(',')
+    print ('Input files are "', in_files)
+    print ('Warp is "', warp_f)
+
+    if not out_files:
+        out_files = [f[:-len('.tck')] + '_inMNI.tck' for f in in_files]
+    if len(out_files) != len(in_files) or (ref_files and len(ref_files) != len(in_files)):
+        print ('Number of inputs, outputs and references do not match, exitting')
+        sys.exit(2)
+    if not os.path.isfile(warp_f):
+        print ('Warp not found, exitting')
+        sys.exit(2)
+    for f in in_files:
+        if not os.path.isfile(f):
+            print ('"%s" not found, exitting' % f)
+            sys.exit(2)
+
+    warp, affine = load_warp(warp_f)
+    if ncpu > 1 and len(in_files) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(min(ncpu, len(in_files))) as pool:
+            for msg in pool.map(lambda io: warp_tck(io[0], io[1], warp, affine), zip(in_files, out_files)):
+                print (msg)
+    else:
+        for in_f, out_f in zip(in_files, out_files):
+            print (warp_tck(in_f, out_f, warp, affine))
+
+    bad = 0
+    for out_f, ref_f in zip(out_files, ref_files):
+        diff = compare(out_f, ref_f)
+        if diff is None:
+            print ('%s: streamlines differ from %s' % (os.path.basename(out_f), ref_f))
+            bad += 1
+        else:
+            print ('%s: largest point difference to %s is %.2e mm' % (os.path.basename(out_f), ref_f, diff))
+    if bad:
+        sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,4 @@
+# the KUL_FWT tools are flat scripts in the repo root, import them from there
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
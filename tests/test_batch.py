@@ -0,0 +1,41 @@
+# KUL_FWT_batch.py runs the QQ engine stage on make_TCKs.sh output, it is done rather than skipped
+# when only the bundle itself is there (the resampled intermediates are debug only)
+
+import os
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+
+import KUL_FWT_batch as kbatch
+import KUL_FWT_synth as ksynth
+import KUL_FWT_tckio as ktio
+
+SHAPE = (40, 50, 40)
+AFFINE = np.array([[2., 0, 0, -60], [0, 2., 0, -60], [0, 0, 2., -40], [0, 0, 0, 1]])
+
+
+def test_qqengine_stage(tmp_path, monkeypatch):
+    monkeypatch.delenv('KUL_FWT_STORE', raising=False)
+    monkeypatch.delenv('KUL_FWT_DEBUG', raising=False)
+    out_d = tmp_path / 'KUL_FWT'
+    prep_d = out_d / 'sub-01_prep'
+    voi_d = out_d / 'sub-01_VOIs' / 'CST_LT_VOIs_inMNI'
+    tck_out = out_d / 'sub-01_TCKs_output' / 'CST_LT_output'
+    for d in (prep_d, voi_d, tck_out):
+        d.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    for m in ('FA_MNI', 'ADC_MNI', 'AD_MNI', 'RD_MNI'):
+        nib.save(nib.Nifti1Image(rng.random(SHAPE, dtype=np.float32), AFFINE), str(prep_d / (m + '.nii.gz')))
+    xyz = np.indices(SHAPE).reshape(3, -1).T * 2. + AFFINE[:3, 3]
+    for i, c in enumerate(ksynth.TRACT[[0, 2]]):
+        voi = (np.linalg.norm(xyz - c, axis=1) < 6).reshape(SHAPE).astype(np.uint8)
+        nib.save(nib.Nifti1Image(voi, AFFINE), str(voi_d / ('CST_LT_incs%d_map_inMNI.nii.gz' % (i + 1))))
+    ktio.write_tck(str(tck_out / 'CST_LT_fin_WB_iFOD2_inMNI.tck'), *ksynth.synth_bundle(20))
+
+    p = kbatch.bundle_paths(str(out_d), '01', '', 'CST_LT', 'WB', 'iFOD2')
+    p.update(stream=True, template=str(prep_d / 'FA_MNI.nii.gz'))
+    TCK, status, secs = kbatch.run_bundle(('CST_LT', p, ('qqengine',)))
+    assert status == ['done']
+    assert os.path.isfile(p['tck_reor'])
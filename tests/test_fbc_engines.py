@@ -0,0 +1,81 @@
+# The exact FBC engine against dipy's FBCMeasures, and bounds on how far the grid engine drifts from it
+# The grid engine is opt-in (KUL_FWT_FBC_4TCKs.py -e grid), these numbers are what KUL_FWT_fbc.py
+# promises for it: rFBC correlated at r > 0.99 and at most 2 % of the streamlines kept differently.
+
+import numpy as np
+import pytest
+
+pytest.importorskip('dipy')
+
+import KUL_FWT_fbc as kfbc
+import KUL_FWT_tckio as ktio
+import KUL_FWT_synth as ksynth
+
+
+@pytest.fixture(scope='module')
+def kernel():
+    return kfbc.get_kernel()
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_grid_close_to_exact(kernel, seed):
+    pts, offs, lens = ksynth.add_spurious(*ksynth.synth_bundle(150, seed), frac=0.05, seed=seed)
+    streamlines = ktio.as_arraysequence(pts, offs, lens)
+    exact = kfbc.streamline_rfbc(streamlines, kernel, 'exact')
+    grid = kfbc.streamline_rfbc(streamlines, kernel, 'grid')
+
+    assert np.corrcoef(exact, grid)[0, 1] > 0.99
+    for thr in (0.02, 0.05, 0.1):
+        assert np.mean((exact > thr) != (grid > thr)) <= 0.02
+    # the spurious streamlines are dropped by both at the default threshold
+    spur = np.arange(len(lens) - int(150 * 0.05), len(lens))
+    assert not np.any(exact[spur] > 0.02)
+    assert not np.any(grid[spur] > 0.02)
+
+
+# same rFBC as dipy up to summation order, also on more than one process
+@pytest.mark.parametrize('nproc', [1, 2])
+def test_exact_matches_dipy(kernel, nproc):
+    pts, offs, lens = ksynth.add_spurious(*ksynth.synth_bundle(60, 2), frac=0.05, seed=2)
+    streamlines = ktio.as_arraysequence(pts, offs, lens)
+    dipy_rfbc = kfbc.streamline_rfbc(streamlines, kernel, 'dipy')
+    exact = kfbc.FBCScores(streamlines, kernel, exact=True, nproc=nproc, max_pairs=200000).rfbc
+    assert np.allclose(exact, dipy_rfbc, rtol=1e-9, atol=1e-12)
+
+
+def test_dipy_is_default(kernel):
+    pts, offs, lens = ksynth.synth_bundle(40, 3)
+    streamlines = ktio.as_arraysequence(pts, offs, lens)
+    assert np.array_equal(kfbc.streamline_rfbc(streamlines, kernel), kfbc.streamline_rfbc(streamlines, kernel, 'dipy'))
+
+
+# tiny or empty bundles give an all-nan rFBC (nothing kept) instead of an error
+@pytest.mark.parametrize('engine', ['dipy', 'exact', 'grid', 'approx'])
+def test_nothing_to_score(kernel, engine):
+    short = ktio.as_arraysequence(np.zeros((25, 3), np.float32) + np.arange(25)[:, None], np.arange(0, 25, 5), np.full(5, 5))
+    empty = ktio.as_arraysequence(np.zeros((0, 3), np.float32), np.zeros(0, np.intp), np.zeros(0, np.intp))
+    assert np.all(np.isnan(kfbc.streamline_rfbc(short, kernel, engine)))
+    assert len(kfbc.streamline_rfbc(empty, kernel, engine)) == 0
+    assert kfbc.FBCScores([], kernel).get_points_rfbc_thresholded(0.02) == ([], [], [])
+
+
+# a representative weighted by its cluster size scores like the cluster itself: on a bundle where every
+# streamline comes 3 times, the approximate mode clusters the copies and matches the grid engine
+def test_approx_weighting(kernel):
+    pts, offs, lens = ksynth.add_spurious(*ksynth.synth_bundle(60, 4), frac=0.05, seed=4)
+    one = list(ktio.as_arraysequence(pts, offs, lens))
+    copies = ktio.as_arraysequence(*ktio.flatten([s for s in one for k in range(3)]))
+    rfbc, n_clusters = kfbc.approx_rfbc(copies, kernel, qb_thr=0.01)
+    assert n_clusters == len(one)
+    assert np.allclose(rfbc, kfbc.streamline_rfbc(copies, kernel, 'grid'), rtol=1e-6, atol=1e-9)
+
+
+# a single point can't be resampled for clustering, it is left out even when min_fiberlength lets it in
+def test_approx_short_streamlines(kernel):
+    pts, offs, lens = ksynth.synth_bundle(30, 5)
+    sl = list(ktio.as_arraysequence(pts, offs, lens)) + [np.zeros((1, 3), np.float32)]
+    for min_len in (1, 10):
+        rfbc = kfbc.streamline_rfbc(sl, kernel, 'approx', min_fiberlength=min_len)
+        assert np.isnan(rfbc[30]) and not np.any(np.isnan(rfbc[:30]))
+    rfbc, n_clusters = kfbc.approx_rfbc([], kernel)
+    assert len(rfbc) == 0 and n_clusters == 0
@@ -0,0 +1,35 @@
+# Manifest records: hashed inputs survive a touch, stat_only inputs (shared subject maps) do not
+
+import os
+
+import KUL_FWT_manifest as kman
+
+
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _touch_later(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_stat_only_inputs(tmp_path, monkeypatch):
+    monkeypatch.delenv('KUL_FWT_FORCE', raising=False)
+    tck, fa, out = (str(tmp_path / n) for n in ('b.tck', 'FA_MNI.nii.gz', 'b_prof.csv'))
+    for p in (tck, fa, out):
+        _write(p, p)
+    kman.record('profiles', [tck, fa], {}, [out], stat_only=[fa])
+
+    rec = kman._load_record(kman._record_file('profiles', [out]))
+    assert 'sha1' not in rec['inputs'][fa] and 'sha1' in rec['inputs'][tck]
+    assert kman.up_to_date('profiles', [tck, fa], {}, [out])
+
+    # same content, new mtime: the hashed input still matches
+    _touch_later(tck)
+    assert kman.up_to_date('profiles', [tck, fa], {}, [out])
+
+    # the map is only known by size and mtime, touching it redoes the stage
+    _touch_later(fa)
+    assert not kman.up_to_date('profiles', [tck, fa], {}, [out])
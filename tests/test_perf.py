@@ -0,0 +1,38 @@
+# Stage log: off unless KUL_FWT_PERF=1, peak RSS is the stage's own and not the process peak so far
+
+import json, os
+
+import numpy as np
+
+import KUL_FWT_perf as kperf
+
+
+def test_opt_in(tmp_path, monkeypatch):
+    out = str(tmp_path / 'x.tck')
+    monkeypatch.delenv('KUL_FWT_PERF', raising=False)
+    with kperf.stage('load', out):
+        pass
+    assert not os.path.isfile(tmp_path / kperf.LOG_NAME)
+    monkeypatch.setenv('KUL_FWT_PERF', '1')
+    with kperf.stage('load', out, streamlines=3):
+        pass
+    with open(tmp_path / kperf.LOG_NAME) as f:
+        rec = json.loads(f.readline())
+    assert rec['stage'] == 'load' and rec['streamlines'] == 3 and 'peak_rss_mb' in rec
+
+
+def test_stage_peak(monkeypatch):
+    big = np.ones(400 * 2 ** 20 // 8)
+    big_mb = kperf._hwm()
+    del big
+    with kperf.stage('small') as small:
+        np.ones(1000)
+    with kperf.stage('outer') as outer:
+        big = np.ones(400 * 2 ** 20 // 8)
+        del big
+        with kperf.stage('inner') as inner:
+            pass
+    if small['rss_scope'] == 'stage':
+        # the 400 MB from before the stage do not count, the nested reset does not hide the outer peak
+        assert small['peak_rss_mb'] < big_mb - 300
+        assert outer['peak_rss_mb'] > inner['peak_rss_mb'] + 300
@@ -0,0 +1,56 @@
+# KUL_FWT_QQengine.py on a small synthetic subject: SD_Stream bundles get the FOD metrics sampled
+# like iFOD2 ones, and a bundle FBC left empty is skipped instead of failing its task
+
+import os
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+
+import KUL_FWT_QQengine as kqqe
+import KUL_FWT_synth as ksynth
+import KUL_FWT_tckio as ktio
+
+# 2 mm grid around the synthetic tract
+SHAPE = (40, 50, 40)
+AFFINE = np.array([[2., 0, 0, -60], [0, 2., 0, -60], [0, 0, 2., -40], [0, 0, 0, 1]])
+
+
+def subject(tmp_path):
+    mdir = tmp_path / 'MNI'
+    tck_out = tmp_path / 'TCKs'
+    mdir.mkdir()
+    tck_out.mkdir()
+    rng = np.random.default_rng(0)
+    for m in ('FA_MNI', 'ADC_MNI', 'AD_MNI', 'RD_MNI', 'fd_MNI', 'disp_MNI', 'peaks_MNI'):
+        nib.save(nib.Nifti1Image(rng.random(SHAPE, dtype=np.float32), AFFINE), str(mdir / (m + '.nii.gz')))
+    xyz = np.indices(SHAPE).reshape(3, -1).T * 2. + AFFINE[:3, 3]
+    vois = []
+    for i, c in enumerate(ksynth.TRACT[[0, 2]]):
+        vois.append(str(tmp_path / ('voi%d.nii.gz' % i)))
+        voi = (np.linalg.norm(xyz - c, axis=1) < 6).reshape(SHAPE).astype(np.uint8)
+        nib.save(nib.Nifti1Image(voi, AFFINE), vois[-1])
+    template = str(mdir / 'FA_MNI.nii.gz')
+    return template, str(mdir), vois, tck_out
+
+
+@pytest.mark.parametrize('algo', ['SD_Stream', 'iFOD2', 'Tensor_Prob'])
+def test_fod_metrics_by_algo(tmp_path, monkeypatch, algo):
+    monkeypatch.delenv('KUL_FWT_STORE', raising=False)
+    template, mdir, vois, tck_out = subject(tmp_path)
+    tck = str(tck_out / ('CST_LT_fin_BT_%s_inMNI.tck' % algo))
+    ktio.write_tck(tck, *ksynth.synth_bundle(20))
+    assert kqqe.qq_bundle(tck, template, mdir, vois[0], vois[1], stream=True, profiles=False)
+    fd = tck_out / 'QQ' / ('CST_LT_fin_BT_%s_FD.csv' % algo)
+    assert (tck_out / 'QQ' / ('CST_LT_fin_BT_%s_FA.csv' % algo)).is_file()
+    assert fd.is_file() == (algo != 'Tensor_Prob')
+
+
+def test_empty_bundle(tmp_path, monkeypatch):
+    monkeypatch.delenv('KUL_FWT_STORE', raising=False)
+    template, mdir, vois, tck_out = subject(tmp_path)
+    tck = str(tck_out / 'CST_LT_fin_BT_iFOD2_inMNI.tck')
+    ktio.write_tck(tck, np.zeros((0, 3), np.float32), np.zeros(0, np.intp), np.zeros(0, np.intp))
+    assert kqqe.qq_bundle(tck, template, mdir, vois[0], vois[1], stream=True)
+    assert not os.path.isfile(str(tck_out / 'QQ' / 'CST_LT_fin_BT_iFOD2_inMNI_rTCK.tck'))
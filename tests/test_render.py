@@ -0,0 +1,35 @@
+# Render queue: jobs left in the running file of a render that died are done by the next one
+
+import json, os
+
+import pytest
+
+pytest.importorskip('matplotlib')
+
+import KUL_FWT_render as krend
+
+
+def _job(out):
+    return {'kind': 'profile', 'inputs': [], 'outs': [out], 'title': 'AF_LT', 'ylabel': 'FA',
+            'values': [0.4, 0.5, 0.45], 'dpi': 50, 'merge': False}
+
+
+def test_leftover_running_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('KUL_FWT_FORCE', '1')
+    queue_f = str(tmp_path / 'render_queue.jsonl')
+    # what a killed render left behind, and what was queued since
+    with open(queue_f + '.999999.running', 'w') as f:
+        f.write(json.dumps(_job(str(tmp_path / 'old.pdf'))) + '\n')
+    with open(queue_f, 'w') as f:
+        f.write(json.dumps(_job(str(tmp_path / 'new.pdf'))) + '\n')
+
+    assert krend.render_queue(queue_f) == (2, 0)
+    assert os.path.isfile(tmp_path / 'old.pdf') and os.path.isfile(tmp_path / 'new.pdf')
+    assert not list(tmp_path.glob('*.running')) and not os.path.isfile(queue_f)
+
+    # only a running file left is enough for a render to pick it up
+    with open(queue_f + '.999999.running', 'w') as f:
+        f.write(json.dumps(_job(str(tmp_path / 'again.pdf'))) + '\n')
+    assert krend.render_queue(queue_f) == (1, 0)
+    assert os.path.isfile(tmp_path / 'again.pdf')
+    assert krend.render_queue(queue_f) == (0, 0)
@@ -0,0 +1,51 @@
+# The QQ store: rewritten blocks of the same size go in place, dead rows are compacted away
+
+import numpy as np
+import pytest
+
+pytest.importorskip('h5py')
+
+import h5py
+import KUL_FWT_store as kstore
+
+
+def _rows(store_f, table):
+    with h5py.File(store_f, 'r') as h:
+        return h[table][kstore.TABLES[table][0][0]].shape[0]
+
+
+def test_same_size_in_place(tmp_path):
+    store_f = str(tmp_path / 'sub-01_QQ_store.h5')
+    kstore.add_profile(store_f, 'AF_LT_fin_BT_iFOD2', 'FA', np.full(101, 0.4))
+    kstore.add_profile(store_f, 'AF_LT_fin_BT_iFOD2', 'MD', np.full(101, 0.7))
+    kstore.add_profile(store_f, 'AF_LT_fin_BT_iFOD2', 'FA', np.full(101, 0.5))
+    assert _rows(store_f, 'profiles') == 202
+    out = kstore.read(store_f, 'profiles', metric='FA')
+    assert np.allclose(out['value'], 0.5) and len(out['value']) == 101
+    assert np.allclose(kstore.read(store_f, 'profiles', metric='MD')['value'], 0.7)
+
+
+def test_compaction(tmp_path):
+    store_f = str(tmp_path / 'sub-01_QQ_store.h5')
+    kstore.add_histogram(store_f, 'CST_LT_fin_BT_iFOD2', np.arange(50))
+    kstore.add_histogram(store_f, 'CST_RT_fin_BT_iFOD2', np.arange(60))
+    # a histogram of another size every time, the old ones go dead until the store is compacted
+    for n in range(70, 80):
+        kstore.add_histogram(store_f, 'CST_LT_fin_BT_iFOD2', np.arange(n))
+        n_rows = _rows(store_f, 'histograms')
+        assert n_rows - (n + 60) <= kstore.DEAD_FRAC * n_rows
+    assert kstore.read(store_f, 'histograms', bundle='CST_LT')['count'].tolist() == list(range(79))
+    assert kstore.read(store_f, 'histograms', bundle='CST_RT')['count'].tolist() == list(range(60))
+    assert not list(tmp_path.glob('*.compact'))
+
+
+# SD_Stream has an underscore of its own, its blocks still go under bundle, method and algorithm
+def test_sd_stream_names(tmp_path):
+    assert kstore.parse_name('CST_LT_fin_BT_SD_Stream') == ('CST_LT', 'BT', 'SD_Stream')
+    assert kstore.parse_name('AF_LT_fin_BT_iFOD2') == ('AF_LT', 'BT', 'iFOD2')
+    assert kstore.parse_name('CST_LT_initial') == ('CST_LT_initial', '', '')
+    store_f = str(tmp_path / 'sub-01_QQ_store.h5')
+    kstore.add_histogram(store_f, 'CST_LT_fin_BT_SD_Stream', np.arange(40))
+    assert kstore.has(store_f, 'histograms', 'CST_LT', 'SD_Stream', 'BT', 'length')
+    out = kstore.read(store_f, 'histograms', bundle='CST_LT', algo='SD_Stream', method='BT')
+    assert out['count'].tolist() == list(range(40))
@@ -0,0 +1,41 @@
+# Templates cache: only .nii copies, in a dir the shell prior() finds under the same key
+
+import os, subprocess
+
+import numpy as np
+import pytest
+
+import KUL_FWT_templates as ktpl
+
+
+def test_cache_dir_matches_shell(tmp_path, monkeypatch):
+    monkeypatch.delenv('KUL_FWT_TEMPLATE_CACHE', raising=False)
+    monkeypatch.setenv('KUL_FWT_CACHE', str(tmp_path / 'cache'))
+    temp_d = tmp_path / 'KUL_FWT_templates'
+    temp_d.mkdir()
+    # the same key lines as make_VOIs/make_TCKs
+    sh = ('pr_d=%s; tpl_key=$(printf %%s "$(cd "${pr_d}" && pwd -P)" | sha1sum | cut -c1-8); '
+          'echo "${KUL_FWT_TEMPLATE_CACHE:-${KUL_FWT_CACHE:-${HOME}/.cache/KUL_FWT}/templates_${tpl_key}}"' % temp_d)
+    out = subprocess.run(['bash', '-c', sh], capture_output=True, text=True, check=True).stdout.strip()
+    assert out == ktpl.cache_dir(str(temp_d))
+    assert not out.startswith(str(temp_d))
+    monkeypatch.setenv('KUL_FWT_TEMPLATE_CACHE', str(tmp_path / 'mine'))
+    assert ktpl.cache_dir(str(temp_d)) == str(tmp_path / 'mine')
+
+
+def test_prepare_nii_only(tmp_path):
+    nib = pytest.importorskip('nibabel')
+    temp_d, cdir = tmp_path / 'tpl', tmp_path / 'c'
+    temp_d.mkdir()
+    labels = np.zeros((4, 5, 6), np.float64)
+    labels[1:3, 2:4, 3:5] = 7
+    nib.save(nib.Nifti1Image(labels, np.eye(4)), str(temp_d / 'JHU_WM_labels.nii.gz'))
+    nib.save(nib.Nifti1Image(np.full((4, 5, 6), 0.5, np.float32), np.eye(4)), str(temp_d / 'FA_MNI.nii.gz'))
+
+    assert ktpl.prepare(str(temp_d), str(cdir)) == 2
+    assert sorted(f for f in os.listdir(cdir) if not f.startswith('.')) == \
+        ['FA_MNI.nii', 'JHU_WM_labels.nii', ktpl.INDEX_NAME]
+    lab = nib.load(str(cdir / 'JHU_WM_labels.nii'))
+    assert lab.get_data_dtype() == np.uint8 and np.array_equal(lab.get_fdata(), labels)
+    # nothing changed, nothing redone
+    assert ktpl.prepare(str(temp_d), str(cdir)) == 0
@@ -0,0 +1,87 @@
+# KUL_FWT_warpTCKs.py on a synthetic warp: a linear (so exactly interpolated) displacement field
+# saved as .mif with different strides, points outside the warp and streamlines left empty are dropped
+
+import numpy as np
+import pytest
+
+import KUL_FWT_tckio as ktio
+import KUL_FWT_warpTCKs as kwarp
+
+DIMS = (10, 12, 9)
+VOX = 2.
+# scanner position of voxel 0, the rotation part of the mrtrix transform is the identity
+ORIGIN = np.array([-10., -12., -8.])
+AFFINE = np.diag([VOX, VOX, VOX, 1.])
+AFFINE[:3, 3] = ORIGIN
+
+# target of every scanner position p is A p + b
+A = np.array([[1.1, 0.05, 0.], [0., 0.9, 0.1], [0.02, 0., 1.]])
+B = np.array([3., -2., 1.])
+
+
+def field():
+    ijk = np.stack(np.meshgrid(*[np.arange(d) for d in DIMS], indexing='ij'), -1)
+    xyz = ijk * VOX + ORIGIN
+    return (xyz @ A.T + B).astype(np.float32)
+
+
+# single file .mif with the given layout, e.g. '+0,+1,+2,+3'
+def write_mif(fname, data, layout):
+    axes = layout.split(',')
+    mem = data
+    for a, s in enumerate(axes):
+        if s[0] == '-':
+            mem = np.flip(mem, a)
+    # slowest axis first in C order
+    mem = np.ascontiguousarray(np.transpose(mem, sorted(range(data.ndim), key=lambda a: -int(axes[a][1:]))))
+    lines = ['mrtrix image', 'dim: ' + ','.join(str(d) for d in data.shape), 'vox: %g,%g,%g,1' % (VOX, VOX, VOX),
+             'layout: ' + layout, 'datatype: Float32LE']
+    lines += ['transform: ' + ','.join('%g' % v for v in row) for row in np.c_[np.eye(3), ORIGIN]]
+    head = '\n'.join(lines) + '\nfile: . '
+    # the offset is part of the header it points past
+    offset = len(head) + len('END\n') + 8
+    head += '%-7d\nEND\n' % offset
+    assert len(head) == offset
+    with open(fname, 'wb') as f:
+        f.write(head.encode('latin-1'))
+        f.write(mem.astype('<f4').tobytes())
+
+
+@pytest.mark.parametrize('layout', ['+0,+1,+2,+3', '-0,+1,+2,+3', '+3,+2,+1,+0'])
+def test_linear_warp(tmp_path, layout):
+    warp_f = str(tmp_path / 'warp.mif')
+    write_mif(warp_f, field(), layout)
+    warp, affine = kwarp.load_mif(warp_f)
+    assert np.array_equal(warp, field())
+    assert np.allclose(affine, AFFINE)
+
+    rng = np.random.default_rng(0)
+    # 3 streamlines well inside the warp, one running out of it and one completely outside
+    lo, hi = ORIGIN, ORIGIN + (np.array(DIMS) - 1) * VOX
+    inside = [lo + rng.random((n, 3)) * (hi - lo) for n in (5, 8, 3)]
+    leaving = np.linspace(hi - 2., hi + 6., 9)
+    outside = np.linspace(lo - 10., lo - 4., 4)
+    pts, offs, lens = ktio.flatten(inside[:2] + [leaving, outside] + inside[2:], dtype=np.float64)
+
+    new, new_offs, new_lens = kwarp.warp_bundle(pts, offs, lens, warp, affine)
+
+    # points up to half a voxel past the last voxel centre still map, the rest of leaving is dropped
+    keep = np.all(leaving <= hi + VOX / 2, axis=1)
+    assert 0 < keep.sum() < len(leaving)
+    assert list(new_lens) == [5, 8, int(keep.sum()), 3]
+    expect = np.concatenate(inside[:2] + [leaving[keep]] + inside[2:]) @ A.T + B
+    # the field is linear, trilinear interpolation gives it back exactly, except past the border voxels
+    inner = np.ones(len(expect), bool)
+    inner[13:13 + keep.sum()] = np.all(leaving[keep] <= hi, axis=1)
+    assert np.allclose(new[inner], expect[inner], atol=1e-3)
+    assert np.array_equal(new_offs, np.concatenate([[0], np.cumsum(new_lens)[:-1]]))
+
+
+def test_nan_voxels_dropped(tmp_path):
+    warp = field()
+    warp[4:, :, :] = np.nan
+    pts = np.array([[0., 0., 0.], [-10., -12., -8.], [5., 0., 0.]])
+    new, new_offs, new_lens = kwarp.warp_bundle(pts, np.array([0]), np.array([3]), warp, AFFINE)
+    # only the point whose interpolation uses no invalid voxel is kept
+    assert list(new_lens) == [1]
+    assert np.allclose(new[0], np.array([-10., -12., -8.]) @ A.T + B, atol=1e-4)